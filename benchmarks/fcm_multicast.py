@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Compares building the FCM requests of a 100k-token send one Message at a time,
+as messaging.send_each does, with splicing each token into a MessageTemplate,
+as gcm_async and gcm.send_message with FCM_USE_ASYNC do. gcm.send_message
+takes the first path unless FCM_USE_ASYNC is set.
+
+Usage: python benchmarks/fcm_multicast.py [number of tokens]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tests.settings")
+
+import django  # noqa: E402
+
+
+django.setup()
+
+from push_notifications.gcm import (  # noqa: E402
+	MessageTemplate, _prepare_message, dict_to_fcm_message, encode_message
+)
+
+
+CHUNK_SIZE = 500
+
+
+def per_message(message, tokens):
+	# what send_each does for each Message of a chunk
+	for token in tokens:
+		yield encode_message(_prepare_message(message, token))
+
+
+def template(message, tokens):
+	template = MessageTemplate(message)
+	for token in tokens:
+		yield template.render(token)
+
+
+def chunk_peak(fn, message, tokens):
+	"""Peak memory allocated while building the requests of one chunk."""
+	tracemalloc.start()
+	bodies = list(fn(message, tokens))
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	del bodies
+	return peak
+
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	tokens = ["%0152x" % i for i in range(count)]
+	message = dict_to_fcm_message(
+		{"message": "Hello world", "title": "Greetings", "foo": "bar", "baz": "qux"},
+		collapse_key="greetings", priority="high", time_to_live=3600,
+	)
+
+	results = {}
+	for fn in (per_message, template):
+		start = time.perf_counter()
+		for _ in fn(message, tokens):
+			pass
+		elapsed = time.perf_counter() - start
+		peak = chunk_peak(fn, message, tokens[:CHUNK_SIZE])
+		results[fn.__name__] = elapsed
+		print("{:<12} {:>8.3f}s {:>8.1f} us/token {:>10.1f} KiB per {}-token chunk".format(
+			fn.__name__, elapsed, elapsed / count * 1e6, peak / 1024, CHUNK_SIZE
+		))
+
+	print("speedup: {:.1f}x".format(results["per_message"] / results["template"]))
+
+
+if __name__ == "__main__":
+	main()
@@ -4,40 +4,300 @@ Documentation is available on the iOS Developer Library:
 https://developer.apple.com/library/content/documentation/NetworkingInternet/Conceptual/RemoteNotificationsPG/APNSOverview.html
 """
 
+import collections
+import json
+import threading
 import time
 
+import h2.exceptions
+import jwt
 from apns2 import client as apns2_client
 from apns2 import credentials as apns2_credentials
 from apns2 import errors as apns2_errors
 from apns2 import payload as apns2_payload
+from hyper.http20 import exceptions as hyper_exceptions
 
 from . import models
+from .batching import bounded_map, pages
 from .conf import get_manager
+from .deactivation import deactivation_sink
 from .exceptions import APNSError, APNSUnsupportedPriority, APNSServerError
+from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+
+
+# Raised by the HTTP/2 stack under APNsClient when the connection was lost or
+# shut down by APNs (GOAWAY). The pooled connection is discarded when it happens.
+CONNECTION_ERRORS = (
+	OSError, hyper_exceptions.ConnectionError, hyper_exceptions.ProtocolError,
+	h2.exceptions.ProtocolError,
+)
+
+# Provider tokens are signed again this many seconds before TOKEN_LIFETIME
+# runs out, so that no request goes out with a token about to expire.
+TOKEN_REFRESH_MARGIN = 60
+
+# Credentials are built once per configuration, see _apns_get_credentials.
+_credentials = {}
+_credentials_lock = threading.Lock()
+
+
+class APNSTokenCredentials(apns2_credentials.Credentials):
+	"""
+	Token-based (.p8 signing key) credentials for APNs.
+
+	The key is read once, and the signed provider token (JWT) is reused for
+	every request until it is `token_lifetime` seconds old, minus
+	TOKEN_REFRESH_MARGIN.
+
+	:param auth_key_path: str: Path to the .p8 signing key.
+	:param auth_key_id: str: The 10-character key id of the signing key.
+	:param team_id: str: The 10-character team id.
+	:param encryption_algorithm: str: The JWT signing algorithm.
+	:param token_lifetime: int: Seconds a provider token is used for. Apple
+	rejects tokens older than one hour.
+	"""
+
+	def __init__(
+		self, auth_key_path, auth_key_id, team_id,
+		encryption_algorithm=apns2_credentials.DEFAULT_TOKEN_ENCRYPTION_ALGORITHM,
+		token_lifetime=apns2_credentials.DEFAULT_TOKEN_LIFETIME
+	):
+		super().__init__()
+		with open(auth_key_path) as f:
+			self.auth_key = f.read()
+		self.auth_key_id = auth_key_id
+		self.team_id = team_id
+		self.encryption_algorithm = encryption_algorithm
+		self.token_lifetime = token_lifetime
+
+		self._lock = threading.Lock()
+		self._token = None
+		self._issued_at = None
+
+	def get_authorization_header(self, topic):
+		return "bearer %s" % (self.get_token())
+
+	def get_token(self):
+		"""
+		Returns the current provider token, signing a new one if it is due.
+		"""
+		with self._lock:
+			now = time.time()
+			if self._token is None or now >= self._issued_at + self._refresh_after:
+				self._token = self._sign(int(now))
+				self._issued_at = int(now)
+			return self._token
+
+	@property
+	def _refresh_after(self):
+		return max(self.token_lifetime - TOKEN_REFRESH_MARGIN, 0)
+
+	def _sign(self, issued_at):
+		token = jwt.encode(
+			{"iss": self.team_id, "iat": issued_at},
+			self.auth_key,
+			algorithm=self.encryption_algorithm,
+			headers={"alg": self.encryption_algorithm, "kid": self.auth_key_id},
+		)
+		# PyJWT < 2 returns bytes
+		if isinstance(token, bytes):
+			token = token.decode("ascii")
+		return token
+
+
+def _apns_get_credentials(application_id=None):
+	"""
+	Returns the credentials of the application, built on first use and shared
+	by every connection using the same settings.
+	"""
+	manager = get_manager()
+	if manager.has_auth_token_creds(application_id):
+		key = ("token",) + tuple(manager.get_apns_auth_creds(application_id)) + (
+			manager.get_apns_encryption_algorithm(application_id),
+			manager.get_apns_token_lifetime(application_id),
+		)
+	else:
+		key = ("certificate", manager.get_apns_certificate(application_id))
+
+	with _credentials_lock:
+		creds = _credentials.get(key)
+		if creds is None:
+			if key[0] == "token":
+				creds = APNSTokenCredentials(*key[1:])
+			else:
+				creds = apns2_credentials.CertificateCredentials(key[1])
+			_credentials[key] = creds
+	return creds
 
 
 def _apns_create_socket(creds=None, application_id=None):
 	if creds is None:
-		if not get_manager().has_auth_token_creds(application_id):
-			cert = get_manager().get_apns_certificate(application_id)
-			creds = apns2_credentials.CertificateCredentials(cert)
-		else:
-			keyPath, keyId, teamId = get_manager().get_apns_auth_creds(application_id)
-			# No use getting a lifetime because this credential is
-			# ephemeral, but if you're looking at this to see how to
-			# create a credential, you could also pass the lifetime and
-			# algorithm. Neither of those settings are exposed in the
-			# settings API at the moment.
-			creds = creds or apns2_credentials.TokenCredentials(keyPath, keyId, teamId)
+		creds = _apns_get_credentials(application_id)
 	client = apns2_client.APNsClient(
 		creds,
 		use_sandbox=get_manager().get_apns_use_sandbox(application_id),
-		use_alternative_port=get_manager().get_apns_use_alternative_port(application_id)
+		use_alternative_port=get_manager().get_apns_use_alternative_port(application_id),
+		json_encoder=APNSPayloadEncoder
 	)
 	client.connect()
 	return client
 
 
+def _apns_close_socket(client):
+	try:
+		client._connection.close()
+	except Exception:
+		# the connection is being thrown away, it may well be broken already
+		pass
+
+
+class APNSClientPool:
+	"""
+	Keeps a connected APNsClient per application and credentials, so that sends
+	reuse an open HTTP/2 connection to APNs instead of paying a TLS and HTTP/2
+	handshake every time.
+
+	Clients unused for APNS_CONNECTION_IDLE_TIMEOUT seconds are closed the next
+	time the pool is used.
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._clients = {}
+
+	def get(self, key, factory):
+		"""
+		Returns the client stored under `key`, connecting a new one with
+		`factory()` if there is none.
+		"""
+		now = time.monotonic()
+		with self._lock:
+			idle = self._pop_idle(now)
+			entry = self._clients.get(key)
+			if entry is not None:
+				self._clients[key] = (entry[0], now)
+		for client in idle:
+			_apns_close_socket(client)
+		if entry is not None:
+			return entry[0]
+
+		client = factory()
+		with self._lock:
+			entry = self._clients.setdefault(key, (client, now))
+		if entry[0] is not client:
+			# another thread connected first, use its client
+			_apns_close_socket(client)
+		return entry[0]
+
+	def discard(self, key, client):
+		"""
+		Closes `client` and removes it from the pool, e.g. after a connection error.
+		"""
+		with self._lock:
+			entry = self._clients.get(key)
+			if entry is not None and entry[0] is client:
+				del self._clients[key]
+		_apns_close_socket(client)
+
+	def clear(self):
+		"""
+		Closes every pooled client.
+		"""
+		with self._lock:
+			clients, self._clients = self._clients, {}
+		for client, _ in clients.values():
+			_apns_close_socket(client)
+
+	def __len__(self):
+		return len(self._clients)
+
+	def _pop_idle(self, now):
+		timeout = SETTINGS["APNS_CONNECTION_IDLE_TIMEOUT"]
+		idle = [key for key, (_, last_used) in self._clients.items() if now - last_used > timeout]
+		return [self._clients.pop(key)[0] for key in idle]
+
+
+apns_client_pool = APNSClientPool()
+
+
+def _apns_connection_owner(creds, application_id):
+	"""
+	Connections authenticated with a provider token can send to every topic of
+	the team, so applications whose token credentials are the same (see
+	_apns_get_credentials) share them. Certificate connections belong to their
+	application.
+	"""
+	if isinstance(creds, APNSTokenCredentials):
+		return None
+	return application_id
+
+
+def _apns_client_key(creds=None, application_id=None, connection_index=0):
+	manager = get_manager()
+	if creds is None:
+		creds = _apns_get_credentials(application_id)
+	return (
+		_apns_connection_owner(creds, application_id), creds,
+		manager.get_apns_use_sandbox(application_id),
+		manager.get_apns_use_alternative_port(application_id),
+		connection_index,
+	)
+
+
+class _SerializedDict(dict):
+	"""The dict of an APNSPayload, along with its JSON serialization."""
+	serialized = None
+
+
+class APNSPayload(apns2_payload.Payload):
+	"""
+	A Payload that is serialized to JSON once, no matter how many notifications
+	it is sent with. APNsClient must be created with APNSPayloadEncoder for the
+	serialization to be reused.
+
+	The payload must not be modified once it has been sent.
+	"""
+
+	def dict(self):
+		result = getattr(self, "_dict", None)
+		if result is None:
+			result = self._dict = _SerializedDict(super().dict())
+			# the same options APNsClient serializes payloads with
+			result.serialized = json.dumps(result, ensure_ascii=False, separators=(",", ":"))
+		return result
+
+
+class APNSPayloadEncoder(json.JSONEncoder):
+	"""
+	Returns the cached serialization of APNSPayload dicts instead of encoding
+	them again.
+	"""
+
+	def encode(self, o):
+		if isinstance(o, _SerializedDict) and o.serialized is not None:
+			return o.serialized
+		return super().encode(o)
+
+
+class BatchedProvider:
+	"""
+	Computes a per-device `badge` or `extra` for a whole batch of tokens at once,
+	e.g. with one aggregate query, instead of calling a function per token.
+
+	:param fn: callable: Called with a list of registration ids, returns a mapping
+	of registration id to value.
+	:param default: The value of tokens missing from the mapping.
+	"""
+
+	def __init__(self, fn, default=None):
+		self.fn = fn
+		self.default = default
+
+	def resolve(self, tokens):
+		values = self.fn(tokens)
+		return {token: values.get(token, self.default) for token in tokens}
+
+
 def _apns_prepare(
 	token, alert, application_id=None, badge=None, sound=None, category=None,
 	content_available=False, action_loc_key=None, loc_key=None, loc_args=[],
@@ -49,20 +309,56 @@ def _apns_prepare(
 		else:
 			apns2_alert = alert
 
-		if callable(badge):
+		if isinstance(badge, BatchedProvider):
+			badge = badge.resolve([token])[token]
+		elif callable(badge):
 			badge = badge(token)
+		if isinstance(extra, BatchedProvider):
+			extra = extra.resolve([token])[token]
 
-		return apns2_payload.Payload(
+		return APNSPayload(
 			alert=apns2_alert, badge=badge, sound=sound, category=category,
 			url_args=url_args, custom=extra, thread_id=thread_id,
 			content_available=content_available, mutable_content=mutable_content)
 
 
-def _apns_send(
-	registration_id, alert, batch=False, application_id=None, creds=None, **kwargs
-):
-	client = _apns_create_socket(creds=creds, application_id=application_id)
+def _apns_prepare_batch(tokens, alert, **kwargs):
+	"""
+	Returns the notifications for `tokens`. Tokens whose badge and extra resolve
+	to the same values share one payload, which is serialized only once.
+	"""
+	tokens = list(tokens)
+	per_token = {}
+	for name in ("badge", "extra"):
+		value = kwargs.get(name)
+		if isinstance(value, BatchedProvider):
+			per_token[name] = value.resolve(tokens)
+		elif name == "badge" and callable(value):
+			per_token[name] = {token: value(token) for token in tokens}
+
+	if not per_token:
+		# the payload is the same for every token, build and serialize it once
+		payload = _apns_prepare(None, alert, **kwargs)
+		return [apns2_client.Notification(token=token, payload=payload) for token in tokens]
+
+	payloads = {}
+	notifications = []
+	for token in tokens:
+		token_kwargs = dict(kwargs)
+		for name, values in per_token.items():
+			token_kwargs[name] = values[token]
+		key = json.dumps([token_kwargs.get("badge"), token_kwargs.get("extra")], sort_keys=True)
+		payload = payloads.get(key)
+		if payload is None:
+			payload = payloads[key] = _apns_prepare(token, alert, **token_kwargs)
+		notifications.append(apns2_client.Notification(token=token, payload=payload))
+	return notifications
+
 
+def _apns_notification_kwargs(kwargs):
+	"""
+	Pops the options sent as request headers from `kwargs`.
+	"""
 	notification_kwargs = {}
 
 	# if expiration isn"t specified use 1 month from now
@@ -78,23 +374,82 @@ def _apns_send(
 			raise APNSUnsupportedPriority("Unsupported priority %d" % (priority))
 
 	notification_kwargs["collapse_id"] = kwargs.pop("collapse_id", None)
+	return notification_kwargs
+
 
+def _apns_send_async(
+	registration_id, data, batch, topic, application_id, creds, connection_index,
+	notification_kwargs
+):
+	from . import apns_async
+	from .http2 import run
+
+	if not batch:
+		data = [apns2_client.Notification(token=registration_id, payload=data)]
+	results = run(apns_async.send_notifications(
+		data, topic, application_id=application_id, creds=creds,
+		connection_index=connection_index, **notification_kwargs
+	))
 	if batch:
-		data = [apns2_client.Notification(
-			token=rid, payload=_apns_prepare(rid, alert, **kwargs)) for rid in registration_id]
-		# returns a dictionary mapping each token to its result. That
-		# result is either "Success" or the reason for the failure.
-		return client.send_notification_batch(
-			data, get_manager().get_apns_topic(application_id=application_id),
-			**notification_kwargs
+		return results
+
+	result = results[registration_id]
+	if isinstance(result, Exception):
+		raise result
+	if result != "Success":
+		# raised the way APNsClient.send_notification does
+		if isinstance(result, tuple):
+			reason, info = result
+			raise apns2_errors.exception_class_for_reason(reason)(info)
+		raise apns2_errors.exception_class_for_reason(result)
+
+
+def _apns_send(
+	registration_id, alert, batch=False, application_id=None, creds=None,
+	connection_index=0, **kwargs
+):
+	notification_kwargs = _apns_notification_kwargs(kwargs)
+	topic = get_manager().get_apns_topic(application_id=application_id)
+
+	if SETTINGS["APNS_USE_ASYNC"]:
+		if batch:
+			data = _apns_prepare_batch(registration_id, alert, **kwargs)
+		else:
+			data = _apns_prepare(registration_id, alert, **kwargs)
+		return _apns_send_async(
+			registration_id, data, batch, topic, application_id, creds, connection_index,
+			notification_kwargs
 		)
 
-	data = _apns_prepare(registration_id, alert, **kwargs)
-	client.send_notification(
-		registration_id, data,
-		get_manager().get_apns_topic(application_id=application_id),
-		**notification_kwargs
+	key = _apns_client_key(
+		creds=creds, application_id=application_id, connection_index=connection_index
 	)
+	client = apns_client_pool.get(
+		key, lambda: _apns_create_socket(creds=creds, application_id=application_id)
+	)
+
+	if batch:
+		data = _apns_prepare_batch(registration_id, alert, **kwargs)
+		try:
+			# returns a dictionary mapping each token to its result. That
+			# result is either "Success" or the reason for the failure.
+			return client.send_notification_batch(data, topic, **notification_kwargs)
+		except CONNECTION_ERRORS:
+			# part of the batch may have been delivered, don't send it twice
+			apns_client_pool.discard(key, client)
+			raise
+
+	data = _apns_prepare(registration_id, alert, **kwargs)
+	try:
+		client.send_notification(registration_id, data, topic, **notification_kwargs)
+	except CONNECTION_ERRORS:
+		# the pooled connection went away (GOAWAY, idle timeout), retry once
+		# on a new one
+		apns_client_pool.discard(key, client)
+		client = apns_client_pool.get(
+			key, lambda: _apns_create_socket(creds=creds, application_id=application_id)
+		)
+		client.send_notification(registration_id, data, topic, **notification_kwargs)
 
 
 def apns_send_message(registration_id, alert, application_id=None, creds=None, **kwargs):
@@ -116,29 +471,70 @@ def apns_send_message(registration_id, alert, application_id=None, creds=None, *
 		)
 	except apns2_errors.APNsException as apns2_exception:
 		if isinstance(apns2_exception, apns2_errors.Unregistered):
-			device = models.APNSDevice.objects.get(registration_id=registration_id)
-			device.active = False
-			device.save()
+			deactivation_sink.add(models.APNSDevice, [registration_id])
 
 		raise APNSServerError(status=apns2_exception.__class__.__name__)
 
 
+def _apns_result_reason(result):
+	# Unregistered (410) results come with the time the token became invalid
+	if isinstance(result, tuple):
+		return result[0]
+	# requests of the asyncio client that failed, see APNSTransport.send_notifications
+	if isinstance(result, Exception):
+		return type(result).__name__
+	return result
+
+
+def _apns_deactivate_unregistered(results):
+	inactive_tokens = [
+		token for token, result in results.items()
+		if _apns_result_reason(result) == "Unregistered"
+	]
+	deactivation_sink.add(models.APNSDevice, inactive_tokens)
+
+
+def _apns_count_results(counts, results):
+	counts.update(_apns_result_reason(result) for result in results.values())
+
+
 def apns_send_bulk_message(
-	registration_ids, alert, application_id=None, creds=None, **kwargs
+	registration_ids, alert, application_id=None, creds=None, return_results=True, **kwargs
 ):
 	"""
 	Sends an APNS notification to one or more registration_ids.
-	The registration_ids argument needs to be a list.
+	The registration_ids argument can be any iterable, including a generator.
+	It is consumed and sent in windows of APNS_BATCH_SIZE tokens; the
+	notifications of a window are released once it has been sent, and its
+	unregistered devices deactivated. With CONNECTIONS set above 1, that many
+	windows are sent in parallel, each over its own connection.
+
+	Returns a dict mapping each token to its result. With return_results=False,
+	the results of a window are dropped once it has been handled and a
+	collections.Counter of the results (e.g. {"Success": 998, "Unregistered": 2})
+	is returned instead, so that memory doesn't grow with the audience.
 
 	Note that if set alert should always be a string. If it is not set,
 	it won"t be included in the notification. You will need to pass None
 	to this for silent notifications.
 	"""
 
-	results = _apns_send(
-		registration_ids, alert, batch=True, application_id=application_id,
-		creds=creds, **kwargs
-	)
-	inactive_tokens = [token for token, result in results.items() if result == "Unregistered"]
-	models.APNSDevice.objects.filter(registration_id__in=inactive_tokens).update(active=False)
+	connections = get_manager().get_apns_connections(application_id)
+
+	def send(indexed_window):
+		# window i goes over connection i % connections
+		index, window = indexed_window
+		return _apns_send(
+			window, alert, batch=True, application_id=application_id,
+			creds=creds, connection_index=index % connections, **kwargs
+		)
+
+	results = {} if return_results else collections.Counter()
+	windows = enumerate(pages(registration_ids, SETTINGS["APNS_BATCH_SIZE"]))
+	for _, window_results in bounded_map(send, windows, connections):
+		_apns_deactivate_unregistered(window_results)
+		if return_results:
+			results.update(window_results)
+		else:
+			_apns_count_results(results, window_results)
 	return results
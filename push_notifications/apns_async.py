@@ -0,0 +1,326 @@
+"""
+Apple Push Notification Service over asyncio
+
+Sends notifications to APNs over a single multiplexed HTTP/2 connection per
+application, or per provider token shared by several applications, keeping up
+to APNS_MAX_CONCURRENT_STREAMS requests in flight instead of going through the
+blocking loop of `apns2`.
+
+The coroutines can be awaited directly. `apns.apns_send_message` and
+`apns.apns_send_bulk_message` use them when APNS_USE_ASYNC is enabled, running
+them on the background event loop of `http2.run` so that connections outlive
+each call.
+Documentation is available on the Apple Developer website:
+https://developer.apple.com/documentation/usernotifications/sending-notification-requests-to-apns
+"""
+
+import asyncio
+import collections
+import ssl
+
+from apns2 import client as apns2_client
+from apns2 import credentials as apns2_credentials
+from apns2 import errors as apns2_errors
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ImproperlyConfigured
+
+from . import models
+from .apns import (
+	_apns_connection_owner, _apns_count_results, _apns_deactivate_unregistered,
+	_apns_get_credentials, _apns_notification_kwargs, _apns_prepare, _apns_prepare_batch,
+	_apns_result_reason
+)
+from .batching import pages
+from .conf import get_manager
+from .deactivation import deactivation_sink
+from .exceptions import APNSServerError
+from .http2 import HTTP2Error, HTTP2Transport, TransportRegistry, run  # noqa: F401
+from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+
+
+APNS_HOST = "api.push.apple.com"
+APNS_SANDBOX_HOST = "api.development.push.apple.com"
+APNS_PORT = 443
+APNS_ALTERNATIVE_PORT = 2197
+
+# One transport per application and credentials, for each event loop.
+_transports = TransportRegistry()
+
+# SSL contexts holding a client certificate, per certificate file.
+_ssl_contexts = {}
+
+
+def _apns_headers(payload, topic=None, priority=None, expiration=None, collapse_id=None):
+	"""
+	Returns the request headers of a notification, the same ones APNsClient sends.
+	"""
+	headers = []
+	if topic is not None:
+		headers.append(("apns-topic", topic))
+		if topic.endswith(".voip"):
+			push_type = apns2_client.NotificationType.VoIP
+		elif topic.endswith(".complication"):
+			push_type = apns2_client.NotificationType.Complication
+		elif topic.endswith(".pushkit.fileprovider"):
+			push_type = apns2_client.NotificationType.FileProvider
+		elif any([
+			payload.alert is not None, payload.badge is not None, payload.sound is not None
+		]):
+			push_type = apns2_client.NotificationType.Alert
+		else:
+			push_type = apns2_client.NotificationType.Background
+		headers.append(("apns-push-type", push_type.value))
+	if priority is not None and priority != apns2_client.DEFAULT_APNS_PRIORITY:
+		headers.append(("apns-priority", priority.value))
+	if expiration is not None:
+		headers.append(("apns-expiration", "%d" % expiration))
+	if collapse_id is not None:
+		headers.append(("apns-collapse-id", collapse_id))
+	return headers
+
+
+def _apns_result(response):
+	"""
+	Returns "Success", the reason of the failure, or a (reason, timestamp) tuple
+	for unregistered tokens, like APNsClient.get_notification_result.
+	"""
+	if response.status == 200:
+		return "Success"
+	data = response.json()
+	if response.status == 410:
+		return data["reason"], data["timestamp"]
+	return data["reason"]
+
+
+def _ssl_context(certificate):
+	context = _ssl_contexts.get(certificate)
+	if context is None:
+		context = ssl.create_default_context()
+		context.load_cert_chain(certificate)
+		_ssl_contexts[certificate] = context
+	return context
+
+
+class APNSTransport(HTTP2Transport):
+	"""
+	Sends notifications to APNs over a single HTTP/2 connection.
+
+	:param auth: apns2.credentials.Credentials: Token credentials, whose
+	authorization header is sent with every request. None for certificates.
+	:param ssl_context: ssl.SSLContext: The context holding the client
+	certificate, if any.
+	:param use_sandbox: bool: Send to the development environment.
+	:param use_alternative_port: bool: Use port 2197 instead of 443.
+	:param host: str: Overrides the APNs host, e.g. a local stub server in tests.
+	:param port: int: Overrides the APNs port.
+	:param secure: bool: Use TLS. Only disable it to talk to local stub servers.
+	:param max_concurrent_streams: int: The maximum number of requests in flight,
+	APNS_MAX_CONCURRENT_STREAMS by default.
+	"""
+
+	def __init__(
+		self, auth=None, ssl_context=None, use_sandbox=False, use_alternative_port=False,
+		host=None, port=None, secure=True, max_concurrent_streams=None
+	):
+		super().__init__(
+			host or (APNS_SANDBOX_HOST if use_sandbox else APNS_HOST),
+			port or (APNS_ALTERNATIVE_PORT if use_alternative_port else APNS_PORT),
+			ssl_context=ssl_context, secure=secure,
+			max_concurrent_streams=(
+				max_concurrent_streams or SETTINGS["APNS_MAX_CONCURRENT_STREAMS"]
+			)
+		)
+		self.auth = auth
+
+	async def send(self, token, payload, topic=None, **notification_kwargs):
+		"""
+		Sends `payload` to `token`.
+
+		:param payload: apns.APNSPayload: Shared by every token it is sent to, it
+		is only serialized once.
+		:return: "Success", the reason of the failure, or a (reason, timestamp)
+		tuple for unregistered tokens.
+		:raises HTTP2Error: if the request failed, ValueError if APNs answered
+		with something else than its JSON error body.
+		"""
+		headers = _apns_headers(payload, topic, **notification_kwargs)
+		if self.auth is not None:
+			authorization = self.auth.get_authorization_header(topic)
+			if authorization is not None:
+				headers.append(("authorization", authorization))
+		body = payload.dict().serialized.encode("utf-8")
+		response = await self.request("POST", "/3/device/%s" % (token), headers, body)
+		return _apns_result(response)
+
+	async def send_notifications(self, notifications, topic=None, **notification_kwargs):
+		"""
+		Sends the notifications, keeping up to `max_concurrent_streams` of them in
+		flight. A request that fails (stream reset, lost connection, unexpected
+		response) doesn't stop the others: its exception is its token's result.
+
+		:param notifications: iterable of apns2.client.Notification
+		:return: A dict mapping each token to its result, see `send`, or to the
+		exception its request failed with.
+		"""
+		results = {}
+		slots = asyncio.Semaphore(self.max_concurrent_streams)
+		pending = set()
+
+		async def send(notification):
+			try:
+				results[notification.token] = await self.send(
+					notification.token, notification.payload, topic, **notification_kwargs
+				)
+			except (HTTP2Error, OSError, ValueError, KeyError) as e:
+				results[notification.token] = e
+			finally:
+				slots.release()
+
+		for notification in notifications:
+			await slots.acquire()
+			# reserve the slot in order, so the results keep the tokens' order
+			results[notification.token] = None
+			task = asyncio.ensure_future(send(notification))
+			pending.add(task)
+			task.add_done_callback(pending.discard)
+		if pending:
+			await asyncio.gather(*pending)
+
+		return results
+
+
+def _transport_key(application_id=None, creds=None, connection_index=0):
+	manager = get_manager()
+	if creds is None:
+		if manager.has_auth_token_creds(application_id):
+			creds = _apns_get_credentials(application_id)
+		else:
+			creds = manager.get_apns_certificate(application_id)
+	return (
+		_apns_connection_owner(creds, application_id), creds,
+		manager.get_apns_use_sandbox(application_id),
+		manager.get_apns_use_alternative_port(application_id),
+		connection_index,
+	)
+
+
+def get_transport(application_id=None, creds=None, connection_index=0):
+	"""
+	Returns the APNSTransport of the application for the running event loop,
+	creating it on first use.
+
+	:param creds: apns2.credentials.TokenCredentials or str: Overrides the
+	credentials of the application, token credentials or the path of a
+	certificate file.
+	:param connection_index: int: Which of the application's CONNECTIONS to use.
+	"""
+	if isinstance(creds, apns2_credentials.CertificateCredentials):
+		# apns2 keeps the SSL context of certificate credentials to itself
+		raise ImproperlyConfigured(
+			"The asyncio APNS client needs certificate credentials as the path of "
+			"the certificate file."
+		)
+	key = _transport_key(application_id, creds, connection_index)
+
+	def create():
+		_, creds, use_sandbox, use_alternative_port, _ = key
+		if isinstance(creds, str):
+			auth, ssl_context = None, _ssl_context(creds)
+		else:
+			auth, ssl_context = creds, None
+		return APNSTransport(
+			auth, ssl_context, use_sandbox=use_sandbox,
+			use_alternative_port=use_alternative_port
+		)
+
+	return _transports.get(key, create)
+
+
+async def send_notifications(
+	notifications, topic=None, application_id=None, creds=None, transport=None,
+	connection_index=0, **notification_kwargs
+):
+	"""
+	Sends already prepared notifications with the application's transport.
+
+	:return: A dict mapping each token to its result.
+	"""
+	transport = transport or get_transport(application_id, creds, connection_index)
+	return await transport.send_notifications(notifications, topic, **notification_kwargs)
+
+
+async def send_message(
+	registration_id, alert, application_id=None, creds=None, transport=None, **kwargs
+):
+	"""
+	Sends an APNS notification to a single registration_id, the asyncio
+	counterpart of `apns.apns_send_message`. Raises APNSServerError if APNs
+	rejects it.
+	"""
+	notification_kwargs = _apns_notification_kwargs(kwargs)
+	topic = get_manager().get_apns_topic(application_id=application_id)
+	notification = apns2_client.Notification(
+		token=registration_id, payload=_apns_prepare(registration_id, alert, **kwargs)
+	)
+	results = await send_notifications(
+		[notification], topic, application_id, creds, transport, **notification_kwargs
+	)
+	result = results[registration_id]
+	if isinstance(result, Exception):
+		raise result
+	reason = _apns_result_reason(result)
+	if reason != "Success":
+		if reason == "Unregistered":
+			await sync_to_async(deactivation_sink.add)(models.APNSDevice, [registration_id])
+		raise APNSServerError(status=apns2_errors.exception_class_for_reason(reason).__name__)
+
+
+async def send_bulk_message(
+	registration_ids, alert, application_id=None, creds=None, transport=None,
+	return_results=True, **kwargs
+):
+	"""
+	Sends an APNS notification to one or more registration_ids, the asyncio
+	counterpart of `apns.apns_send_bulk_message`. registration_ids can be any
+	iterable, it is sent in windows of APNS_BATCH_SIZE tokens. Up to CONNECTIONS
+	windows are sent at a time, window i over connection i % CONNECTIONS.
+
+	:return: A dict mapping each token to its result, or with
+	return_results=False a collections.Counter of the results.
+	"""
+	notification_kwargs = _apns_notification_kwargs(kwargs)
+	manager = get_manager()
+	topic = manager.get_apns_topic(application_id=application_id)
+	connections = 1 if transport else manager.get_apns_connections(application_id)
+
+	async def send_window(connection_index, window):
+		# a BatchedProvider may query the database
+		notifications = await sync_to_async(_apns_prepare_batch)(window, alert, **kwargs)
+		return await send_notifications(
+			notifications, topic, application_id, creds, transport,
+			connection_index=connection_index, **notification_kwargs
+		)
+
+	results = {} if return_results else collections.Counter()
+	pending = collections.deque()
+
+	async def collect():
+		window_results = await pending.popleft()
+		await sync_to_async(_apns_deactivate_unregistered)(window_results)
+		if return_results:
+			results.update(window_results)
+		else:
+			_apns_count_results(results, window_results)
+
+	try:
+		windows = pages(registration_ids, SETTINGS["APNS_BATCH_SIZE"])
+		for index, window in enumerate(windows):
+			if len(pending) >= connections:
+				await collect()
+			pending.append(asyncio.ensure_future(send_window(index % connections, window)))
+		while pending:
+			await collect()
+	finally:
+		for task in pending:
+			task.cancel()
+	return results
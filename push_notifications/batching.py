@@ -0,0 +1,44 @@
+"""
+Helpers shared by the bulk senders, which stream their registration ids
+rather than holding every one of them in memory.
+"""
+
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+
+def pages(iterable, page_size):
+	"""
+	Yields the items of `iterable` in lists of at most `page_size`.
+	"""
+	iterator = iter(iterable)
+	while True:
+		page = list(itertools.islice(iterator, page_size))
+		if not page:
+			return
+		yield page
+
+
+def bounded_map(fn, items, max_workers):
+	"""
+	Yields `(item, fn(item))` for each of `items`, in order, calling `fn` from
+	up to `max_workers` threads at a time. Only `max_workers` calls are queued
+	ahead of the one yielded, so `items` can be a stream, and an error stops
+	the map without going through the remaining items first.
+	"""
+	if max_workers <= 1:
+		for item in items:
+			yield item, fn(item)
+		return
+
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		pending = collections.deque()
+		for item in items:
+			if len(pending) >= max_workers:
+				done, future = pending.popleft()
+				yield done, future.result()
+			pending.append((item, executor.submit(fn, item)))
+		while pending:
+			done, future = pending.popleft()
+			yield done, future.result()
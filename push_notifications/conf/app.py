@@ -51,19 +51,19 @@ APNS_AUTH_CREDS_REQUIRED = ["AUTH_KEY_PATH", "AUTH_KEY_ID", "TEAM_ID"]
 APNS_AUTH_CREDS_OPTIONAL = ["CERTIFICATE", "ENCRYPTION_ALGORITHM", "TOKEN_LIFETIME"]
 
 APNS_OPTIONAL_SETTINGS = [
-	"USE_SANDBOX", "USE_ALTERNATIVE_PORT", "TOPIC"
+	"USE_SANDBOX", "USE_ALTERNATIVE_PORT", "TOPIC", "CONNECTIONS"
 ]
 
 FCM_REQUIRED_SETTINGS = []
 FCM_OPTIONAL_SETTINGS = [
-	"MAX_RECIPIENTS", "FIREBASE_APP"
+	"MAX_RECIPIENTS", "MAX_WORKERS", "FIREBASE_APP"
 ]
 
 WNS_REQUIRED_SETTINGS = ["PACKAGE_SECURITY_ID", "SECRET_KEY"]
-WNS_OPTIONAL_SETTINGS = ["WNS_ACCESS_URL"]
+WNS_OPTIONAL_SETTINGS = ["WNS_ACCESS_URL", "MAX_WORKERS"]
 
 WP_REQUIRED_SETTINGS = ["PRIVATE_KEY", "CLAIMS"]
-WP_OPTIONAL_SETTINGS = ["ERROR_TIMEOUT", "POST_URL"]
+WP_OPTIONAL_SETTINGS = ["ERROR_TIMEOUT", "POST_URL", "MAX_WORKERS"]
 
 
 class AppConfig(BaseConfig):
@@ -165,6 +165,9 @@ class AppConfig(BaseConfig):
 		application_config.setdefault("USE_SANDBOX", False)
 		application_config.setdefault("USE_ALTERNATIVE_PORT", False)
 		application_config.setdefault("TOPIC", None)
+		application_config.setdefault("CONNECTIONS", 1)
+		application_config.setdefault("TOKEN_LIFETIME", 2700)
+		application_config.setdefault("ENCRYPTION_ALGORITHM", "ES256")
 
 	def _validate_apns_certificate(self, certfile):
 		"""Validate the APNS certificate at startup."""
@@ -189,7 +192,8 @@ class AppConfig(BaseConfig):
 		)
 
 		application_config.setdefault("FIREBASE_APP", None)
-		application_config.setdefault("MAX_RECIPIENTS", 1000)
+		application_config.setdefault("MAX_RECIPIENTS", 500)
+		application_config.setdefault("MAX_WORKERS", 1)
 
 	def _validate_wns_config(self, application_id, application_config):
 		allowed = (
@@ -202,6 +206,7 @@ class AppConfig(BaseConfig):
 		)
 
 		application_config.setdefault("WNS_ACCESS_URL", "https://login.live.com/accesstoken.srf")
+		application_config.setdefault("MAX_WORKERS", 1)
 
 	def _validate_wp_config(self, application_id, application_config):
 		allowed = (
@@ -218,6 +223,8 @@ class AppConfig(BaseConfig):
 			"EDGE": "https://wns2-par02p.notify.windows.com/w",
 			"FIREFOX": "https://updates.push.services.mozilla.com/wpush/v2",
 		})
+		application_config.setdefault("MAX_WORKERS", 1)
+		application_config.setdefault("ERROR_TIMEOUT", None)
 
 	def _validate_allowed_settings(self, application_id, application_config, allowed_settings):
 		"""Confirm only allowed settings are present."""
@@ -296,6 +303,9 @@ class AppConfig(BaseConfig):
 	def get_max_recipients(self, application_id=None):
 		return self._get_application_settings(application_id, "FCM", "MAX_RECIPIENTS")
 
+	def get_max_workers(self, application_id=None):
+		return self._get_application_settings(application_id, "FCM", "MAX_WORKERS")
+
 	def get_apns_certificate(self, application_id=None):
 		r = self._get_application_settings(application_id, "APNS", "CERTIFICATE")
 		if not isinstance(r, str):
@@ -326,6 +336,12 @@ class AppConfig(BaseConfig):
 	def _get_apns_team_id(self, application_id=None):
 		return self._get_application_settings(application_id, "APNS", "TEAM_ID")
 
+	def get_apns_token_lifetime(self, application_id=None):
+		return self._get_application_settings(application_id, "APNS", "TOKEN_LIFETIME")
+
+	def get_apns_encryption_algorithm(self, application_id=None):
+		return self._get_application_settings(application_id, "APNS", "ENCRYPTION_ALGORITHM")
+
 	def get_apns_use_sandbox(self, application_id=None):
 		return self._get_application_settings(application_id, "APNS", "USE_SANDBOX")
 
@@ -335,12 +351,18 @@ class AppConfig(BaseConfig):
 	def get_apns_topic(self, application_id=None):
 		return self._get_application_settings(application_id, "APNS", "TOPIC")
 
+	def get_apns_connections(self, application_id=None):
+		return self._get_application_settings(application_id, "APNS", "CONNECTIONS")
+
 	def get_wns_package_security_id(self, application_id=None):
 		return self._get_application_settings(application_id, "WNS", "PACKAGE_SECURITY_ID")
 
 	def get_wns_secret_key(self, application_id=None):
 		return self._get_application_settings(application_id, "WNS", "SECRET_KEY")
 
+	def get_wns_max_workers(self, application_id=None):
+		return self._get_application_settings(application_id, "WNS", "MAX_WORKERS")
+
 	def get_wp_post_url(self, application_id, browser):
 		return self._get_application_settings(application_id, "WP", "POST_URL")[browser]
 
@@ -349,3 +371,9 @@ class AppConfig(BaseConfig):
 
 	def get_wp_claims(self, application_id=None):
 		return self._get_application_settings(application_id, "WP", "CLAIMS")
+
+	def get_wp_max_workers(self, application_id=None):
+		return self._get_application_settings(application_id, "WP", "MAX_WORKERS")
+
+	def get_wp_error_timeout(self, application_id=None):
+		return self._get_application_settings(application_id, "WP", "ERROR_TIMEOUT")
@@ -15,21 +15,42 @@ class BaseConfig:
 	def get_apns_auth_creds(self, application_id=None):
 		raise NotImplementedError
 
+	def get_apns_token_lifetime(self, application_id=None):
+		raise NotImplementedError
+
+	def get_apns_encryption_algorithm(self, application_id=None):
+		raise NotImplementedError
+
 	def get_apns_use_sandbox(self, application_id=None):
 		raise NotImplementedError
 
 	def get_apns_use_alternative_port(self, application_id=None):
 		raise NotImplementedError
 
+	def get_apns_connections(self, application_id=None):
+		raise NotImplementedError
+
 	def get_wns_package_security_id(self, application_id=None):
 		raise NotImplementedError
 
 	def get_wns_secret_key(self, application_id=None):
 		raise NotImplementedError
 
+	def get_wns_max_workers(self, application_id=None):
+		raise NotImplementedError
+
+	def get_wp_max_workers(self, application_id=None):
+		raise NotImplementedError
+
+	def get_wp_error_timeout(self, application_id=None):
+		raise NotImplementedError
+
 	def get_max_recipients(self, application_id=None):
 		raise NotImplementedError
 
+	def get_max_workers(self, application_id=None):
+		raise NotImplementedError
+
 	def get_applications(self):
 		"""Returns a collection containing the configured applications."""
 
@@ -45,6 +45,13 @@ class LegacyConfig(BaseConfig):
 		)
 		return self._get_application_settings(application_id, key, msg)
 
+	def get_max_workers(self, application_id=None):
+		key = "FCM_MAX_WORKERS"
+		msg = (
+			'Set PUSH_NOTIFICATIONS_SETTINGS["{}"] to send messages through FCM.'.format(key)
+		)
+		return self._get_application_settings(application_id, key, msg)
+
 	def has_auth_token_creds(self, application_id=None):
 		try:
 			self._get_apns_auth_key(application_id)
@@ -89,6 +96,14 @@ class LegacyConfig(BaseConfig):
 	def _get_apns_auth_key_id(self, application_id=None):
 		return self._get_application_settings(application_id, "APNS_AUTH_KEY_ID", self.msg)
 
+	def get_apns_token_lifetime(self, application_id=None):
+		return self._get_application_settings(application_id, "APNS_TOKEN_LIFETIME", self.msg)
+
+	def get_apns_encryption_algorithm(self, application_id=None):
+		return self._get_application_settings(
+			application_id, "APNS_ENCRYPTION_ALGORITHM", self.msg
+		)
+
 	def get_apns_use_sandbox(self, application_id=None):
 		return self._get_application_settings(application_id, "APNS_USE_SANDBOX", self.msg)
 
@@ -98,6 +113,9 @@ class LegacyConfig(BaseConfig):
 	def get_apns_topic(self, application_id=None):
 		return self._get_application_settings(application_id, "APNS_TOPIC", self.msg)
 
+	def get_apns_connections(self, application_id=None):
+		return self._get_application_settings(application_id, "APNS_CONNECTIONS", self.msg)
+
 	def get_apns_host(self, application_id=None):
 		return self._get_application_settings(application_id, "APNS_HOST", self.msg)
 
@@ -117,6 +135,9 @@ class LegacyConfig(BaseConfig):
 		msg = "Setup PUSH_NOTIFICATIONS_SETTINGS properly to send messages"
 		return self._get_application_settings(application_id, "WNS_SECRET_KEY", msg)
 
+	def get_wns_max_workers(self, application_id=None):
+		return self._get_application_settings(application_id, "WNS_MAX_WORKERS", self.msg)
+
 	def get_wp_post_url(self, application_id, browser):
 		msg = "Setup PUSH_NOTIFICATIONS_SETTINGS properly to send messages"
 		return self._get_application_settings(application_id, "WP_POST_URL", msg)[browser]
@@ -128,3 +149,9 @@ class LegacyConfig(BaseConfig):
 	def get_wp_claims(self, application_id=None):
 		msg = "Setup PUSH_NOTIFICATIONS_SETTINGS properly to send messages"
 		return self._get_application_settings(application_id, "WP_CLAIMS", msg)
+
+	def get_wp_max_workers(self, application_id=None):
+		return self._get_application_settings(application_id, "WP_MAX_WORKERS", self.msg)
+
+	def get_wp_error_timeout(self, application_id=None):
+		return self._get_application_settings(application_id, "WP_ERROR_TIMEOUT", self.msg)
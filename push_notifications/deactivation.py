@@ -0,0 +1,174 @@
+"""
+Write-behind deactivation of devices with invalid registration ids.
+
+The send functions of every platform hand the registration ids the push
+service rejected to `deactivation_sink` instead of updating the device tables
+themselves. The sink buffers them per device model and writes them in batches
+of at most DEACTIVATION_BATCH_SIZE rows, each in its own short transaction:
+
+- as soon as they are added, if DEACTIVATION_BUFFER_SIZE is 0 (the default);
+- otherwise when DEACTIVATION_BUFFER_SIZE ids are pending, when the oldest
+one has waited DEACTIVATION_FLUSH_INTERVAL seconds, or when the process exits.
+
+Ids that fail to be written are kept pending and written with the next ones.
+"""
+
+import atexit
+import logging
+import threading
+import time
+
+from django.db import connections, router, transaction
+
+from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+
+
+logger = logging.getLogger(__name__)
+
+# Batches larger than this are joined against a VALUES list on PostgreSQL,
+# which plans much better than a long IN (...) list.
+VALUES_JOIN_THRESHOLD = 100
+
+
+def _deactivate_batch(model, registration_ids, field="registration_id"):
+	using = router.db_for_write(model)
+	connection = connections[using]
+	with transaction.atomic(using=using):
+		if connection.vendor == "postgresql" and len(registration_ids) > VALUES_JOIN_THRESHOLD:
+			table = connection.ops.quote_name(model._meta.db_table)
+			active = connection.ops.quote_name(model._meta.get_field("active").column)
+			key = model._meta.pk if field == "pk" else model._meta.get_field(field)
+			key = connection.ops.quote_name(key.column)
+			sql = (
+				"UPDATE {table} SET {active} = false "
+				"FROM (VALUES {values}) AS dead (key) "
+				"WHERE {table}.{key} = dead.key AND {table}.{active}"
+			).format(
+				table=table, active=active, key=key,
+				values=", ".join(["(%s)"] * len(registration_ids)),
+			)
+			with connection.cursor() as cursor:
+				cursor.execute(sql, list(registration_ids))
+		else:
+			model._default_manager.using(using).filter(
+				active=True, **{field + "__in": registration_ids}
+			).update(active=False)
+
+
+def deactivate_devices(model, registration_ids, batch_size=None, field="registration_id"):
+	"""
+	Marks the devices of `model` with one of `registration_ids` as inactive, in
+	batches of at most `batch_size` rows (DEACTIVATION_BATCH_SIZE by default).
+
+	:param field: str: The field `registration_ids` are values of, e.g. "pk"
+	to deactivate single devices rather than every device of a registration id.
+	"""
+	batch_size = batch_size or SETTINGS["DEACTIVATION_BATCH_SIZE"]
+	registration_ids = list(registration_ids)
+	for i in range(0, len(registration_ids), batch_size):
+		_deactivate_batch(model, registration_ids[i:i + batch_size], field)
+
+
+class DeactivationSink:
+	"""
+	Collects registration ids to deactivate, per device model and field, and
+	writes them with `deactivate_devices`. Safe to use from several threads.
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._pending = {}
+		self._count = 0
+		self._first_added = None
+		self._timer = None
+
+	def add(self, model, registration_ids, field="registration_id"):
+		"""
+		Queues `registration_ids` of `model` for deactivation. Errors writing
+		them are logged, not raised: the send that rejected them is done.
+
+		:param field: str: See `deactivate_devices`.
+		"""
+		registration_ids = [r for r in registration_ids if r]
+		if not registration_ids:
+			return
+
+		with self._lock:
+			due = self._queue((model, field), registration_ids)
+
+		if due:
+			self._flush_and_log()
+
+	def _queue(self, key, registration_ids):
+		"""
+		Adds `registration_ids` to the pending ones of `key`, a (model, field)
+		pair, with the lock held.
+
+		:return: bool: Whether the pending ids are due to be written.
+		"""
+		buffer_size = SETTINGS["DEACTIVATION_BUFFER_SIZE"]
+		flush_interval = SETTINGS["DEACTIVATION_FLUSH_INTERVAL"]
+		pending = self._pending.setdefault(key, set())
+		before = len(pending)
+		pending.update(registration_ids)
+		self._count += len(pending) - before
+		if self._first_added is None:
+			self._first_added = time.monotonic()
+
+		due = self._count >= buffer_size or (
+			flush_interval and time.monotonic() - self._first_added >= flush_interval
+		)
+		if not due and flush_interval and self._timer is None:
+			self._timer = threading.Timer(flush_interval, self._flush_in_background)
+			self._timer.daemon = True
+			self._timer.start()
+		return due
+
+	def flush(self):
+		"""
+		Writes every pending registration id. If writing fails, the ids not
+		written yet are queued again and the error is raised.
+		"""
+		with self._lock:
+			pending, self._pending = self._pending, {}
+			self._count = 0
+			self._first_added = None
+			if self._timer is not None:
+				self._timer.cancel()
+				self._timer = None
+
+		pending = list(pending.items())
+		for i, ((model, field), registration_ids) in enumerate(pending):
+			try:
+				deactivate_devices(model, registration_ids, field=field)
+			except Exception:
+				# writing them again is harmless, only active devices are updated
+				with self._lock:
+					for key, registration_ids in pending[i:]:
+						self._queue(key, registration_ids)
+				raise
+
+	def _flush_and_log(self):
+		try:
+			self.flush()
+		except Exception:
+			logger.exception("Could not deactivate devices, they are kept pending")
+
+	def _flush_in_background(self):
+		with self._lock:
+			self._timer = None
+		try:
+			self._flush_and_log()
+		finally:
+			# database connections are per thread, don't leak this one
+			connections.close_all()
+
+	@property
+	def pending(self):
+		"""The number of registration ids waiting to be written."""
+		return self._count
+
+
+deactivation_sink = DeactivationSink()
+
+atexit.register(deactivation_sink.flush)
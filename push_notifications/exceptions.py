@@ -25,3 +25,13 @@ class GCMError(NotificationError):
 # Web Push
 class WebPushError(NotificationError):
 	pass
+
+
+class WebPushThrottledError(WebPushError):
+	"""
+	The push service answered 429 or 503: no more requests should be sent to
+	it for `retry_after` seconds.
+	"""
+	def __init__(self, msg, retry_after):
+		super().__init__(msg)
+		self.retry_after = retry_after
@@ -5,18 +5,27 @@ Documentation is available on the Firebase Developer website:
 https://firebase.google.com/docs/cloud-messaging/
 """
 
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
 from typing import List, Union
 
+from django.core.exceptions import ImproperlyConfigured
 from firebase_admin import messaging
 from firebase_admin.exceptions import FirebaseError, InvalidArgumentError
 
 from .conf import get_manager
+from .deactivation import deactivation_sink
+from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
 
 
 # Valid keys for FCM messages. Reference:
 # https://firebase.google.com/docs/cloud-messaging/http-server-ref
 
+# send_each accepts at most 500 messages per call
+FCM_MAX_BATCH_SIZE = 500
+
 FCM_NOTIFICATIONS_PAYLOAD_KEYS = [
 	"title", "body", "icon", "image", "sound", "badge", "color", "tag", "click_action",
 	"body_loc_key", "body_loc_args", "title_loc_key", "title_loc_args", "android_channel_id"
@@ -136,13 +145,63 @@ def _deactivate_devices_with_error_results(
 			if _validate_exception_for_deactivation(x.reason)
 		]
 	from .models import GCMDevice
-	GCMDevice.objects.filter(registration_id__in=deactivated_ids).update(active=False)
+	deactivation_sink.add(GCMDevice, deactivated_ids)
 	return deactivated_ids
 
 
 def _prepare_message(message: messaging.Message, token: str):
+	message = copy(message)
 	message.token = token
-	return copy(message)
+	return message
+
+
+def _message_encoder():
+	# firebase_admin has no public API returning the request body of a message:
+	# use the encoder send_each relies on, if this version still has it
+	service = getattr(messaging, "_MessagingService", None)
+	return getattr(service, "encode_message", None)
+
+
+def encode_message(message: messaging.Message, dry_run=False) -> bytes:
+	"""
+	Returns the FCM v1 `messages:send` request body of `message`.
+	"""
+	encoder = _message_encoder()
+	if encoder is None:
+		raise ImproperlyConfigured(
+			"This version of firebase_admin can't encode messages outside of send_each."
+		)
+	data = {"message": encoder(message)}
+	if dry_run:
+		data["validate_only"] = True
+	return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+class MessageTemplate:
+	"""
+	The FCM v1 `messages:send` request body of a message, serialized once.
+
+	Sending the same message to many registration ids only differs in the token,
+	so instead of building and encoding one Message per token, the body is
+	encoded once around a placeholder and each token is spliced in when the
+	request is written. Only the asyncio client (`gcm_async`, and `send_message`
+	with FCM_USE_ASYNC) sends such bodies: `messaging.send_each` takes one
+	Message per token.
+	"""
+
+	_placeholder = "push-notifications-token-%s" % (uuid.uuid4().hex)
+
+	def __init__(self, message: messaging.Message, dry_run=False):
+		body = encode_message(_prepare_message(message, self._placeholder), dry_run)
+		placeholder = json.dumps(self._placeholder).encode("utf-8")
+		self.prefix, _, self.suffix = body.partition(placeholder)
+
+	@classmethod
+	def is_supported(cls):
+		return _message_encoder() is not None
+
+	def render(self, token: str) -> bytes:
+		return b"".join((self.prefix, json.dumps(token).encode("utf-8"), self.suffix))
 
 
 def send_message(
@@ -163,7 +222,8 @@ def send_message(
 
 	:return: A BatchResponse object
 	"""
-	max_recipients = get_manager().get_max_recipients(application_id)
+	max_recipients = min(get_manager().get_max_recipients(application_id), FCM_MAX_BATCH_SIZE)
+	max_workers = get_manager().get_max_workers(application_id)
 	app = get_manager().get_firebase_app(application_id) if application_id else None
 
 	# Checks for valid recipient
@@ -174,16 +234,40 @@ def send_message(
 	if not isinstance(registration_ids, list):
 		registration_ids = [registration_ids] if registration_ids else None
 
-	# FCM only allows up to 1000 reg ids per bulk message
-	# https://firebase.google.com/docs/cloud-messaging/server#http-request
+	if SETTINGS["FCM_USE_ASYNC"] and registration_ids and MessageTemplate.is_supported():
+		# serializes the message once for every registration id, see MessageTemplate
+		from . import gcm_async
+		from .http2 import run
+		response = run(gcm_async.send_message(
+			registration_ids, message, application_id=application_id, dry_run=dry_run,
+			deactivate=False
+		))
+		# from this thread, which may be reading the devices from the database
+		_deactivate_devices_with_error_results(registration_ids, response.responses)
+		return response
+
+	def send_chunk(chunk):
+		# send_each needs one Message per token, see FCM_USE_ASYNC to avoid them
+		messages = [
+			_prepare_message(message, token) for token in chunk
+		]
+		return messaging.send_each(messages, dry_run=dry_run, app=app).responses
+
+	# FCM only allows up to 500 messages per send_each call
+	# https://firebase.google.com/docs/cloud-messaging/send-message#send-a-batch-of-messages
 	if registration_ids:
 		ret: List[messaging.SendResponse] = []
-		for chunk in _chunks(registration_ids, max_recipients):
-			messages = [
-				_prepare_message(message, token) for token in chunk
-			]
-			responses = messaging.send_all(messages, dry_run=dry_run, app=app).responses
-			ret.extend(responses)
+		chunks = _chunks(registration_ids, max_recipients)
+		if max_workers > 1 and len(registration_ids) > max_recipients:
+			# map() keeps the order of the chunks, so the responses still line up
+			# with registration_ids. send_each starts a thread per message of its
+			# chunk on top of these, see FCM_MAX_WORKERS in the README.
+			with ThreadPoolExecutor(max_workers=max_workers) as executor:
+				for responses in executor.map(send_chunk, chunks):
+					ret.extend(responses)
+		else:
+			for chunk in chunks:
+				ret.extend(send_chunk(chunk))
 		_deactivate_devices_with_error_results(registration_ids, ret)
 		return messaging.BatchResponse(ret)
 	else:
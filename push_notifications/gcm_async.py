@@ -0,0 +1,255 @@
+"""
+Firebase Cloud Messaging over asyncio
+
+Sends messages to the FCM HTTP v1 API (`messages:send`) over a single
+multiplexed HTTP/2 connection per Firebase project, instead of one blocking
+request per message like `gcm.send_message` does.
+Documentation is available on the Firebase Developer website:
+https://firebase.google.com/docs/reference/fcm/rest/v1/projects.messages/send
+"""
+
+import asyncio
+import datetime
+
+import firebase_admin
+from asgiref.sync import sync_to_async
+from firebase_admin import exceptions, messaging
+
+from .conf import get_manager
+from .gcm import MessageTemplate, _deactivate_devices_with_error_results, encode_message
+from .http2 import HTTP2Error, HTTP2Transport, TransportRegistry
+from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+
+
+FCM_HOST = "fcm.googleapis.com"
+FCM_SEND_PATH = "/v1/projects/{}/messages:send"
+
+# Access tokens are refreshed this long before they expire.
+ACCESS_TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+_HTTP_STATUS_TO_EXCEPTION = {
+	400: exceptions.InvalidArgumentError,
+	401: exceptions.UnauthenticatedError,
+	403: exceptions.PermissionDeniedError,
+	404: exceptions.NotFoundError,
+	409: exceptions.ConflictError,
+	412: exceptions.FailedPreconditionError,
+	429: exceptions.ResourceExhaustedError,
+	500: exceptions.InternalError,
+	503: exceptions.UnavailableError,
+}
+
+# One transport per Firebase project, for each event loop.
+_transports = TransportRegistry()
+
+
+def _build_fcm_error(response):
+	"""
+	Builds the same exception firebase_admin raises for an FCM error response.
+	"""
+	try:
+		error = response.json().get("error", {})
+	except ValueError:
+		error = {}
+	msg = error.get("message") or "Unexpected HTTP response with status: {}; body: {}".format(
+		response.status, response.body.decode("utf-8", "replace")
+	)
+
+	fcm_code = None
+	for detail in error.get("details", []):
+		if detail.get("@type") == "type.googleapis.com/google.firebase.fcm.v1.FcmError":
+			fcm_code = detail.get("errorCode")
+			break
+
+	exc_type = messaging._MessagingService.FCM_ERROR_TYPES.get(fcm_code)
+	if exc_type is None:
+		exc_type = _HTTP_STATUS_TO_EXCEPTION.get(response.status, exceptions.UnknownError)
+	return exc_type(msg)
+
+
+def _expires_soon(expiry):
+	if expiry is None:
+		return False
+	if expiry.tzinfo is None:
+		now = datetime.datetime.utcnow()
+	else:
+		now = datetime.datetime.now(datetime.timezone.utc)
+	return expiry - now < ACCESS_TOKEN_REFRESH_MARGIN
+
+
+class FCMTransport(HTTP2Transport):
+	"""
+	Sends messages for one Firebase app over a single HTTP/2 connection.
+
+	The OAuth2 access token of the app's credential is fetched once and reused
+	for every request until shortly before it expires.
+
+	:param app: firebase_admin.App: The app to send messages for. Defaults to the
+	default app.
+	:param host: str: The FCM host, e.g. a local stub server in tests.
+	:param port: int: The FCM port.
+	:param secure: bool: Use TLS. Only disable it to talk to local stub servers.
+	:param max_concurrent_streams: int: The maximum number of requests in flight,
+	FCM_MAX_CONCURRENT_STREAMS by default.
+	"""
+
+	def __init__(
+		self, app=None, host=FCM_HOST, port=443, secure=True, max_concurrent_streams=None
+	):
+		super().__init__(
+			host, port, secure=secure,
+			max_concurrent_streams=max_concurrent_streams or SETTINGS["FCM_MAX_CONCURRENT_STREAMS"]
+		)
+		self.app = app or firebase_admin.get_app()
+		self.path = FCM_SEND_PATH.format(self.app.project_id)
+
+		self._access_token = None
+		self._access_token_expiry = None
+		self._access_token_lock = None
+
+	async def _get_access_token(self):
+		if self._access_token is not None and not _expires_soon(self._access_token_expiry):
+			return self._access_token
+
+		if self._access_token_lock is None:
+			self._access_token_lock = asyncio.Lock()
+		async with self._access_token_lock:
+			# another request may have refreshed it while we were waiting
+			if self._access_token is None or _expires_soon(self._access_token_expiry):
+				loop = asyncio.get_event_loop()
+				token = await loop.run_in_executor(None, self.app.credential.get_access_token)
+				self._access_token = token.access_token
+				self._access_token_expiry = token.expiry
+		return self._access_token
+
+	async def _post(self, body):
+		headers = [
+			("authorization", "Bearer %s" % (await self._get_access_token())),
+			("content-type", "application/json; charset=UTF-8"),
+			("x-goog-api-format-version", "2"),
+			("x-firebase-client", "fire-admin-python/%s" % (firebase_admin.__version__)),
+		]
+		return await self.request("POST", self.path, headers, body)
+
+	async def send_data(self, body):
+		"""
+		Posts an already encoded `messages:send` request body.
+
+		:return: messaging.SendResponse
+		"""
+		try:
+			response = await self._post(body)
+		except (HTTP2Error, OSError) as e:
+			return messaging.SendResponse(
+				None, exception=exceptions.UnavailableError(str(e), cause=e)
+			)
+
+		if response.status == 200:
+			return messaging.SendResponse(response.json(), exception=None)
+		if response.status == 401:
+			# fetch a new access token for the next request
+			self._access_token = None
+		return messaging.SendResponse(None, exception=_build_fcm_error(response))
+
+	async def send(self, message, dry_run=False):
+		"""
+		Sends a single messaging.Message.
+
+		:return: messaging.SendResponse
+		"""
+		return await self.send_data(encode_message(message, dry_run))
+
+	async def send_multicast(self, message, registration_ids, dry_run=False):
+		"""
+		Sends the message to every registration id. The message is serialized
+		once, see `gcm.MessageTemplate`.
+
+		:return: A BatchResponse object
+		"""
+		template = MessageTemplate(message, dry_run=dry_run)
+		responses = await asyncio.gather(
+			*[self.send_data(template.render(token)) for token in registration_ids]
+		)
+		return messaging.BatchResponse(list(responses))
+
+	async def send_each(self, messages, dry_run=False):
+		"""
+		Sends the messages concurrently, the asyncio counterpart of messaging.send_each.
+
+		:return: A BatchResponse object
+		"""
+		responses = await asyncio.gather(*[self.send(m, dry_run=dry_run) for m in messages])
+		return messaging.BatchResponse(list(responses))
+
+
+def get_transport(application_id=None):
+	"""
+	Returns the FCMTransport of the application's Firebase project for the
+	running event loop, creating it on first use.
+	"""
+	app = get_manager().get_firebase_app(application_id) if application_id else None
+	app = app or firebase_admin.get_app()
+
+	return _transports.get(app.project_id, lambda: FCMTransport(app))
+
+
+async def send_message(
+	registration_ids,
+	message: messaging.Message,
+	application_id=None,
+	dry_run=False,
+	transport=None,
+	deactivate=True,
+	**kwargs
+):
+	"""
+	Sends an FCM notification to one or more registration_ids, the asyncio
+	counterpart of `gcm.send_message`.
+
+	Up to `transport.max_concurrent_streams` requests are kept in flight on the
+	project's HTTP/2 connection at any time.
+
+	:param registration_ids: A list of registration ids or a single string
+	:param message: The Message object, use `dict_to_fcm_message` to convert dict to Message
+	:param application_id: The application id to use.
+	:param dry_run: If True, no message will be sent.
+	:param transport: The FCMTransport to use, defaults to `get_transport(application_id)`.
+	:param deactivate: If False, the devices with invalid registration ids are left
+	for the caller to deactivate.
+
+	:return: A BatchResponse object
+	"""
+	# Checks for valid recipient
+	if registration_ids is None and message.topic is None and message.condition is None:
+		return
+
+	# Bundles the registration_ids in an list if only one is sent
+	if not isinstance(registration_ids, list):
+		registration_ids = [registration_ids] if registration_ids else None
+
+	if not registration_ids:
+		return messaging.BatchResponse([])
+
+	transport = transport or get_transport(application_id)
+	template = MessageTemplate(message, dry_run=dry_run)
+	responses = [None] * len(registration_ids)
+	slots = asyncio.Semaphore(transport.max_concurrent_streams)
+	pending = set()
+
+	async def send(index, token):
+		try:
+			responses[index] = await transport.send_data(template.render(token))
+		finally:
+			slots.release()
+
+	for index, token in enumerate(registration_ids):
+		await slots.acquire()
+		task = asyncio.ensure_future(send(index, token))
+		pending.add(task)
+		task.add_done_callback(pending.discard)
+	if pending:
+		await asyncio.gather(*pending)
+
+	if deactivate:
+		await sync_to_async(_deactivate_devices_with_error_results)(registration_ids, responses)
+	return messaging.BatchResponse(responses)
@@ -0,0 +1,409 @@
+"""
+A small asyncio HTTP/2 client.
+
+FCM, APNs and most WebPush services accept a large number of concurrent
+requests over a single HTTP/2 connection. `HTTP2Connection` keeps one such
+connection open and multiplexes every request sent through it as a separate
+stream, so one event loop can keep thousands of notifications in flight without
+a thread or a TCP/TLS handshake per request.
+
+Only the parts of HTTP/2 needed to POST small payloads and read small responses
+are implemented. It relies on the `h2` package, which is also what the `apns2`
+client is built on.
+"""
+
+import asyncio
+import json
+import ssl
+import threading
+import weakref
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.exceptions
+
+from .exceptions import NotificationError
+
+
+class HTTP2Error(NotificationError):
+	pass
+
+
+class HTTP2ConnectionError(HTTP2Error):
+	"""
+	The connection was closed, or shut down (GOAWAY), before the request was
+	processed by the server. Requests failing with this error can be retried on
+	a new connection; requests in flight when the connection was lost fail with
+	HTTP2Error instead, since the server may have processed them.
+	"""
+	pass
+
+
+class HTTP2NotSupportedError(HTTP2Error):
+	"""
+	The server did not negotiate HTTP/2 (ALPN), it only speaks HTTP/1.1.
+	"""
+	pass
+
+
+class HTTP2Response:
+	def __init__(self, status, headers, body):
+		self.status = status
+		self.headers = headers
+		self.body = body
+
+	def json(self):
+		return json.loads(self.body.decode("utf-8"))
+
+
+class _Stream:
+	def __init__(self, future):
+		self.future = future
+		self.headers = {}
+		self.body = bytearray()
+
+
+class HTTP2Connection:
+	"""
+	A single HTTP/2 connection to `host`, opened on the first request.
+
+	:param host: str: The host to connect to.
+	:param port: int: The port to connect to.
+	:param ssl_context: ssl.SSLContext: The context used for TLS connections, e.g.
+	one holding a client certificate. Defaults to `ssl.create_default_context()`.
+	:param secure: bool: If False, speak HTTP/2 over plain TCP (prior knowledge).
+	Only useful to talk to local stub servers.
+	:param max_concurrent_streams: int: Upper bound on the number of requests in
+	flight on this connection. The limit announced by the server also applies.
+	"""
+
+	def __init__(
+		self, host, port=443, ssl_context=None, secure=True, max_concurrent_streams=100
+	):
+		self.host = host
+		self.port = port
+		self.ssl_context = ssl_context
+		self.secure = secure
+		self.max_concurrent_streams = max_concurrent_streams
+
+		self._conn = None
+		self._reader = None
+		self._writer = None
+		self._read_task = None
+		self._connecting = None
+		self._changed = None
+		self._streams = {}
+		self._closed = False
+		self._error = None
+
+	@property
+	def authority(self):
+		if self.port in (80, 443):
+			return self.host
+		return "{}:{}".format(self.host, self.port)
+
+	@property
+	def is_closed(self):
+		return self._closed
+
+	@property
+	def in_flight(self):
+		"""The number of requests currently waiting for a response."""
+		return len(self._streams)
+
+	async def connect(self):
+		if self._closed:
+			raise self._error or HTTP2ConnectionError("Connection is closed.")
+		if self._connecting is None:
+			self._connecting = asyncio.ensure_future(self._connect())
+		try:
+			await self._connecting
+		except Exception:
+			self._connecting = None
+			raise
+
+	async def _connect(self):
+		ssl_context = None
+		if self.secure:
+			ssl_context = self.ssl_context or ssl.create_default_context()
+			ssl_context.set_alpn_protocols(["h2"])
+
+		self._reader, self._writer = await asyncio.open_connection(
+			self.host, self.port, ssl=ssl_context
+		)
+		if self.secure:
+			ssl_object = self._writer.get_extra_info("ssl_object")
+			if ssl_object is not None and ssl_object.selected_alpn_protocol() != "h2":
+				self._writer.close()
+				raise HTTP2NotSupportedError("{} does not support HTTP/2.".format(self.host))
+		self._conn = h2.connection.H2Connection(
+			config=h2.config.H2Configuration(client_side=True, header_encoding="utf-8")
+		)
+		self._changed = asyncio.Condition()
+		self._conn.initiate_connection()
+		self._flush()
+		self._read_task = asyncio.ensure_future(self._read_loop())
+
+	async def request(self, method, path, headers=(), body=b""):
+		"""
+		Sends a request on a new stream and waits for its response.
+
+		:param method: str: e.g. "POST".
+		:param path: str: The request path, including the query string.
+		:param headers: iterable: (name, value) pairs; names must be lowercase.
+		:param body: bytes: The request body.
+		:return: HTTP2Response
+		"""
+		await self.connect()
+
+		async with self._changed:
+			await self._changed.wait_for(self._can_open_stream)
+			if self._closed:
+				raise self._error or HTTP2ConnectionError("Connection is closed.")
+
+			stream_id = self._conn.get_next_available_stream_id()
+			stream = _Stream(asyncio.get_event_loop().create_future())
+			self._streams[stream_id] = stream
+			request_headers = [
+				(":method", method),
+				(":scheme", "https" if self.secure else "http"),
+				(":authority", self.authority),
+				(":path", path),
+			]
+			request_headers.extend(headers)
+			self._conn.send_headers(stream_id, request_headers, end_stream=not body)
+			self._flush()
+
+		if body:
+			await self._send_body(stream_id, body)
+
+		return await stream.future
+
+	async def close(self):
+		if self._conn is not None and not self._closed:
+			try:
+				self._conn.close_connection()
+				self._flush()
+			except (OSError, h2.exceptions.ProtocolError):
+				pass
+		self._closed = True
+		if self._read_task is not None:
+			self._read_task.cancel()
+			await asyncio.gather(self._read_task, return_exceptions=True)
+		if self._writer is not None:
+			self._writer.close()
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *exc_info):
+		await self.close()
+
+	def _can_open_stream(self):
+		if self._closed:
+			return True
+		remote_limit = self._conn.remote_settings.max_concurrent_streams
+		return self._conn.open_outbound_streams < min(self.max_concurrent_streams, remote_limit)
+
+	async def _send_body(self, stream_id, body):
+		def writable():
+			if self._closed or stream_id not in self._streams:
+				return True
+			return self._send_window(stream_id) > 0
+
+		while body:
+			async with self._changed:
+				await self._changed.wait_for(writable)
+				if self._closed or stream_id not in self._streams:
+					# the stream's future carries the error
+					return
+				size = min(len(body), self._send_window(stream_id), self._conn.max_outbound_frame_size)
+				self._conn.send_data(stream_id, body[:size], end_stream=size == len(body))
+				body = body[size:]
+				self._flush()
+				await self._writer.drain()
+
+	def _send_window(self, stream_id):
+		try:
+			return self._conn.local_flow_control_window(stream_id)
+		except h2.exceptions.StreamClosedError:
+			return 0
+
+	def _flush(self):
+		data = self._conn.data_to_send()
+		if data:
+			self._writer.write(data)
+
+	async def _read_loop(self):
+		error = None
+		try:
+			while True:
+				data = await self._reader.read(65535)
+				if not data:
+					break
+				for event in self._conn.receive_data(data):
+					self._handle_event(event)
+				self._flush()
+				async with self._changed:
+					self._changed.notify_all()
+		except (OSError, h2.exceptions.ProtocolError) as e:
+			error = HTTP2ConnectionError(str(e))
+		finally:
+			self._terminate(error or HTTP2ConnectionError("Connection closed by the server."))
+			if self._changed is not None:
+				try:
+					async with self._changed:
+						self._changed.notify_all()
+				except asyncio.CancelledError:
+					pass
+
+	def _handle_event(self, event):
+		if isinstance(event, h2.events.ResponseReceived):
+			stream = self._streams.get(event.stream_id)
+			if stream is not None:
+				stream.headers = dict(event.headers)
+		elif isinstance(event, h2.events.DataReceived):
+			stream = self._streams.get(event.stream_id)
+			if stream is not None:
+				stream.body.extend(event.data)
+			try:
+				self._conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+			except h2.exceptions.StreamClosedError:
+				pass
+		elif isinstance(event, h2.events.StreamEnded):
+			stream = self._streams.pop(event.stream_id, None)
+			if stream is not None and not stream.future.done():
+				headers = stream.headers
+				stream.future.set_result(
+					HTTP2Response(int(headers.get(":status", 0)), headers, bytes(stream.body))
+				)
+		elif isinstance(event, h2.events.StreamReset):
+			stream = self._streams.pop(event.stream_id, None)
+			if stream is not None and not stream.future.done():
+				stream.future.set_exception(
+					HTTP2Error("Stream reset by the server (error code %s)." % event.error_code)
+				)
+		elif isinstance(event, h2.events.ConnectionTerminated):
+			# GOAWAY: streams above last_stream_id were never processed
+			self._closed = True
+			self._error = HTTP2ConnectionError(
+				"Connection shut down by the server (error code %s)." % event.error_code
+			)
+			last_stream_id = event.last_stream_id or 0
+			for stream_id in [s for s in self._streams if s > last_stream_id]:
+				stream = self._streams.pop(stream_id)
+				if not stream.future.done():
+					stream.future.set_exception(self._error)
+
+	def _terminate(self, error):
+		self._closed = True
+		self._error = self._error or error
+		# the server may have processed the streams still open, at or below the
+		# last_stream_id of a GOAWAY or when the connection dropped: retrying
+		# them could deliver the notification twice
+		stream_error = HTTP2Error("Connection lost before the response completed: %s" % error)
+		for stream in self._streams.values():
+			if not stream.future.done():
+				stream.future.set_exception(stream_error)
+		self._streams.clear()
+
+
+class HTTP2Transport:
+	"""
+	Base of the FCM, APNs and WebPush asyncio clients: sends the requests of
+	one server over an HTTP2Connection, opening a new connection once it is
+	closed.
+
+	Takes the arguments of HTTP2Connection.
+	"""
+
+	def __init__(
+		self, host, port=443, ssl_context=None, secure=True, max_concurrent_streams=100
+	):
+		self.host = host
+		self.port = port
+		self.ssl_context = ssl_context
+		self.secure = secure
+		self.max_concurrent_streams = max_concurrent_streams
+		self.connection = self._connect()
+
+	def _connect(self):
+		return HTTP2Connection(
+			self.host, self.port, ssl_context=self.ssl_context, secure=self.secure,
+			max_concurrent_streams=self.max_concurrent_streams
+		)
+
+	async def request(self, method, path, headers=(), body=b""):
+		"""
+		Sends a request like HTTP2Connection.request, retrying it once on a new
+		connection if the server didn't process it.
+
+		:return: HTTP2Response
+		"""
+		if self.connection.is_closed:
+			self.connection = self._connect()
+		try:
+			return await self.connection.request(method, path, headers, body)
+		except HTTP2ConnectionError:
+			# the request was not processed (GOAWAY, dropped connection), retry once
+			if self.connection.is_closed:
+				self.connection = self._connect()
+			return await self.connection.request(method, path, headers, body)
+
+	async def close(self):
+		await self.connection.close()
+
+
+class TransportRegistry:
+	"""
+	Transports per key, for each event loop: a connection can only be used
+	from the loop it was opened on.
+	"""
+
+	def __init__(self):
+		self._transports = weakref.WeakKeyDictionary()
+
+	def get(self, key, factory):
+		"""
+		Returns the transport of `key` for the running event loop, creating it
+		with `factory()` on first use.
+		"""
+		transports = self._transports.setdefault(asyncio.get_event_loop(), {})
+		transport = transports.get(key)
+		if transport is None:
+			transport = transports[key] = factory()
+		return transport
+
+	async def close(self):
+		"""
+		Closes the transports of the running event loop.
+		"""
+		transports = self._transports.pop(asyncio.get_event_loop(), {})
+		for transport in transports.values():
+			await transport.close()
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop():
+	global _loop
+	with _loop_lock:
+		if _loop is None:
+			_loop = asyncio.new_event_loop()
+			thread = threading.Thread(
+				target=_loop.run_forever, name="push-notifications-http2", daemon=True
+			)
+			thread.start()
+	return _loop
+
+
+def run(coroutine):
+	"""
+	Runs `coroutine` on the background event loop shared by every synchronous
+	caller of the asyncio clients, so that their connections stay open between
+	calls, and waits for its result.
+	"""
+	return asyncio.run_coroutine_threadsafe(coroutine, _get_loop()).result()
@@ -0,0 +1,137 @@
+"""
+A small pool of keep-alive HTTP/1.1 connections.
+
+`urlopen` opens a new TCP/TLS connection for every request. `HTTPConnectionPool`
+keeps the connections to each host open once a request completes and hands
+them to the next request to the same host, so services without HTTP/2 support,
+like WNS, only pay for the handshake once per connection.
+
+It is built on `http.client` and safe to use from several threads: a request
+takes an idle connection of its host or opens a new one, and gives it back
+once the response has been read.
+"""
+
+import collections
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+# Errors raised when the server closed an idle keep-alive connection.
+STALE_CONNECTION_ERRORS = (
+	http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError,
+)
+
+
+class HTTPResponse:
+	def __init__(self, status, reason, headers, body):
+		self.status = status
+		self.reason = reason
+		self.headers = headers
+		self.body = body
+
+	def json(self):
+		return json.loads(self.body.decode("utf-8"))
+
+
+class HTTPConnectionPool:
+	"""
+	Keeps up to `maxsize` idle connections open per host.
+
+	More requests than that can run at the same time, each on its own
+	connection; the ones that don't fit in the pool are closed once their
+	response has been read.
+
+	:param maxsize: int: The number of idle connections kept per host.
+	:param timeout: float: The socket timeout of connections, in seconds.
+	:param idle_timeout: float: Idle connections are closed after this many
+	seconds instead of being reused.
+	:param ssl_context: ssl.SSLContext: The context used for https connections.
+	"""
+
+	def __init__(self, maxsize=10, timeout=None, idle_timeout=None, ssl_context=None):
+		self.maxsize = maxsize
+		self.timeout = timeout
+		self.idle_timeout = idle_timeout
+		self.ssl_context = ssl_context
+		self._lock = threading.Lock()
+		# (scheme, host, port): deque of (connection, released_at)
+		self._idle = {}
+
+	def _new_connection(self, scheme, host, port):
+		if scheme == "https":
+			return http.client.HTTPSConnection(
+				host, port, timeout=self.timeout, context=self.ssl_context
+			)
+		return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+	def _get_connection(self, key):
+		with self._lock:
+			idle = self._idle.get(key)
+			while idle:
+				connection, released_at = idle.pop()
+				if self.idle_timeout and time.monotonic() - released_at > self.idle_timeout:
+					connection.close()
+					continue
+				return connection, True
+		return self._new_connection(*key), False
+
+	def _release(self, key, connection):
+		with self._lock:
+			idle = self._idle.setdefault(key, collections.deque())
+			if len(idle) < self.maxsize:
+				idle.append((connection, time.monotonic()))
+				return
+		connection.close()
+
+	def request(self, method, url, body=None, headers=None):
+		"""
+		Sends a request and reads its response.
+
+		:param url: str: An absolute http or https url.
+		:return: HTTPResponse
+		"""
+		parts = urlsplit(url)
+		if parts.scheme not in ("http", "https"):
+			raise ValueError("Unsupported url: %r" % (url))
+		key = (parts.scheme, parts.hostname, parts.port)
+		path = parts.path or "/"
+		if parts.query:
+			path += "?" + parts.query
+
+		connection, reused = self._get_connection(key)
+		try:
+			try:
+				connection.request(method, path, body=body, headers=headers or {})
+				response = connection.getresponse()
+			except STALE_CONNECTION_ERRORS:
+				if not reused:
+					raise
+				# The server closed the connection while it was idle, before
+				# reading the request: send it again on a new connection.
+				connection.close()
+				connection = self._new_connection(*key)
+				connection.request(method, path, body=body, headers=headers or {})
+				response = connection.getresponse()
+			data = response.read()
+		except BaseException:
+			connection.close()
+			raise
+
+		if response.will_close:
+			connection.close()
+		else:
+			self._release(key, connection)
+		return HTTPResponse(response.status, response.reason, response.headers, data)
+
+	def clear(self):
+		"""
+		Closes every idle connection.
+		"""
+		with self._lock:
+			idle, self._idle = self._idle, {}
+		for connections in idle.values():
+			for connection, _ in connections:
+				connection.close()
@@ -0,0 +1,63 @@
+import django
+from django.db import migrations, models
+
+
+class AddIndexConcurrently(migrations.AddIndex):
+    """
+    AddIndex, building the index with CREATE INDEX CONCURRENTLY on PostgreSQL
+    so that the device tables stay writable while it is built. Other databases,
+    and Django versions before 3.0 whose schema editors can't build indexes
+    concurrently, build it as AddIndex does.
+    """
+
+    def _concurrently(self, schema_editor):
+        return django.VERSION >= (3, 0) and schema_editor.connection.vendor == "postgresql"
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            if self._concurrently(schema_editor):
+                schema_editor.add_index(model, self.index, concurrently=True)
+            else:
+                schema_editor.add_index(model, self.index)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            if self._concurrently(schema_editor):
+                schema_editor.remove_index(model, self.index, concurrently=True)
+            else:
+                schema_editor.remove_index(model, self.index)
+
+
+class Migration(migrations.Migration):
+
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('push_notifications', '0010_alter_gcmdevice_options_and_more'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='gcmdevice',
+            index=models.Index(fields=['application_id', 'active', 'id'], name='push_gcm_app_active_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='gcmdevice',
+            index=models.Index(fields=['application_id', 'active', 'cloud_message_type', 'id'], name='push_gcm_app_active_type_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='apnsdevice',
+            index=models.Index(fields=['application_id', 'active', 'id'], name='push_apns_app_active_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='wnsdevice',
+            index=models.Index(fields=['application_id', 'active', 'id'], name='push_wns_app_active_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='webpushdevice',
+            index=models.Index(fields=['application_id', 'active'], name='push_webpush_app_active_idx'),
+        ),
+    ]
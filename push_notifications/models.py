@@ -1,6 +1,10 @@
+import itertools
+import operator
+
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 
+from .batching import pages
 from .fields import HexIntegerField
 from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
 
@@ -50,41 +54,49 @@ class Device(models.Model):
 		)
 
 
+def _registration_ids_by_application(queryset, chunk_size=None):
+	"""
+	Yields an `(application_id, registration_ids)` pair for each application of
+	`queryset`, from a single query ordered by application, streamed from the
+	database `chunk_size` rows at a time. `registration_ids` is an iterator
+	over the application's rows, to consume before reading the next pair.
+
+	The (application_id, active, id) indexes of the device models supply that
+	order for the active devices, so the database doesn't sort the audience.
+	"""
+	rows = queryset.order_by("application_id", "pk").values_list(
+		"application_id", "registration_id"
+	).iterator(chunk_size=chunk_size or SETTINGS["BULK_PAGE_SIZE"])
+	for app_id, app_rows in itertools.groupby(rows, key=operator.itemgetter(0)):
+		yield app_id, (registration_id for _, registration_id in app_rows)
+
+
 class GCMDeviceManager(models.Manager):
 	def get_queryset(self):
 		return GCMDeviceQuerySet(self.model)
 
 
 class GCMDeviceQuerySet(models.query.QuerySet):
-	def send_message(self, message, **kwargs):
-		if self.exists():
-			from .gcm import dict_to_fcm_message, messaging
-			from .gcm import send_message as fcm_send_message
-
-			if not isinstance(message, messaging.Message):
-				data = kwargs.pop("extra", {})
-				if message is not None:
-					data["message"] = message
-				# transform legacy data to new message object
-				message = dict_to_fcm_message(data, **kwargs)
-
-			app_ids = self.filter(active=True).order_by(
-				"application_id"
-			).values_list("application_id", flat=True).distinct()
-
-			responses = []
-			for app_id in app_ids:
-				reg_ids = list(
-					self.filter(
-						active=True, cloud_message_type="FCM", application_id=app_id).values_list(
-						"registration_id", flat=True
-					)
-				)
-				if reg_ids:
-					r = fcm_send_message(reg_ids, message, application_id=app_id, **kwargs)
-					responses.extend(r.responses)
+	def send_message(self, message, page_size=None, **kwargs):
+		from .gcm import dict_to_fcm_message, messaging
+		from .gcm import send_message as fcm_send_message
+
+		if not isinstance(message, messaging.Message):
+			data = kwargs.pop("extra", {})
+			if message is not None:
+				data["message"] = message
+			# transform legacy data to new message object
+			message = dict_to_fcm_message(data, **kwargs)
+
+		devices = self.filter(active=True, cloud_message_type="FCM")
+		responses = []
+		for app_id, reg_ids in _registration_ids_by_application(devices, page_size):
+			# each page is handed to FCM as soon as it is fetched
+			for page in pages(reg_ids, page_size or SETTINGS["BULK_PAGE_SIZE"]):
+				r = fcm_send_message(page, message, application_id=app_id, **kwargs)
+				responses.extend(r.responses)
 
-			return messaging.BatchResponse(responses)
+		return messaging.BatchResponse(responses)
 
 
 class GCMDevice(Device):
@@ -105,6 +117,15 @@ class GCMDevice(Device):
 
 	class Meta:
 		verbose_name = _("FCM device")
+		indexes = [
+			models.Index(
+				fields=["application_id", "active", "id"], name="push_gcm_app_active_idx"
+			),
+			models.Index(
+				fields=["application_id", "active", "cloud_message_type", "id"],
+				name="push_gcm_app_active_type_idx"
+			),
+		]
 
 	def send_message(self, message, **kwargs):
 		from .gcm import dict_to_fcm_message, messaging
@@ -133,26 +154,27 @@ class APNSDeviceManager(models.Manager):
 
 
 class APNSDeviceQuerySet(models.query.QuerySet):
-	def send_message(self, message, creds=None, **kwargs):
-		if self.exists():
-			from .apns import apns_send_bulk_message
-
-			app_ids = self.filter(active=True).order_by("application_id") \
-				.values_list("application_id", flat=True).distinct()
-			res = []
-			for app_id in app_ids:
-				reg_ids = list(self.filter(active=True, application_id=app_id).values_list(
-					"registration_id", flat=True)
-				)
-				r = apns_send_bulk_message(
-					registration_ids=reg_ids, alert=message, application_id=app_id,
-					creds=creds, **kwargs
-				)
-				if hasattr(r, "keys"):
-					res += [r]
-				elif hasattr(r, "__getitem__"):
-					res += r
-			return res
+	def send_message(self, message, creds=None, page_size=None, return_results=True, **kwargs):
+		"""
+		:param return_results: bool: If False, a collections.Counter of the
+		results of each application is returned instead of the result of every
+		device, see `apns.apns_send_bulk_message`.
+		"""
+		from .apns import apns_send_bulk_message
+
+		devices = self.filter(active=True)
+		res = []
+		# streamed from the database while apns_send_bulk_message consumes them
+		for app_id, reg_ids in _registration_ids_by_application(devices, page_size):
+			r = apns_send_bulk_message(
+				registration_ids=reg_ids, alert=message, application_id=app_id,
+				creds=creds, return_results=return_results, **kwargs
+			)
+			if hasattr(r, "keys"):
+				res += [r]
+			elif hasattr(r, "__getitem__"):
+				res += r
+		return res
 
 
 class APNSDevice(Device):
@@ -168,6 +190,11 @@ class APNSDevice(Device):
 
 	class Meta:
 		verbose_name = _("APNS device")
+		indexes = [
+			models.Index(
+				fields=["application_id", "active", "id"], name="push_apns_app_active_idx"
+			),
+		]
 
 	def send_message(self, message, creds=None, **kwargs):
 		from .apns import apns_send_message
@@ -186,22 +213,16 @@ class WNSDeviceManager(models.Manager):
 
 
 class WNSDeviceQuerySet(models.query.QuerySet):
-	def send_message(self, message, **kwargs):
+	def send_message(self, message, page_size=None, **kwargs):
 		from .wns import wns_send_bulk_message
 
-		app_ids = self.filter(active=True).order_by("application_id").values_list(
-			"application_id", flat=True
-		).distinct()
 		res = []
-		for app_id in app_ids:
-			reg_ids = self.filter(active=True, application_id=app_id).values_list(
-				"registration_id", flat=True
-			)
-			r = wns_send_bulk_message(uri_list=list(reg_ids), message=message, **kwargs)
-			if hasattr(r, "keys"):
-				res += [r]
-			elif hasattr(r, "__getitem__"):
-				res += r
+		devices = self.filter(active=True)
+		for app_id, reg_ids in _registration_ids_by_application(devices, page_size):
+			for page in pages(reg_ids, page_size or SETTINGS["BULK_PAGE_SIZE"]):
+				res += wns_send_bulk_message(
+					uri_list=page, message=message, application_id=app_id, **kwargs
+				)
 
 		return res
 
@@ -217,6 +238,11 @@ class WNSDevice(Device):
 
 	class Meta:
 		verbose_name = _("WNS device")
+		indexes = [
+			models.Index(
+				fields=["application_id", "active", "id"], name="push_wns_app_active_idx"
+			),
+		]
 
 	def send_message(self, message, **kwargs):
 		from .wns import wns_send_message
@@ -234,10 +260,17 @@ class WebPushDeviceManager(models.Manager):
 
 class WebPushDeviceQuerySet(models.query.QuerySet):
 	def send_message(self, message, **kwargs):
-		devices = self.filter(active=True).order_by("application_id").distinct()
+		from .webpush import webpush_send_bulk_message
+
+		# ordering by registration_id groups the devices by push service
+		devices = self.filter(active=True).order_by("application_id", "registration_id")
 		res = []
-		for device in devices:
-			res.append(device.send_message(message))
+		for app_id, app_devices in itertools.groupby(
+			devices.iterator(), key=lambda device: device.application_id
+		):
+			res += webpush_send_bulk_message(
+				app_devices, message, application_id=app_id, **kwargs
+			)
 
 		return res
 
@@ -259,6 +292,11 @@ class WebPushDevice(Device):
 
 	class Meta:
 		verbose_name = _("WebPush device")
+		indexes = [
+			models.Index(
+				fields=["application_id", "active"], name="push_webpush_app_active_idx"
+			),
+		]
 
 	@property
 	def device_id(self):
@@ -9,7 +9,10 @@ PUSH_NOTIFICATIONS_SETTINGS.setdefault(
 
 # FCM
 PUSH_NOTIFICATIONS_SETTINGS.setdefault("FIREBASE_APP", None)
-PUSH_NOTIFICATIONS_SETTINGS.setdefault("FCM_MAX_RECIPIENTS", 1000)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("FCM_MAX_RECIPIENTS", 500)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("FCM_MAX_WORKERS", 1)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("FCM_MAX_CONCURRENT_STREAMS", 100)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("FCM_USE_ASYNC", False)
 
 # APNS
 if settings.DEBUG:
@@ -18,6 +21,13 @@ else:
 	PUSH_NOTIFICATIONS_SETTINGS.setdefault("APNS_USE_SANDBOX", False)
 PUSH_NOTIFICATIONS_SETTINGS.setdefault("APNS_USE_ALTERNATIVE_PORT", False)
 PUSH_NOTIFICATIONS_SETTINGS.setdefault("APNS_TOPIC", None)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("APNS_TOKEN_LIFETIME", 2700)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("APNS_ENCRYPTION_ALGORITHM", "ES256")
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("APNS_CONNECTION_IDLE_TIMEOUT", 300)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("APNS_BATCH_SIZE", 1000)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("APNS_CONNECTIONS", 1)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("APNS_USE_ASYNC", False)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("APNS_MAX_CONCURRENT_STREAMS", 500)
 
 # WNS
 PUSH_NOTIFICATIONS_SETTINGS.setdefault("WNS_PACKAGE_SECURITY_ID", None)
@@ -25,6 +35,10 @@ PUSH_NOTIFICATIONS_SETTINGS.setdefault("WNS_SECRET_KEY", None)
 PUSH_NOTIFICATIONS_SETTINGS.setdefault(
 	"WNS_ACCESS_URL", "https://login.live.com/accesstoken.srf"
 )
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WNS_CONNECTION_POOL_SIZE", 10)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WNS_CONNECTION_IDLE_TIMEOUT", 60)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WNS_TIMEOUT", 30)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WNS_MAX_WORKERS", 1)
 
 # WP (WebPush)
 
@@ -41,6 +55,13 @@ PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_POST_URL", {
 PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_PRIVATE_KEY", None)
 PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_CLAIMS", None)
 PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_ERROR_TIMEOUT", None)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_MAX_WORKERS", 1)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_ENCRYPTION_PROCESSES", 0)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_CONNECTION_POOL_SIZE", 10)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_ORIGIN_MAX_CONCURRENCY", 50)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_ORIGIN_RATE", None)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_MAX_RETRIES", 3)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("WP_ASYNC_MAX_IN_FLIGHT", 100)
 
 # User model
 PUSH_NOTIFICATIONS_SETTINGS.setdefault("USER_MODEL", settings.AUTH_USER_MODEL)
@@ -48,5 +69,13 @@ PUSH_NOTIFICATIONS_SETTINGS.setdefault("USER_MODEL", settings.AUTH_USER_MODEL)
 # Unique registration ID for all devices
 PUSH_NOTIFICATIONS_SETTINGS.setdefault("UNIQUE_REG_ID", False)
 
+# Number of devices fetched per query when sending to a queryset
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("BULK_PAGE_SIZE", 10000)
+
+# Deactivation of devices with invalid registration ids
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("DEACTIVATION_BUFFER_SIZE", 0)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("DEACTIVATION_FLUSH_INTERVAL", 10)
+PUSH_NOTIFICATIONS_SETTINGS.setdefault("DEACTIVATION_BATCH_SIZE", 1000)
+
 # API endpoint settings
 PUSH_NOTIFICATIONS_SETTINGS.setdefault("UPDATE_ON_DUPLICATE_REG_ID", False)
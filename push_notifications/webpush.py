@@ -1,9 +1,62 @@
+import collections
+import email.utils
+import os
+import threading
+import time
 import warnings
+from concurrent.futures import (
+	FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+)
+from urllib.parse import urlsplit
 
-from pywebpush import WebPushException, webpush
+import requests
+from py_vapid import Vapid
+from pywebpush import WebPusher, WebPushException, webpush
+from requests.adapters import HTTPAdapter
 
+from . import models
 from .conf import get_manager
-from .exceptions import WebPushError
+from .deactivation import deactivation_sink
+from .exceptions import WebPushError, WebPushThrottledError
+from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from .webpush_encryption import encrypt
+
+
+# Lifetime of the VAPID tokens we sign, the same as pywebpush's default.
+VAPID_TOKEN_LIFETIME = 12 * 60 * 60
+
+# Signed VAPID headers are replaced this many seconds before they expire.
+VAPID_REFRESH_MARGIN = 5 * 60
+
+# Parsed VAPID keys, per (application_id, private key setting).
+_vapid_keys = {}
+
+# Signed VAPID headers, per (application_id, audience): (headers, expires_at).
+_vapid_headers = {}
+
+_vapid_lock = threading.Lock()
+
+# Pause used when a push service throttles us without a Retry-After header.
+DEFAULT_RETRY_AFTER = 5
+
+# Subscriptions of a push service asking to wait longer than this are not
+# retried by bulk sends.
+MAX_RETRY_AFTER = 60
+
+# Keep-alive sessions, per push service origin.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Concurrency and rate limits, per push service origin.
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+# How often bulk sends check for a free slot held by another bulk send.
+LIMITER_POLL_INTERVAL = 0.01
+
+# Worker processes encrypting the payloads of bulk sends, see WP_ENCRYPTION_PROCESSES.
+_encryption_pool = None
+_encryption_pool_lock = threading.Lock()
 
 
 def get_subscription_info(application_id, uri, browser, auth, p256dh):
@@ -26,30 +79,484 @@ def get_subscription_info(application_id, uri, browser, auth, p256dh):
 	}
 
 
-def webpush_send_message(device, message, **kwargs):
-	subscription_info = get_subscription_info(
-		device.application_id, device.registration_id,
-		device.browser, device.auth, device.p256dh)
+def _webpush_origin(endpoint):
+	url = urlsplit(endpoint)
+	return "{}://{}".format(url.scheme, url.netloc)
+
+
+def _webpush_session(origin):
+	"""
+	Returns the session sending to the push service at `origin`. It keeps up
+	to WP_CONNECTION_POOL_SIZE connections to it open between requests.
+	"""
+	session = _sessions.get(origin)
+	if session is None:
+		with _sessions_lock:
+			session = _sessions.get(origin)
+			if session is None:
+				session = requests.Session()
+				pool_size = SETTINGS["WP_CONNECTION_POOL_SIZE"]
+				session.mount(origin, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+				_sessions[origin] = session
+	return session
+
+
+class _OriginLimiter:
+	"""
+	Limits the requests sent to one push service: at most `concurrency` of them
+	in flight, `rate` per second with bursts of up to `rate` requests, and none
+	while it is paused after asking us to slow down. It never blocks: requests
+	that can't be sent yet are set aside by the caller.
+	"""
+
+	def __init__(self, concurrency=None, rate=None):
+		self._slots = threading.BoundedSemaphore(concurrency) if concurrency else None
+		self.rate = rate
+		self._tokens = max(rate or 0, 1)
+		self._updated = time.monotonic()
+		self._paused_until = 0
+		self._lock = threading.Lock()
+
+	def paused_for(self):
+		"""The number of seconds left before requests can be sent again."""
+		return max(self._paused_until - time.monotonic(), 0)
+
+	def pause(self, seconds):
+		with self._lock:
+			self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+	def _refill(self, now):
+		self._tokens = min(max(self.rate, 1), self._tokens + (now - self._updated) * self.rate)
+		self._updated = now
+
+	def ready_in(self):
+		"""
+		The number of seconds left before the end of any pause and the next token.
+		"""
+		with self._lock:
+			now = time.monotonic()
+			wait = max(self._paused_until - now, 0)
+			if self.rate:
+				self._refill(now)
+				wait = max(wait, (1 - self._tokens) / self.rate)
+			return wait
+
+	def acquire(self):
+		"""
+		Takes a free slot and a token, without waiting.
+
+		:return: bool: False if the push service is paused, or has no free
+		slot or token left.
+		"""
+		if self._slots is not None and not self._slots.acquire(blocking=False):
+			return False
+		with self._lock:
+			now = time.monotonic()
+			if self._paused_until <= now:
+				if not self.rate:
+					return True
+				self._refill(now)
+				if self._tokens >= 1:
+					self._tokens -= 1
+					return True
+		self.release()
+		return False
+
+	def release(self):
+		if self._slots is not None:
+			self._slots.release()
+
+
+def _webpush_limiter(origin):
+	limiter = _limiters.get(origin)
+	if limiter is None:
+		with _limiters_lock:
+			limiter = _limiters.get(origin)
+			if limiter is None:
+				limiter = _limiters[origin] = _OriginLimiter(
+					SETTINGS["WP_ORIGIN_MAX_CONCURRENCY"], SETTINGS["WP_ORIGIN_RATE"]
+				)
+	return limiter
+
+
+def _webpush_retry_after(response):
+	"""
+	Returns the number of seconds of the Retry-After header of `response`,
+	which can also be an HTTP date.
+	"""
+	value = response.headers.get("Retry-After") if response.headers is not None else None
+	if not value:
+		return DEFAULT_RETRY_AFTER
+	try:
+		return max(float(value), 0)
+	except ValueError:
+		pass
+	try:
+		retry_at = email.utils.parsedate_to_datetime(value)
+	except (TypeError, ValueError):
+		return DEFAULT_RETRY_AFTER
+	return max(retry_at.timestamp() - time.time(), 0)
+
+
+def _webpush_vapid_key(application_id, private_key):
+	key = (application_id, private_key)
+	vapid = _vapid_keys.get(key)
+	if vapid is None:
+		if os.path.isfile(private_key):
+			vapid = Vapid.from_file(private_key_file=private_key)
+		else:
+			vapid = Vapid.from_string(private_key=private_key)
+		_vapid_keys[key] = vapid
+	return vapid
+
+
+def _webpush_vapid_headers(application_id, endpoint):
+	"""
+	Returns the VAPID headers of a request to `endpoint`. The token only
+	depends on the origin of the push service, so it is signed once per
+	application and origin and reused until shortly before it expires.
+
+	:return: dict: The Authorization header, or None if the application has
+	no VAPID key or claims, leaving it to pywebpush to report.
+	"""
+	private_key = get_manager().get_wp_private_key(application_id)
+	claims = get_manager().get_wp_claims(application_id)
+	if not private_key or not claims:
+		return None
+
+	audience = claims.get("aud") or _webpush_origin(endpoint)
+	key = (application_id, audience)
+	now = time.time()
+	headers, expires_at = _vapid_headers.get(key, (None, 0))
+	if headers is not None and now < expires_at - VAPID_REFRESH_MARGIN:
+		return headers
+
+	with _vapid_lock:
+		headers, expires_at = _vapid_headers.get(key, (None, 0))
+		if headers is None or now >= expires_at - VAPID_REFRESH_MARGIN:
+			claims = dict(claims, aud=audience)
+			if not claims.get("exp") or claims["exp"] - VAPID_REFRESH_MARGIN <= now:
+				claims["exp"] = int(now) + VAPID_TOKEN_LIFETIME
+			vapid = _webpush_vapid_key(application_id, private_key)
+			headers = vapid.sign(claims)
+			expires_at = claims["exp"]
+			_vapid_headers[key] = (headers, expires_at)
+	return headers
+
+
+def _webpush_encryption_pool():
+	global _encryption_pool
+	processes = SETTINGS["WP_ENCRYPTION_PROCESSES"]
+	if not processes:
+		return None
+	with _encryption_pool_lock:
+		if _encryption_pool is None:
+			_encryption_pool = ProcessPoolExecutor(max_workers=processes)
+	return _encryption_pool
+
+
+class _EncryptedWebPusher(WebPusher):
+	"""
+	A WebPusher sending a payload that was already encrypted.
+	"""
+
+	def __init__(self, subscription_info, encoded, **kwargs):
+		super().__init__(subscription_info, **kwargs)
+		self.encoded = encoded
+
+	def encode(self, data, content_encoding="aes128gcm"):
+		return self.encoded
+
+
+def _webpush_encrypt(
+	encryption_pool, subscription_info, data, content_encoding="aes128gcm"
+):
+	"""
+	Submits the encryption of `data` to `encryption_pool`.
+
+	:return: concurrent.futures.Future: The encrypted payload, see
+	`webpush_encryption.encrypt`, or None if there is no data to encrypt.
+	"""
+	if not data:
+		return None
+	return encryption_pool.submit(encrypt, subscription_info, data, content_encoding)
+
+
+def _webpush_send_encrypted(
+	subscription_info, data, encoded, content_encoding="aes128gcm", headers=None,
+	ttl=0, timeout=None, requests_session=None, verbose=False, vapid_private_key=None,
+	vapid_claims=None
+):
+	"""
+	Sends `data` like `pywebpush.webpush`, with the payload encrypted by
+	`_webpush_encrypt`.
+
+	:param encoded: concurrent.futures.Future: The encrypted payload.
+	"""
+	if vapid_claims and not vapid_private_key:
+		raise WebPushException("VAPID dict missing 'private_key'")
+	encoded = encoded.result() if encoded is not None else {}
+	response = _EncryptedWebPusher(
+		dict(subscription_info, keys=dict(subscription_info["keys"])), encoded,
+		requests_session=requests_session, verbose=verbose
+	).send(
+		data, headers, ttl=ttl, content_encoding=content_encoding, timeout=timeout
+	)
+	if response.status_code > 202:
+		raise WebPushException("Push failed: {} {}\nResponse body:{}".format(
+			response.status_code, response.reason, response.text),
+			response=response)
+	return response
+
+
+def _webpush_send(
+	device, message, encryption_pool=None, subscription_info=None, encoded=None, **kwargs
+):
+	"""
+	Sends `message` to `device`, without touching the database. Raises
+	WebPushThrottledError if the push service answers 429 or 503.
+
+	:param encryption_pool: concurrent.futures.Executor: Encrypts the payload
+	there instead of in the calling thread.
+	:param subscription_info: dict: The subscription of `device`, if already known.
+	:param encoded: concurrent.futures.Future: The payload already submitted
+	to `encryption_pool` by `_webpush_encrypt`.
+
+	:return: tuple: (results, unsubscribed), `unsubscribed` being True when
+	the push service answered that the subscription is gone.
+	"""
+	if subscription_info is None:
+		subscription_info = get_subscription_info(
+			device.application_id, device.registration_id,
+			device.browser, device.auth, device.p256dh)
+	endpoint = subscription_info["endpoint"]
+	kwargs.setdefault("requests_session", _webpush_session(_webpush_origin(endpoint)))
+	kwargs.setdefault("timeout", get_manager().get_wp_error_timeout(device.application_id))
+	vapid_headers = _webpush_vapid_headers(device.application_id, endpoint)
+	if vapid_headers is not None:
+		kwargs["headers"] = dict(kwargs.get("headers") or {}, **vapid_headers)
+	else:
+		kwargs["vapid_private_key"] = get_manager().get_wp_private_key(device.application_id)
+		kwargs["vapid_claims"] = get_manager().get_wp_claims(device.application_id).copy()
 	try:
 		results = {"results": [{"original_registration_id": device.registration_id}]}
-		response = webpush(
-			subscription_info=subscription_info,
-			data=message,
-			vapid_private_key=get_manager().get_wp_private_key(device.application_id),
-			vapid_claims=get_manager().get_wp_claims(device.application_id).copy(),
-			**kwargs
-		)
+		if encryption_pool is None:
+			response = webpush(
+				subscription_info=subscription_info,
+				data=message,
+				**kwargs
+			)
+		else:
+			if encoded is None:
+				encoded = _webpush_encrypt(
+					encryption_pool, subscription_info, message,
+					kwargs.get("content_encoding", "aes128gcm")
+				)
+			response = _webpush_send_encrypted(subscription_info, message, encoded, **kwargs)
 		if response.ok:
 			results["success"] = 1
 		else:
 			results["failure"] = 1
 			results["results"][0]["error"] = response.content
-		return results
+		return results, False
 	except WebPushException as e:
 		if e.response is not None and e.response.status_code in [404, 410]:
 			results["failure"] = 1
 			results["results"][0]["error"] = e.message
-			device.active = False
-			device.save()
-			return results
+			return results, True
+		if e.response is not None and e.response.status_code in [429, 503]:
+			raise WebPushThrottledError(e.message, _webpush_retry_after(e.response))
 		raise WebPushError(e.message)
+
+
+def webpush_send_message(device, message, **kwargs):
+	results, unsubscribed = _webpush_send(device, message, **kwargs)
+	if unsubscribed:
+		device.active = False
+		# only this device, its endpoint may be registered by other applications
+		deactivation_sink.add(models.WebPushDevice, [device.pk], field="pk")
+	return results
+
+
+def _webpush_map(send, items, max_workers, limiter, max_pause=0):
+	"""
+	Yields `(index, item, send(item))` for each of `items` as their sends
+	complete, `index` being the position of the item in `items`. Up to
+	`max_workers` items are sent at a time, and items are only read from
+	`items` as workers free up, so that querysets can be streamed.
+
+	An item is only handed to a worker once `limiter(item)`, the
+	_OriginLimiter of its push service, has a free slot and a token: until
+	then it is set aside, without holding a worker, and the next items are
+	sent. The result of an item whose push service is paused for longer than
+	`max_pause` seconds is None, and it isn't sent.
+	"""
+	max_workers = max(max_workers, 1)
+	items = enumerate(items)
+	exhausted = False
+	deferred = collections.deque()
+	running = {}
+
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		while True:
+			skipped = collections.deque()
+			delay = None
+			while len(running) < max_workers:
+				if deferred:
+					index, item = deferred.popleft()
+				elif not exhausted and len(skipped) < max_workers:
+					try:
+						index, item = next(items)
+					except StopIteration:
+						exhausted = True
+						continue
+				else:
+					break
+				origin_limiter = limiter(item)
+				if origin_limiter.paused_for() > max_pause:
+					yield index, item, None
+				elif origin_limiter.acquire():
+					try:
+						future = executor.submit(send, item)
+					except BaseException:
+						origin_limiter.release()
+						raise
+					# the limiters outlive this generator, free the slot whatever
+					# becomes of the result
+					future.add_done_callback(lambda _, slot=origin_limiter: slot.release())
+					running[future] = (index, item)
+				else:
+					skipped.append((index, item))
+					# a missing slot is only freed by another send, poll for it
+					ready_in = origin_limiter.ready_in() or LIMITER_POLL_INTERVAL
+					delay = ready_in if delay is None else min(delay, ready_in)
+			skipped.extend(deferred)
+			deferred = skipped
+
+			if not running:
+				if not deferred:
+					return
+				time.sleep(delay)
+				continue
+			done, _ = wait(running, timeout=delay, return_when=FIRST_COMPLETED)
+			for future in done:
+				index, item = running.pop(future)
+				yield index, item, future.result()
+
+
+def webpush_send_bulk_message(devices, message, application_id=None, **kwargs):
+	"""
+	Sends `message` to each device of `devices`, up to MAX_WORKERS of them at
+	a time. A device the push service rejects doesn't stop the others: its
+	error is reported in its results, and unsubscribed devices are
+	deactivated. With WP_ENCRYPTION_PROCESSES set, the payloads are encrypted
+	in that many worker processes while the workers send them: the payloads
+	of the next devices are submitted ahead of their sends, so that the
+	workers don't wait for them.
+
+	Requests to a push service reuse the connections of its origin, so
+	ordering the devices by registration_id, which groups them by origin,
+	keeps those connections busy.
+
+	Each push service gets at most WP_ORIGIN_MAX_CONCURRENCY requests in
+	flight and WP_ORIGIN_RATE requests per second: the devices of a push
+	service at its limit wait without holding a worker, while the others are
+	sent to. When one answers 429 or 503, it is paused for its Retry-After
+	delay and its devices are set aside while the others are sent to. They
+	are retried afterwards, up to WP_MAX_RETRIES times.
+
+	:param devices: iterable of WebPushDevice: The devices of `application_id`.
+	:param message: str: The notification data to be sent.
+	:return: list: The results of each device, in order, see `webpush_send_message`.
+	"""
+	encryption_pool = _webpush_encryption_pool()
+	content_encoding = kwargs.get("content_encoding", "aes128gcm")
+
+	def failure(device, error):
+		return {
+			"results": [{"original_registration_id": device.registration_id, "error": error}],
+			"failure": 1,
+		}, False
+
+	def prepare(devices):
+		"""
+		Yields `(device, subscription_info, encoded)` for each device. The
+		payloads of up to twice WP_ENCRYPTION_PROCESSES devices are submitted
+		to the encryption pool before their devices are yielded.
+		"""
+		ahead = collections.deque()
+		for device in devices:
+			subscription_info = get_subscription_info(
+				device.application_id, device.registration_id,
+				device.browser, device.auth, device.p256dh)
+			encoded = None
+			if encryption_pool is not None:
+				encoded = _webpush_encrypt(
+					encryption_pool, subscription_info, message, content_encoding
+				)
+			ahead.append((device, subscription_info, encoded))
+			if len(ahead) > 2 * SETTINGS["WP_ENCRYPTION_PROCESSES"]:
+				yield ahead.popleft()
+		while ahead:
+			yield ahead.popleft()
+
+	def limiter(item):
+		return _webpush_limiter(_webpush_origin(item[1]["endpoint"]))
+
+	def send(item):
+		"""
+		Returns the results of the device of `item`, or the
+		WebPushThrottledError to retry it after.
+		"""
+		device, subscription_info, encoded = item
+		try:
+			return _webpush_send(
+				device, message, encryption_pool=encryption_pool,
+				subscription_info=subscription_info, encoded=encoded, **kwargs
+			)
+		except WebPushThrottledError as e:
+			limiter(item).pause(e.retry_after)
+			return e
+		except (WebPushError, requests.RequestException) as e:
+			return failure(device, str(e))
+
+	res = {}
+	unsubscribed = []
+	throttled = []
+
+	def collect(index, item, result, error=None):
+		if result is None:
+			# not sent, keep the error of the last attempt
+			result = error or WebPushThrottledError("Throttled by the push service", 0)
+		if isinstance(result, WebPushThrottledError):
+			throttled.append((index, item, result))
+			return
+		device = item[0]
+		results, gone = result
+		if gone:
+			device.active = False
+			unsubscribed.append(device.registration_id)
+		res[index] = results
+
+	max_workers = get_manager().get_wp_max_workers(application_id)
+	try:
+		for index, item, result in _webpush_map(
+			send, prepare(devices), max_workers, limiter
+		):
+			collect(index, item, result)
+
+		for _ in range(SETTINGS["WP_MAX_RETRIES"]):
+			if not throttled:
+				break
+			retry, throttled = throttled, []
+			for _, (index, item, error), result in _webpush_map(
+				lambda retried: send(retried[1]), retry, max_workers,
+				lambda retried: limiter(retried[1]), max_pause=MAX_RETRY_AFTER
+			):
+				collect(index, item, result, error)
+
+		for index, item, error in throttled:
+			res[index] = failure(item[0], str(error))[0]
+	finally:
+		deactivation_sink.add(models.WebPushDevice, unsubscribed)
+	return [res[index] for index in range(len(res))]
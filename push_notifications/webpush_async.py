@@ -0,0 +1,272 @@
+"""
+WebPush over asyncio
+
+Sends WebPush notifications from an event loop, encrypted with aes128gcm
+(RFC 8291). Requests to a push service share one multiplexed HTTP/2
+connection when the service supports it; otherwise they are sent with the
+keep-alive session of `webpush` on the loop's default executor.
+
+The VAPID headers, sessions and Retry-After handling are shared with
+`webpush`, and the results have the same shape as `webpush_send_message`.
+"""
+
+import asyncio
+import functools
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from pywebpush import WebPushException
+from requests.structures import CaseInsensitiveDict
+
+from . import models
+from .conf import get_manager
+from .deactivation import deactivation_sink
+from .exceptions import WebPushError
+from .http2 import HTTP2Error, HTTP2NotSupportedError, HTTP2Transport, TransportRegistry
+from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from .webpush import (
+	MAX_RETRY_AFTER, _webpush_encryption_pool, _webpush_origin, _webpush_retry_after,
+	_webpush_session, _webpush_vapid_headers, get_subscription_info
+)
+from .webpush_encryption import encrypt
+
+
+# One transport per push service origin, for each event loop.
+_transports = TransportRegistry()
+
+
+class WebPushResponse:
+	def __init__(self, status, headers, body):
+		self.status_code = status
+		self.headers = CaseInsensitiveDict(headers)
+		self.content = body
+
+	@property
+	def ok(self):
+		return self.status_code < 400
+
+	@property
+	def text(self):
+		return self.content.decode("utf-8", "replace")
+
+
+class WebPushTransport(HTTP2Transport):
+	"""
+	Sends requests to one push service.
+
+	:param origin: str: e.g. "https://fcm.googleapis.com".
+	:param host: str: Overrides the host of `origin`, e.g. a local stub server
+	in tests.
+	:param port: int: Overrides the port of `origin`.
+	:param secure: bool: Use TLS. Only disable it to talk to local stub servers.
+	:param max_concurrent_streams: int: The maximum number of requests in
+	flight, WP_ORIGIN_MAX_CONCURRENCY by default.
+	"""
+
+	def __init__(self, origin, host=None, port=None, secure=None, max_concurrent_streams=None):
+		url = urlsplit(origin)
+		super().__init__(
+			host or url.hostname,
+			port or url.port or (443 if url.scheme == "https" else 80),
+			secure=url.scheme == "https" if secure is None else secure,
+			max_concurrent_streams=(
+				max_concurrent_streams or SETTINGS["WP_ORIGIN_MAX_CONCURRENCY"] or 100
+			)
+		)
+		self.origin = origin
+		# None until the first connection tells whether the service speaks HTTP/2
+		self.http2 = None
+		self.paused_until = 0
+
+	async def _post_http2(self, path, headers, body):
+		h2_headers = [(name.lower(), value) for name, value in headers.items()]
+		response = await self.request("POST", path, h2_headers, body)
+		return WebPushResponse(response.status, response.headers, response.body)
+
+	async def _post_http1(self, path, headers, body, timeout):
+		session = _webpush_session(self.origin)
+		response = await asyncio.get_event_loop().run_in_executor(None, functools.partial(
+			session.post, self.origin + path, data=body, headers=headers, timeout=timeout
+		))
+		return WebPushResponse(response.status_code, response.headers, response.content)
+
+	async def post(self, path, headers, body, timeout=None):
+		"""
+		:param headers: dict: The request headers.
+		:return: WebPushResponse
+		"""
+		if self.http2 is not False:
+			try:
+				coroutine = self._post_http2(path, headers, body)
+				response = await asyncio.wait_for(coroutine, _total_timeout(timeout))
+				self.http2 = True
+				return response
+			except HTTP2NotSupportedError:
+				self.http2 = False
+		return await self._post_http1(path, headers, body, timeout)
+
+	def pause(self, seconds):
+		loop = asyncio.get_event_loop()
+		self.paused_until = max(self.paused_until, loop.time() + seconds)
+
+	async def wait(self):
+		loop = asyncio.get_event_loop()
+		while loop.time() < self.paused_until:
+			await asyncio.sleep(self.paused_until - loop.time())
+
+
+def _total_timeout(timeout):
+	# requests style timeouts can be a (connect, read) tuple
+	if isinstance(timeout, (tuple, list)):
+		return sum(t for t in timeout if t)
+	return timeout
+
+
+def get_transport(origin):
+	"""
+	Returns the WebPushTransport of `origin` for the running event loop,
+	creating it on first use.
+	"""
+	return _transports.get(origin, lambda: WebPushTransport(origin))
+
+
+async def close_transports():
+	"""
+	Closes the connections of the running event loop.
+	"""
+	await _transports.close()
+
+
+async def _encrypt(subscription_info, message):
+	if not message:
+		return b""
+	# keep the encryption off the event loop, in the encryption processes if
+	# any or the default executor otherwise
+	loop = asyncio.get_event_loop()
+	encoded = await loop.run_in_executor(
+		_webpush_encryption_pool(), encrypt, subscription_info, message
+	)
+	return encoded["body"]
+
+
+async def _send(device, message, ttl=0, headers=None, timeout=None, transport=None):
+	"""
+	Sends `message` to `device`, retrying it if the push service asks to
+	slow down.
+
+	:return: tuple: (results, unsubscribed), see `webpush._webpush_send`.
+	"""
+	subscription_info = get_subscription_info(
+		device.application_id, device.registration_id,
+		device.browser, device.auth, device.p256dh)
+	endpoint = subscription_info["endpoint"]
+	url = urlsplit(endpoint)
+	path = url.path + ("?" + url.query if url.query else "")
+	transport = transport or get_transport(_webpush_origin(endpoint))
+
+	request_headers = dict(headers or {})
+	request_headers.update(_webpush_vapid_headers(device.application_id, endpoint) or {})
+	request_headers["ttl"] = str(ttl or 0)
+	body = await _encrypt(subscription_info, message)
+	if body:
+		request_headers["content-encoding"] = "aes128gcm"
+	if timeout is None:
+		timeout = get_manager().get_wp_error_timeout(device.application_id)
+
+	results = {"results": [{"original_registration_id": device.registration_id}]}
+	for _ in range(SETTINGS["WP_MAX_RETRIES"] + 1):
+		await transport.wait()
+		try:
+			response = await transport.post(path, request_headers, body, timeout)
+		except (HTTP2Error, OSError, asyncio.TimeoutError) as e:
+			raise WebPushError("Push failed: {}".format(e) if str(e) else "Push failed")
+		if response.status_code in (429, 503):
+			retry_after = _webpush_retry_after(response)
+			transport.pause(retry_after)
+			if retry_after <= MAX_RETRY_AFTER:
+				continue
+		break
+
+	if response.status_code <= 202:
+		results["success"] = 1
+		return results, False
+	results["failure"] = 1
+	error = WebPushException("Push failed: {}\nResponse body:{}".format(
+		response.status_code, response.text), response=response)
+	results["results"][0]["error"] = error.message
+	if response.status_code in (404, 410):
+		return results, True
+	raise WebPushError(error.message)
+
+
+async def send_message(device, message, **kwargs):
+	"""
+	Sends `message` to `device`, the asyncio counterpart of
+	`webpush.webpush_send_message`.
+
+	:param ttl: int: The time to live of the notification, in seconds.
+	:param headers: dict: Additional request headers, e.g. Urgency or Topic.
+	:param timeout: float: Overrides WP_ERROR_TIMEOUT.
+	:param transport: WebPushTransport: Overrides the transport of the push
+	service of `device`.
+	"""
+	results, unsubscribed = await _send(device, message, **kwargs)
+	if unsubscribed:
+		device.active = False
+		# only this device, its endpoint may be registered by other applications
+		await sync_to_async(deactivation_sink.add)(models.WebPushDevice, [device.pk], field="pk")
+	return results
+
+
+async def send_bulk_message(devices, message, max_in_flight=None, **kwargs):
+	"""
+	Sends `message` to each device, keeping up to `max_in_flight` requests
+	(WP_ASYNC_MAX_IN_FLIGHT by default) in flight, the asyncio counterpart of
+	`webpush.webpush_send_bulk_message`. A device that fails, be it rejected
+	by the push service or lost with its connection, doesn't stop the others:
+	its error is reported in its results, and unsubscribed devices are
+	deactivated.
+
+	:param devices: iterable of WebPushDevice: Querysets can't be iterated
+	from an event loop, evaluate them first.
+	:return: list: The results of each device, in order.
+	"""
+	max_in_flight = max_in_flight or SETTINGS["WP_ASYNC_MAX_IN_FLIGHT"]
+	slots = asyncio.Semaphore(max_in_flight)
+	res = []
+	unsubscribed = []
+	pending = set()
+
+	async def send(index, device):
+		try:
+			results, gone = await _send(device, message, **kwargs)
+			if gone:
+				device.active = False
+				unsubscribed.append(device.registration_id)
+		except Exception as e:
+			# whatever goes wrong with one device doesn't stop the others
+			results = {
+				"results": [{
+					"original_registration_id": device.registration_id,
+					"error": str(e) or type(e).__name__,
+				}],
+				"failure": 1,
+			}
+		finally:
+			slots.release()
+		res[index] = results
+
+	try:
+		for device in devices:
+			await slots.acquire()
+			res.append(None)
+			task = asyncio.ensure_future(send(len(res) - 1, device))
+			pending.add(task)
+			task.add_done_callback(pending.discard)
+		if pending:
+			await asyncio.gather(*pending)
+	finally:
+		for task in pending:
+			task.cancel()
+		await sync_to_async(deactivation_sink.add)(models.WebPushDevice, unsubscribed)
+	return res
@@ -0,0 +1,22 @@
+"""
+WebPush payload encryption, run in worker processes.
+
+Kept apart from `push_notifications.webpush` so that worker processes can
+import it without setting up Django, whatever their start method.
+"""
+
+from pywebpush import WebPusher
+
+
+def encrypt(subscription_info, data, content_encoding="aes128gcm"):
+	"""
+	Encrypts `data` for the subscription, like `pywebpush.WebPusher.encode`.
+
+	:return: dict: The encrypted body, and the crypto_key and salt of the
+	legacy aesgcm encoding.
+	"""
+	if isinstance(data, str):
+		# pywebpush 2 only encrypts bytes
+		data = data.encode("utf-8")
+	encoded = WebPusher(subscription_info).encode(data, content_encoding)
+	return dict(encoded) if encoded else {}
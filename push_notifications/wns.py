@@ -5,14 +5,22 @@ Documentation is available on the Windows Dev Center:
 https://msdn.microsoft.com/en-us/windows/uwp/controls-and-patterns/tiles-and-notifications-windows-push-notification-services--wns--overview
 """
 
+import functools
+import io
 import json
+import threading
+import time
 import xml.etree.ElementTree as ET
 
 from django.core.exceptions import ImproperlyConfigured
 
-from .compat import HTTPError, Request, urlencode, urlopen
+from . import models
+from .batching import bounded_map
+from .compat import HTTPError, urlencode
 from .conf import get_manager
+from .deactivation import deactivation_sink
 from .exceptions import NotificationError
+from .http_pool import HTTPConnectionPool
 from .settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
 
 
@@ -25,10 +33,58 @@ class WNSAuthenticationError(WNSError):
 
 
 class WNSNotificationResponseError(WNSError):
-	pass
+	def __init__(self, msg, status=None):
+		super().__init__(msg)
+		self.status = status
 
 
-def _wns_authenticate(scope="notify.windows.com", application_id=None):
+# The number of distinct toasts and xml_data dictionaries whose XML is kept.
+WNS_XML_CACHE_SIZE = 128
+
+# WNS answers with these status codes for channel URIs that are gone for good.
+WNS_INVALID_CHANNEL_STATUSES = (404, 410)
+
+
+# Keep-alive connections to login.live.com and the notify.windows.com hosts.
+_wns_pool = None
+_wns_pool_lock = threading.Lock()
+
+# Access tokens are refreshed this many seconds before WNS expires them.
+WNS_TOKEN_REFRESH_MARGIN = 60
+
+# Cached access tokens, per (application_id, scope): (access_token, expires_at).
+_wns_access_tokens = {}
+_wns_access_tokens_lock = threading.Lock()
+
+
+def _wns_connection_pool():
+	global _wns_pool
+	with _wns_pool_lock:
+		if _wns_pool is None:
+			_wns_pool = HTTPConnectionPool(
+				maxsize=SETTINGS["WNS_CONNECTION_POOL_SIZE"],
+				timeout=SETTINGS["WNS_TIMEOUT"],
+				idle_timeout=SETTINGS["WNS_CONNECTION_IDLE_TIMEOUT"],
+			)
+	return _wns_pool
+
+
+def _wns_post(url, data, headers):
+	"""
+	POSTs `data` over a pooled keep-alive connection. Raises HTTPError for
+	error responses, like urlopen.
+
+	:return: http_pool.HTTPResponse
+	"""
+	response = _wns_connection_pool().request("POST", url, body=data, headers=headers)
+	if response.status >= 400:
+		raise HTTPError(
+			url, response.status, response.reason, response.headers, io.BytesIO(response.body)
+		)
+	return response
+
+
+def _wns_request_access_token(scope="notify.windows.com", application_id=None):
 	"""
 	Requests an Access token for WNS communication.
 
@@ -57,9 +113,8 @@ def _wns_authenticate(scope="notify.windows.com", application_id=None):
 	}
 	data = urlencode(params).encode("utf-8")
 
-	request = Request(SETTINGS["WNS_ACCESS_URL"], data=data, headers=headers)
 	try:
-		response = urlopen(request)
+		response = _wns_post(SETTINGS["WNS_ACCESS_URL"], data, headers)
 	except HTTPError as err:
 		if err.code == 400:
 			# One of your settings is probably jacked up.
@@ -67,7 +122,7 @@ def _wns_authenticate(scope="notify.windows.com", application_id=None):
 			raise WNSAuthenticationError("Authentication failed, check your WNS settings.")
 		raise err
 
-	oauth_data = response.read().decode("utf-8")
+	oauth_data = response.body.decode("utf-8")
 	try:
 		oauth_data = json.loads(oauth_data)
 	except Exception:
@@ -79,9 +134,81 @@ def _wns_authenticate(scope="notify.windows.com", application_id=None):
 		# Upstream WNS issue
 		raise WNSAuthenticationError("Access token missing from WNS response.")
 
+	return oauth_data
+
+
+def _wns_authenticate(scope="notify.windows.com", application_id=None):
+	"""
+	Returns an Access token for WNS communication, requesting a new one only
+	when there is none cached for the application and scope or it is about to
+	expire.
+
+	:return: str
+	"""
+	key = (application_id, scope)
+	access_token, expires_at = _wns_access_tokens.get(key, (None, 0))
+	if access_token is not None and time.monotonic() < expires_at:
+		return access_token
+
+	with _wns_access_tokens_lock:
+		# another thread may have refreshed it while we waited for the lock
+		access_token, expires_at = _wns_access_tokens.get(key, (None, 0))
+		if access_token is None or time.monotonic() >= expires_at:
+			requested_at = time.monotonic()
+			oauth_data = _wns_request_access_token(scope=scope, application_id=application_id)
+			access_token = oauth_data["access_token"]
+			try:
+				expires_in = int(oauth_data.get("expires_in") or 0)
+			except (TypeError, ValueError):
+				expires_in = 0
+			expires_at = requested_at + expires_in - WNS_TOKEN_REFRESH_MARGIN
+			_wns_access_tokens[key] = (access_token, expires_at)
 	return access_token
 
 
+def _wns_invalidate_access_token(
+	access_token, scope="notify.windows.com", application_id=None
+):
+	"""
+	Drops `access_token` from the cache, unless it was already replaced.
+	"""
+	key = (application_id, scope)
+	with _wns_access_tokens_lock:
+		if _wns_access_tokens.get(key, (None, 0))[0] == access_token:
+			del _wns_access_tokens[key]
+
+
+def _wns_response_error(err):
+	"""
+	Returns the WNSNotificationResponseError for an HTTPError of WNS, or the
+	HTTPError itself for unexpected status codes.
+	"""
+	# A lot of things can happen, let them know which one.
+	if err.code == 400:
+		msg = "One or more headers were specified incorrectly or conflict with another header."
+	elif err.code == 401:
+		msg = "The cloud service did not present a valid authentication ticket."
+	elif err.code == 403:
+		msg = "The cloud service is not authorized to send a notification to this URI."
+	elif err.code == 404:
+		msg = "The channel URI is not valid or is not recognized by WNS."
+	elif err.code == 405:
+		msg = "Invalid method. Only POST or DELETE is allowed."
+	elif err.code == 406:
+		msg = "The cloud service exceeded its throttle limit"
+	elif err.code == 410:
+		msg = "The channel expired."
+	elif err.code == 413:
+		msg = "The notification payload exceeds the 500 byte limit."
+	elif err.code == 500:
+		msg = "An internal failure caused notification delivery to fail."
+	elif err.code == 503:
+		msg = "The server is currently unavailable."
+	else:
+		return err
+	return WNSNotificationResponseError("HTTP %i: %s" % (err.code, msg), status=err.code)
+
+
 def _wns_send(uri, data, wns_type="wns/toast", application_id=None):
 	"""
 	Sends a notification data and authentication to WNS.
@@ -90,53 +217,31 @@ def _wns_send(uri, data, wns_type="wns/toast", application_id=None):
 	:param data: dict: The notification data to be sent.
 	:return:
 	"""
-	access_token = _wns_authenticate(application_id=application_id)
-
 	content_type = "text/xml"
 	if wns_type == "wns/raw":
 		content_type = "application/octet-stream"
 
-	headers = {
-		# content_type is "text/xml" (toast/badge/tile) | "application/octet-stream" (raw)
-		"Content-Type": content_type,
-		"Authorization": "Bearer %s" % (access_token),
-		"X-WNS-Type": wns_type,  # wns/toast | wns/badge | wns/tile | wns/raw
-	}
-
 	if type(data) is str:
 		data = data.encode("utf-8")
 
-	request = Request(uri, data, headers)
-
-	# A lot of things can happen, let them know which one.
-	try:
-		response = urlopen(request)
-	except HTTPError as err:
-		if err.code == 400:
-			msg = "One or more headers were specified incorrectly or conflict with another header."
-		elif err.code == 401:
-			msg = "The cloud service did not present a valid authentication ticket."
-		elif err.code == 403:
-			msg = "The cloud service is not authorized to send a notification to this URI."
-		elif err.code == 404:
-			msg = "The channel URI is not valid or is not recognized by WNS."
-		elif err.code == 405:
-			msg = "Invalid method. Only POST or DELETE is allowed."
-		elif err.code == 406:
-			msg = "The cloud service exceeded its throttle limit"
-		elif err.code == 410:
-			msg = "The channel expired."
-		elif err.code == 413:
-			msg = "The notification payload exceeds the 500 byte limit."
-		elif err.code == 500:
-			msg = "An internal failure caused notification delivery to fail."
-		elif err.code == 503:
-			msg = "The server is currently unavailable."
-		else:
-			raise err
-		raise WNSNotificationResponseError("HTTP %i: %s" % (err.code, msg))
+	for attempt in range(2):
+		access_token = _wns_authenticate(application_id=application_id)
+		headers = {
+			# content_type is "text/xml" (toast/badge/tile) | "application/octet-stream" (raw)
+			"Content-Type": content_type,
+			"Authorization": "Bearer %s" % (access_token),
+			"X-WNS-Type": wns_type,  # wns/toast | wns/badge | wns/tile | wns/raw
+		}
+		try:
+			response = _wns_post(uri, data, headers)
+		except HTTPError as err:
+			if err.code == 401 and not attempt:
+				# The cached token was revoked or expired early, retry with a new one.
+				_wns_invalidate_access_token(access_token, application_id=application_id)
+				continue
+			raise _wns_response_error(err)
 
-	return response.read().decode("utf-8")
+		return response.body.decode("utf-8")
 
 
 def _wns_prepare_toast(data, **kwargs):
@@ -169,6 +274,54 @@ def _wns_prepare_toast(data, **kwargs):
 	return ET.tostring(root)
 
 
+@functools.lru_cache(maxsize=WNS_XML_CACHE_SIZE)
+def _wns_compile_toast(message_json, template):
+	return _wns_prepare_toast(data=json.loads(message_json), template=template)
+
+
+@functools.lru_cache(maxsize=WNS_XML_CACHE_SIZE)
+def _wns_compile_xml(xml_data_json):
+	xml = dict_to_xml_schema(json.loads(xml_data_json))
+	return "wns/%s" % xml.tag, ET.tostring(xml)
+
+
+def _wns_prepare(message=None, xml_data=None, raw_data=None, **kwargs):
+	"""
+	Builds the notification data, see `wns_send_message`. The XML of toasts
+	and of `xml_data` dictionaries is cached, so that recurring notifications
+	are only built once.
+
+	:return: tuple: (wns_type, data)
+	"""
+	# Create a simple toast notification
+	if message:
+		if isinstance(message, str):
+			message = {
+				"text": [message, ],
+			}
+		try:
+			key = json.dumps(message)
+		except TypeError:
+			return "wns/toast", _wns_prepare_toast(data=message, **kwargs)
+		return "wns/toast", _wns_compile_toast(key, kwargs.get("template", "ToastText01"))
+	# Create a toast/tile/badge notification from a dictionary
+	elif xml_data:
+		try:
+			key = json.dumps(xml_data)
+		except TypeError:
+			xml = dict_to_xml_schema(xml_data)
+			return "wns/%s" % xml.tag, ET.tostring(xml)
+		return _wns_compile_xml(key)
+	# Create a raw notification
+	elif raw_data:
+		return "wns/raw", raw_data
+	else:
+		raise TypeError(
+			"At least one of the following parameters must be set:"
+			"`message`, `xml_data`, `raw_data`"
+		)
+
+
 def wns_send_message(
 	uri, message=None, xml_data=None, raw_data=None, application_id=None, **kwargs
 ):
@@ -206,29 +359,7 @@ def wns_send_message(
 	:param xml_data: dict: A dictionary containing data to be converted to an xml tree.
 	:param raw_data: str: Data to be sent via a `raw` notification.
 	"""
-	# Create a simple toast notification
-	if message:
-		wns_type = "wns/toast"
-		if isinstance(message, str):
-			message = {
-				"text": [message, ],
-			}
-		prepared_data = _wns_prepare_toast(data=message, **kwargs)
-	# Create a toast/tile/badge notification from a dictionary
-	elif xml_data:
-		xml = dict_to_xml_schema(xml_data)
-		wns_type = "wns/%s" % xml.tag
-		prepared_data = ET.tostring(xml)
-	# Create a raw notification
-	elif raw_data:
-		wns_type = "wns/raw"
-		prepared_data = raw_data
-	else:
-		raise TypeError(
-			"At least one of the following parameters must be set:"
-			"`message`, `xml_data`, `raw_data`"
-		)
-
+	wns_type, prepared_data = _wns_prepare(message, xml_data, raw_data, **kwargs)
 	return _wns_send(
 		uri=uri, data=prepared_data, wns_type=wns_type, application_id=application_id
 	)
@@ -238,22 +369,46 @@ def wns_send_bulk_message(
 	uri_list, message=None, xml_data=None, raw_data=None, application_id=None, **kwargs
 ):
 	"""
-	WNS doesn't support bulk notification, so we loop through each uri.
+	WNS doesn't support bulk notification, so we send a request per uri, up to
+	MAX_WORKERS of them at a time. A uri rejected by WNS doesn't stop the
+	others: its error is returned in its place, and the devices of invalid or
+	expired channels are deactivated.
 
 	:param uri_list: list: A list of uris the notification will be sent to.
 	:param message: str: The notification data to be sent.
 	:param xml_data: dict: A dictionary containing data to be converted to an xml tree.
 	:param raw_data: str: Data to be sent via a `raw` notification.
+	:return: list: The response of WNS to each uri, in order, or the error it
+	failed with: a WNSNotificationResponseError, or an OSError (e.g. a timeout
+	or an HTTPError of an unexpected status).
 	"""
-	res = []
-	if uri_list:
-		for uri in uri_list:
-			r = wns_send_message(
-				uri=uri, message=message, xml_data=xml_data,
-				raw_data=raw_data, application_id=application_id, **kwargs
-			)
-			res.append(r)
-	return res
+	if not uri_list:
+		return []
+
+	# the notification is the same for every uri, build it once
+	wns_type, data = _wns_prepare(message, xml_data, raw_data, **kwargs)
+	if isinstance(data, str):
+		data = data.encode("utf-8")
+
+	def send(uri):
+		try:
+			return _wns_send(uri=uri, data=data, wns_type=wns_type, application_id=application_id)
+		except (WNSNotificationResponseError, OSError) as e:
+			return e
+
+	uris = []
+	results = []
+	max_workers = get_manager().get_wns_max_workers(application_id)
+	try:
+		for uri, result in bounded_map(send, uri_list, max_workers):
+			uris.append(uri)
+			results.append(result)
+	finally:
+		deactivation_sink.add(models.WNSDevice, [
+			uri for uri, result in zip(uris, results)
+			if getattr(result, "status", None) in WNS_INVALID_CHANNEL_STATUSES
+		])
+	return results
 
 
 def dict_to_xml_schema(data):
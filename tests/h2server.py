@@ -0,0 +1,77 @@
+import asyncio
+import json
+
+import h2.config
+import h2.connection
+import h2.events
+
+
+class StubH2Server:
+	"""
+	A local HTTP/2 server (plain TCP, prior knowledge) for the asyncio transports.
+
+	`handler(headers, body)` is called for every request, may be a coroutine
+	function and returns a `(status, headers, body)` tuple.
+	"""
+
+	def __init__(self, handler):
+		self.handler = handler
+		self.requests = []
+		self.in_flight = 0
+		self.max_in_flight = 0
+		self.connections = 0
+
+	async def __aenter__(self):
+		self.server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+		self.port = self.server.sockets[0].getsockname()[1]
+		return self
+
+	async def __aexit__(self, *exc_info):
+		self.server.close()
+		await self.server.wait_closed()
+
+	async def _serve(self, reader, writer):
+		self.connections += 1
+		conn = h2.connection.H2Connection(
+			config=h2.config.H2Configuration(client_side=False, header_encoding="utf-8")
+		)
+		conn.initiate_connection()
+		writer.write(conn.data_to_send())
+		streams = {}
+		while True:
+			data = await reader.read(65535)
+			if not data:
+				break
+			for event in conn.receive_data(data):
+				if isinstance(event, h2.events.RequestReceived):
+					streams[event.stream_id] = (dict(event.headers), bytearray())
+				elif isinstance(event, h2.events.DataReceived):
+					streams[event.stream_id][1].extend(event.data)
+					conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+				elif isinstance(event, h2.events.StreamEnded):
+					headers, body = streams.pop(event.stream_id)
+					asyncio.ensure_future(
+						self._respond(conn, writer, event.stream_id, headers, bytes(body))
+					)
+			writer.write(conn.data_to_send())
+		writer.close()
+
+	async def _respond(self, conn, writer, stream_id, headers, body):
+		self.requests.append((headers, body))
+		self.in_flight += 1
+		self.max_in_flight = max(self.max_in_flight, self.in_flight)
+		result = self.handler(headers, body)
+		if asyncio.iscoroutine(result):
+			result = await result
+		self.in_flight -= 1
+
+		status, response_headers, response_body = result
+		if isinstance(response_body, (dict, list)):
+			response_body = json.dumps(response_body).encode("utf-8")
+		response_headers = [
+			(":status", str(status)), ("content-length", str(len(response_body)))
+		] + list(response_headers)
+		conn.send_headers(stream_id, response_headers, end_stream=not response_body)
+		if response_body:
+			conn.send_data(stream_id, response_body, end_stream=True)
+		writer.write(conn.data_to_send())
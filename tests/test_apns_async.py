@@ -0,0 +1,204 @@
+import asyncio
+import json
+from unittest import mock
+
+from apns2.credentials import CertificateCredentials
+from asgiref.sync import async_to_sync
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+
+from push_notifications import apns_async
+from push_notifications.apns import apns_send_bulk_message, apns_send_message
+from push_notifications.apns_async import APNSTransport, send_bulk_message, send_message
+from push_notifications.apns import BatchedProvider
+from push_notifications.exceptions import APNSServerError
+from push_notifications.http2 import HTTP2Error
+from push_notifications.models import APNSDevice
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+
+from .h2server import StubH2Server
+
+
+async def apns_handler(headers, body):
+	token = headers[":path"].rsplit("/", 1)[-1]
+	# keep a few requests in flight at the same time
+	await asyncio.sleep(0.01)
+	if token.startswith("unregistered"):
+		return 410, [], {"reason": "Unregistered", "timestamp": 1500000000000}
+	if token.startswith("bad"):
+		return 400, [], {"reason": "BadDeviceToken"}
+	if token.startswith("broken"):
+		# e.g. an error page of a proxy
+		return 502, [], b"Bad Gateway"
+	return 200, [("apns-id", "5A2E1B39-8C0F-4CE5-9D7A-0B3C9F4A6E21")], b""
+
+
+class APNSAsyncTestCase(TestCase):
+	def setUp(self):
+		self.auth = mock.Mock()
+		self.auth.get_authorization_header.return_value = "bearer provider-token"
+
+	def _transport(self, server):
+		return APNSTransport(
+			self.auth, host="127.0.0.1", port=server.port, secure=False, max_concurrent_streams=10
+		)
+
+	def _run(self, send, *args, **kwargs):
+		async def run():
+			async with StubH2Server(apns_handler) as server:
+				transport = self._transport(server)
+				try:
+					return await send(*args, transport=transport, **kwargs), server
+				finally:
+					await transport.close()
+		return async_to_sync(run)()
+
+	def test_send_bulk_message(self):
+		tokens = ["token%d" % i for i in range(50)]
+		with mock.patch.dict(SETTINGS, {"APNS_TOPIC": "com.example.app"}):
+			results, server = self._run(
+				send_bulk_message, tokens, "Hello world", badge=1, expiration=3, priority=5
+			)
+
+		self.assertEqual(list(results), tokens)
+		self.assertEqual(set(results.values()), {"Success"})
+		self.assertEqual(server.connections, 1)
+		self.assertGreater(server.max_in_flight, 1)
+		self.assertLessEqual(server.max_in_flight, 10)
+
+		headers, body = server.requests[0]
+		self.assertEqual(headers[":method"], "POST")
+		self.assertTrue(headers[":path"].startswith("/3/device/token"))
+		self.assertEqual(headers["authorization"], "bearer provider-token")
+		self.assertEqual(headers["apns-topic"], "com.example.app")
+		self.assertEqual(headers["apns-push-type"], "alert")
+		self.assertEqual(headers["apns-expiration"], "3")
+		self.assertEqual(headers["apns-priority"], "5")
+		self.assertEqual(json.loads(body), {"aps": {"alert": "Hello world", "badge": 1}})
+
+	def test_send_bulk_message_with_errors(self):
+		for token in ["abc", "unregistered", "bad"]:
+			APNSDevice.objects.create(registration_id=token)
+
+		results, server = self._run(
+			send_bulk_message, ["abc", "unregistered", "bad"], "Hello world"
+		)
+
+		self.assertEqual(results, {
+			"abc": "Success",
+			"unregistered": ("Unregistered", 1500000000000),
+			"bad": "BadDeviceToken",
+		})
+		self.assertTrue(APNSDevice.objects.get(registration_id="abc").active)
+		self.assertFalse(APNSDevice.objects.get(registration_id="unregistered").active)
+		self.assertTrue(APNSDevice.objects.get(registration_id="bad").active)
+
+	def test_send_bulk_message_keeps_going_after_failed_requests(self):
+		send = APNSTransport.send
+
+		async def reset_stream(transport, token, *args, **kwargs):
+			if token == "reset":
+				raise HTTP2Error("Stream reset by the server (error code 7).")
+			return await send(transport, token, *args, **kwargs)
+
+		with mock.patch.object(APNSTransport, "send", reset_stream):
+			with mock.patch.dict(SETTINGS, {"APNS_BATCH_SIZE": 2}):
+				results, server = self._run(
+					send_bulk_message, ["abc", "reset", "broken", "def"], "Hello world"
+				)
+
+		self.assertEqual(list(results), ["abc", "reset", "broken", "def"])
+		self.assertEqual(results["abc"], "Success")
+		self.assertIsInstance(results["reset"], HTTP2Error)
+		self.assertIsInstance(results["broken"], ValueError)
+		self.assertEqual(results["def"], "Success")
+
+	def test_send_bulk_message_with_batched_provider(self):
+		APNSDevice.objects.create(registration_id="abc", name="5")
+
+		def badges(tokens):
+			# runs a query, so must not be called from the event loop
+			devices = APNSDevice.objects.filter(registration_id__in=tokens)
+			return {device.registration_id: int(device.name) for device in devices}
+
+		results, server = self._run(
+			send_bulk_message, ["abc", "def"], "Hello world",
+			badge=BatchedProvider(badges, default=0)
+		)
+
+		self.assertEqual(results, {"abc": "Success", "def": "Success"})
+		bodies = {h[":path"].rsplit("/", 1)[-1]: json.loads(b) for h, b in server.requests}
+		self.assertEqual(bodies["abc"]["aps"]["badge"], 5)
+		self.assertEqual(bodies["def"]["aps"]["badge"], 0)
+
+	def test_get_transport_with_certificate(self):
+		async def get_transport(creds):
+			return apns_async.get_transport(creds=creds)
+
+		with mock.patch("push_notifications.apns_async._ssl_context") as ssl_context:
+			transport = async_to_sync(get_transport)("/path/to/certificate.pem")
+		ssl_context.assert_called_once_with("/path/to/certificate.pem")
+		self.assertIs(transport.ssl_context, ssl_context.return_value)
+		self.assertIsNone(transport.auth)
+
+		with mock.patch("apns2.credentials.init_context"):
+			creds = CertificateCredentials("/path/to/certificate.pem")
+		with self.assertRaises(ImproperlyConfigured):
+			async_to_sync(get_transport)(creds)
+
+	def test_send_message(self):
+		APNSDevice.objects.create(registration_id="unregistered")
+
+		result, server = self._run(send_message, "abc", "Hello world")
+		self.assertIsNone(result)
+
+		with self.assertRaises(APNSServerError) as ae:
+			self._run(send_message, "unregistered", "Hello world")
+		self.assertEqual(ae.exception.status, "Unregistered")
+		self.assertFalse(APNSDevice.objects.get(registration_id="unregistered").active)
+
+	def test_send_bulk_message_over_several_connections(self):
+		async def run():
+			async with StubH2Server(apns_handler) as server:
+				transports = [self._transport(server) for _ in range(2)]
+				try:
+					with mock.patch(
+						"push_notifications.apns_async.get_transport",
+						side_effect=lambda application_id, creds, index: transports[index]
+					):
+						results = await send_bulk_message(iter(tokens), "Hello world")
+				finally:
+					for transport in transports:
+						await transport.close()
+				return results, server
+
+		tokens = ["token%d" % i for i in range(9)]
+		with mock.patch.dict(SETTINGS, {"APNS_CONNECTIONS": 2, "APNS_BATCH_SIZE": 2}):
+			results, server = async_to_sync(run)()
+
+		self.assertEqual(list(results), tokens)
+		self.assertEqual(set(results.values()), {"Success"})
+		self.assertEqual(server.connections, 2)
+
+	def test_sync_functions_use_the_background_loop(self):
+		APNSDevice.objects.create(registration_id="unregistered")
+		server = apns_async.run(StubH2Server(apns_handler).__aenter__())
+		transport = self._transport(server)
+		try:
+			with mock.patch.dict(SETTINGS, {"APNS_USE_ASYNC": True}):
+				with mock.patch(
+					"push_notifications.apns_async.get_transport", return_value=transport
+				):
+					results = apns_send_bulk_message(["abc", "unregistered"], "Hello world")
+					apns_send_message("abc", "Hello world")
+					with self.assertRaises(APNSServerError):
+						apns_send_message("bad", "Hello world")
+		finally:
+			apns_async.run(transport.close())
+			apns_async.run(server.__aexit__(None, None, None))
+
+		self.assertEqual(results["abc"], "Success")
+		self.assertFalse(APNSDevice.objects.get(registration_id="unregistered").active)
+		# every send went through the same connection
+		self.assertEqual(server.connections, 1)
+		self.assertEqual(len(server.requests), 4)
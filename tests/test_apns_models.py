@@ -5,8 +5,10 @@ from apns2.errors import BadTopic, PayloadTooLarge, Unregistered
 from django.conf import settings
 from django.test import TestCase, override_settings
 
+from push_notifications.apns import apns_send_bulk_message
 from push_notifications.exceptions import APNSError
 from push_notifications.models import APNSDevice
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
 
 
 class APNSModelTestCase(TestCase):
@@ -111,3 +113,73 @@ class APNSModelTestCase(TestCase):
 					self.assertFalse(APNSDevice.objects.get(registration_id=token).active)
 				else:
 					self.assertTrue(APNSDevice.objects.get(registration_id=token).active)
+
+	def test_apns_send_bulk_message_in_windows(self):
+		devices = ["abc", "def", "ghi", "jkl", "mno"]
+		self._create_devices(devices)
+
+		def send(window, alert, **kwargs):
+			# Unregistered results carry the time the token became invalid
+			return {
+				token: ("Unregistered", 1) if token in ("def", "mno") else "Success"
+				for token in window
+			}
+
+		with mock.patch.dict(SETTINGS, {"APNS_BATCH_SIZE": 2}):
+			with mock.patch("push_notifications.apns._apns_send", side_effect=send) as s:
+				results = apns_send_bulk_message(iter(devices), "Hello world")
+
+		self.assertEqual(
+			[call[0][0] for call in s.call_args_list], [["abc", "def"], ["ghi", "jkl"], ["mno"]]
+		)
+		self.assertEqual(list(results), devices)
+		inactive = APNSDevice.objects.filter(active=False)
+		self.assertEqual(
+			sorted(inactive.values_list("registration_id", flat=True)), ["def", "mno"]
+		)
+
+	def test_apns_queryset_send_message_without_results(self):
+		self._create_devices(["abc", "def", "ghi"])
+
+		with mock.patch("push_notifications.apns._apns_send") as s:
+			s.side_effect = lambda window, alert, **kwargs: {
+				token: ("Unregistered", 1500000000000) if token == "def" else "Success"
+				for token in window
+			}
+			with mock.patch.dict(SETTINGS, {"APNS_BATCH_SIZE": 1}):
+				results = APNSDevice.objects.all().send_message(
+					"Hello world", return_results=False
+				)
+
+		self.assertEqual(results, [{"Success": 2, "Unregistered": 1}])
+		self.assertFalse(APNSDevice.objects.get(registration_id="def").active)
+
+	def test_apns_queryset_send_message_streams_pages(self):
+		devices = ["abc", "def", "ghi"]
+		self._create_devices(devices)
+
+		with mock.patch("push_notifications.apns._apns_send") as s:
+			s.side_effect = lambda window, alert, **kwargs: {token: "Success" for token in window}
+			# a single query, streamed one row at a time
+			with self.assertNumQueries(1):
+				results = APNSDevice.objects.all().send_message("Hello world", page_size=1)
+
+		self.assertEqual(results, [{"abc": "Success", "def": "Success", "ghi": "Success"}])
+
+	def test_apns_queryset_send_message_groups_by_application(self):
+		for token, app_id in [("abc", "app2"), ("def", "app1"), ("ghi", "app2"), ("jkl", "app0")]:
+			APNSDevice.objects.create(registration_id=token, application_id=app_id)
+
+		with mock.patch("push_notifications.apns.apns_send_bulk_message") as s:
+			s.side_effect = lambda registration_ids, application_id, **kwargs: {
+				token: application_id for token in registration_ids
+			}
+			with self.assertNumQueries(1):
+				results = APNSDevice.objects.all().send_message("Hello world")
+
+		self.assertEqual(
+			[call[1]["application_id"] for call in s.call_args_list], ["app0", "app1", "app2"]
+		)
+		self.assertEqual(
+			results, [{"jkl": "app0"}, {"def": "app1"}, {"abc": "app2", "ghi": "app2"}]
+		)
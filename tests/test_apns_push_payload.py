@@ -1,10 +1,22 @@
+import json
+import os
+import tempfile
 from unittest import mock
 
+import jwt
 from apns2.client import NotificationPriority
+from apns2.payload import Payload
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
 from django.test import TestCase
 
-from push_notifications.apns import _apns_send
+from push_notifications.apns import (
+	APNSPayloadEncoder, BatchedProvider, APNSTokenCredentials, _apns_get_credentials,
+	_apns_prepare, _apns_send, apns_client_pool, apns_send_bulk_message
+)
+from push_notifications.conf import AppConfig
 from push_notifications.exceptions import APNSUnsupportedPriority
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
 
 
 class APNSPushPayloadTest(TestCase):
@@ -102,3 +114,240 @@ class APNSPushPayloadTest(TestCase):
 				with mock.patch("apns2.client.APNsClient.send_notification") as s:
 					self.assertRaises(APNSUnsupportedPriority, _apns_send, "123", "_" * 2049, priority=24)
 				s.assert_has_calls([])
+
+
+class APNSClientPoolTest(TestCase):
+	def setUp(self):
+		apns_client_pool.clear()
+
+	def tearDown(self):
+		apns_client_pool.clear()
+
+	def test_connection_is_reused(self):
+		with mock.patch("apns2.credentials.init_context"):
+			with mock.patch("apns2.client.APNsClient.connect") as connect:
+				with mock.patch("apns2.client.APNsClient.send_notification") as s:
+					_apns_send("123", "Hello world")
+					_apns_send("456", "Hello world")
+
+		self.assertEqual(s.call_count, 2)
+		self.assertEqual(connect.call_count, 1)
+		self.assertEqual(len(apns_client_pool), 1)
+
+	def test_reconnects_after_connection_error(self):
+		with mock.patch("apns2.credentials.init_context"):
+			with mock.patch("apns2.client.APNsClient.connect") as connect:
+				with mock.patch(
+					"apns2.client.APNsClient.send_notification",
+					side_effect=[ConnectionResetError, None]
+				) as s:
+					_apns_send("123", "Hello world")
+
+		self.assertEqual(s.call_count, 2)
+		self.assertEqual(connect.call_count, 2)
+		self.assertEqual(len(apns_client_pool), 1)
+
+	def test_batch_is_not_retried(self):
+		with mock.patch("apns2.credentials.init_context"):
+			with mock.patch("apns2.client.APNsClient.connect"):
+				with mock.patch(
+					"apns2.client.APNsClient.send_notification_batch",
+					side_effect=ConnectionResetError
+				) as s:
+					with self.assertRaises(ConnectionResetError):
+						_apns_send(["123", "456"], "Hello world", batch=True)
+
+		self.assertEqual(s.call_count, 1)
+		self.assertEqual(len(apns_client_pool), 0)
+
+	def test_bulk_windows_spread_across_connections(self):
+		clients = []
+
+		def send_batch(client, notifications, topic, **kwargs):
+			clients.append(client)
+			return {n.token: "Success" for n in notifications}
+
+		tokens = ["token%d" % i for i in range(9)]
+		with mock.patch.dict(SETTINGS, {"APNS_CONNECTIONS": 3, "APNS_BATCH_SIZE": 2}):
+			with mock.patch("apns2.credentials.init_context"):
+				with mock.patch("apns2.client.APNsClient.connect"):
+					with mock.patch(
+						"apns2.client.APNsClient.send_notification_batch",
+						autospec=True, side_effect=send_batch
+					):
+						results = apns_send_bulk_message(iter(tokens), "Hello world")
+
+		self.assertEqual(list(results), tokens)
+		self.assertEqual(len(clients), 5)
+		self.assertEqual(len(set(clients)), 3)
+		# windows are assigned to the connections round-robin
+		self.assertEqual(clients[0], clients[3])
+		self.assertEqual(clients[1], clients[4])
+		self.assertEqual(len(apns_client_pool), 3)
+
+	def test_idle_connection_is_closed(self):
+		with mock.patch("apns2.credentials.init_context"):
+			with mock.patch("apns2.client.APNsClient.connect") as connect:
+				with mock.patch("apns2.client.APNsClient.send_notification"):
+					with mock.patch("push_notifications.apns.time.monotonic", return_value=1000):
+						_apns_send("123", "Hello world")
+					with mock.patch.dict(SETTINGS, {"APNS_CONNECTION_IDLE_TIMEOUT": 60}):
+						with mock.patch("push_notifications.apns.time.monotonic", return_value=1030):
+							_apns_send("123", "Hello world")
+						self.assertEqual(connect.call_count, 1)
+						with mock.patch("push_notifications.apns.time.monotonic", return_value=1100):
+							_apns_send("123", "Hello world")
+
+		self.assertEqual(connect.call_count, 2)
+		self.assertEqual(len(apns_client_pool), 1)
+
+
+class APNSTokenCredentialsTest(TestCase):
+	def setUp(self):
+		self.private_key = ec.generate_private_key(ec.SECP256R1())
+		fd, self.key_path = tempfile.mkstemp(suffix=".p8")
+		with os.fdopen(fd, "wb") as f:
+			f.write(self.private_key.private_bytes(
+				serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+				serialization.NoEncryption()
+			))
+
+	def tearDown(self):
+		os.remove(self.key_path)
+
+	def _decode(self, header):
+		token = header[len("bearer "):]
+		return jwt.get_unverified_header(token), jwt.decode(
+			token, self.private_key.public_key(), algorithms=["ES256"]
+		)
+
+	def test_token_is_reused_until_lifetime(self):
+		creds = APNSTokenCredentials(self.key_path, "KEYID", "TEAMID", token_lifetime=1200)
+
+		with mock.patch("push_notifications.apns.time.time", return_value=1000):
+			first = creds.get_authorization_header("com.example")
+		with mock.patch("push_notifications.apns.time.time", return_value=2000):
+			self.assertEqual(creds.get_authorization_header("com.example"), first)
+		# refreshed shortly before the lifetime runs out
+		with mock.patch("push_notifications.apns.time.time", return_value=2150):
+			second = creds.get_authorization_header("com.example")
+
+		self.assertNotEqual(first, second)
+		headers, claims = self._decode(first)
+		self.assertEqual(headers["kid"], "KEYID")
+		self.assertEqual(claims, {"iss": "TEAMID", "iat": 1000})
+		self.assertEqual(self._decode(second)[1]["iat"], 2150)
+
+	def test_applications_with_the_same_key_share_connections(self):
+		key = {"AUTH_KEY_PATH": self.key_path, "AUTH_KEY_ID": "KEYID", "TEAM_ID": "TEAMID"}
+		manager = AppConfig({"APPLICATIONS": {
+			"one": dict(key, PLATFORM="APNS", TOPIC="com.example.one"),
+			"two": dict(key, PLATFORM="APNS", TOPIC="com.example.two"),
+			"sandbox": dict(key, PLATFORM="APNS", TOPIC="com.example.one", USE_SANDBOX=True),
+		}})
+		apns_client_pool.clear()
+		try:
+			with mock.patch("push_notifications.apns.get_manager", return_value=manager):
+				with mock.patch("apns2.client.APNsClient.connect") as connect:
+					with mock.patch("apns2.client.APNsClient.send_notification") as s:
+						for application_id in ["one", "two", "sandbox"]:
+							_apns_send("123", "Hello world", application_id=application_id)
+
+			# one connection per environment
+			self.assertEqual(connect.call_count, 2)
+			self.assertEqual(len(apns_client_pool), 2)
+			self.assertEqual(
+				[call[0][2] for call in s.call_args_list],
+				["com.example.one", "com.example.two", "com.example.one"]
+			)
+		finally:
+			apns_client_pool.clear()
+
+	def test_credentials_are_cached_per_application(self):
+		settings = {
+			"APPLICATIONS": {
+				"ios": {
+					"PLATFORM": "APNS",
+					"AUTH_KEY_PATH": self.key_path,
+					"AUTH_KEY_ID": "KEYID",
+					"TEAM_ID": "TEAMID",
+					"TOKEN_LIFETIME": 1200,
+				},
+			},
+		}
+		with mock.patch("push_notifications.apns.get_manager", return_value=AppConfig(settings)):
+			with mock.patch("builtins.open", wraps=open) as open_:
+				creds = _apns_get_credentials("ios")
+				self.assertIs(_apns_get_credentials("ios"), creds)
+
+		self.assertEqual(open_.call_count, 1)
+		self.assertIsInstance(creds, APNSTokenCredentials)
+		self.assertEqual(creds.token_lifetime, 1200)
+		self.assertEqual(creds.encryption_algorithm, "ES256")
+
+
+class APNSBulkPayloadTest(TestCase):
+	def test_payload_is_built_once(self):
+		with mock.patch("apns2.credentials.init_context"):
+			with mock.patch("apns2.client.APNsClient.connect"):
+				with mock.patch("apns2.client.APNsClient.send_notification_batch") as s:
+					_apns_send(["abc", "def", "ghi"], "Hello world", batch=True, badge=1)
+
+		notifications = s.call_args[0][0]
+		self.assertEqual([n.token for n in notifications], ["abc", "def", "ghi"])
+		self.assertIs(notifications[0].payload, notifications[1].payload)
+		self.assertIs(notifications[0].payload, notifications[2].payload)
+
+	def _send_batch(self, tokens, **kwargs):
+		with mock.patch("apns2.credentials.init_context"):
+			with mock.patch("apns2.client.APNsClient.connect"):
+				with mock.patch("apns2.client.APNsClient.send_notification_batch") as s:
+					_apns_send(tokens, "Hello world", batch=True, **kwargs)
+		return s.call_args[0][0]
+
+	def test_callable_badge_groups_tokens_by_badge(self):
+		badge = mock.Mock(side_effect=len)
+		notifications = self._send_batch(["abc", "defg", "hij"], badge=badge)
+
+		self.assertEqual(badge.call_count, 3)
+		self.assertEqual([n.payload.badge for n in notifications], [3, 4, 3])
+		self.assertIsNot(notifications[0].payload, notifications[1].payload)
+		self.assertIs(notifications[0].payload, notifications[2].payload)
+
+	def test_batched_providers(self):
+		badges = mock.Mock(return_value={"abc": 1, "def": 2})
+		extras = mock.Mock(return_value={"abc": {"foo": "bar"}, "ghi": {"foo": "bar"}})
+		notifications = self._send_batch(
+			["abc", "def", "ghi"],
+			badge=BatchedProvider(badges, default=1), extra=BatchedProvider(extras, default={}),
+		)
+
+		badges.assert_called_once_with(["abc", "def", "ghi"])
+		extras.assert_called_once_with(["abc", "def", "ghi"])
+		self.assertEqual([n.payload.badge for n in notifications], [1, 2, 1])
+		self.assertEqual(
+			[n.payload.custom for n in notifications], [{"foo": "bar"}, {}, {"foo": "bar"}]
+		)
+		self.assertIs(notifications[0].payload, notifications[2].payload)
+		self.assertIsNot(notifications[0].payload, notifications[1].payload)
+
+	def test_batched_provider_single_send(self):
+		with mock.patch("apns2.credentials.init_context"):
+			with mock.patch("apns2.client.APNsClient.connect"):
+				with mock.patch("apns2.client.APNsClient.send_notification") as s:
+					_apns_send("abc", "Hello world", badge=BatchedProvider(lambda tokens: {"abc": 5}))
+
+		self.assertEqual(s.call_args[0][1].badge, 5)
+
+	def test_payload_is_serialized_once(self):
+		payload = _apns_prepare(None, "Hello wörld", badge=1, extra={"foo": "bar"})
+		plain = Payload(alert="Hello wörld", badge=1, custom={"foo": "bar"})
+
+		for _ in range(2):
+			serialized = json.dumps(
+				payload.dict(), cls=APNSPayloadEncoder, ensure_ascii=False, separators=(",", ":")
+			)
+			self.assertIs(serialized, payload.dict().serialized)
+		self.assertEqual(
+			serialized, json.dumps(plain.dict(), ensure_ascii=False, separators=(",", ":"))
+		)
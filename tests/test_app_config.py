@@ -95,7 +95,8 @@ class AppConfigTestCase(TestCase):
 					"PLATFORM": "APNS",
 					"CERTIFICATE": path,
 					"USE_ALTERNATIVE_PORT": True,
-					"USE_SANDBOX": True
+					"USE_SANDBOX": True,
+					"CONNECTIONS": 4,
 				}
 			}
 		}
@@ -154,6 +155,11 @@ class AppConfigTestCase(TestCase):
 
 		assert app_config["USE_SANDBOX"] is False
 		assert app_config["USE_ALTERNATIVE_PORT"] is False
+		assert app_config["CONNECTIONS"] == 1
+		assert app_config["TOKEN_LIFETIME"] == 2700
+		assert app_config["ENCRYPTION_ALGORITHM"] == "ES256"
+		assert manager.get_apns_token_lifetime("my_apns_app") == 2700
+		assert manager.get_apns_encryption_algorithm("my_apns_app") == "ES256"
 
 	def test_get_allowed_settings_fcm(self):
 		"""Verify the settings allowed for FCM platform."""
@@ -166,6 +172,7 @@ class AppConfigTestCase(TestCase):
 				"my_fcm_app": {
 					"PLATFORM": "FCM",
 					"MAX_RECIPIENTS": "...",
+					"MAX_WORKERS": "...",
 					"FIREBASE_APP": "...",
 				}
 			}
@@ -197,7 +204,8 @@ class AppConfigTestCase(TestCase):
 		manager = AppConfig(PUSH_SETTINGS)
 		app_config = manager._settings["APPLICATIONS"]["my_fcm_app"]
 
-		assert app_config["MAX_RECIPIENTS"] == 1000
+		assert app_config["MAX_RECIPIENTS"] == 500
+		assert app_config["MAX_WORKERS"] == 1
 		assert app_config["FIREBASE_APP"] is None
 
 	def test_get_allowed_settings_wns(self):
@@ -213,6 +221,7 @@ class AppConfigTestCase(TestCase):
 					"PACKAGE_SECURITY_ID": "...",
 					"SECRET_KEY": "...",
 					"WNS_ACCESS_URL": "...",
+					"MAX_WORKERS": 4,
 				}
 			}
 		}
@@ -245,3 +254,4 @@ class AppConfigTestCase(TestCase):
 		app_config = manager._settings["APPLICATIONS"]["my_wns_app"]
 
 		assert app_config["WNS_ACCESS_URL"] == "https://login.live.com/accesstoken.srf"
+		assert app_config["MAX_WORKERS"] == 1
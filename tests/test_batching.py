@@ -0,0 +1,47 @@
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from push_notifications.batching import bounded_map, pages
+
+
+class BatchingTestCase(SimpleTestCase):
+	def test_pages(self):
+		self.assertEqual(list(pages(iter(range(5)), 2)), [[0, 1], [2, 3], [4]])
+		self.assertEqual(list(pages([], 2)), [])
+
+	def test_bounded_map_keeps_the_order(self):
+		in_flight = []
+		max_in_flight = []
+		lock = threading.Lock()
+
+		def square(i):
+			with lock:
+				in_flight.append(i)
+				max_in_flight.append(len(in_flight))
+			# the first items finish last
+			time.sleep(0.01 * (10 - i))
+			with lock:
+				in_flight.remove(i)
+			return i * i
+
+		self.assertEqual(
+			list(bounded_map(square, range(10), 3)), [(i, i * i) for i in range(10)]
+		)
+		self.assertGreater(max(max_in_flight), 1)
+		self.assertLessEqual(max(max_in_flight), 3)
+
+	def test_bounded_map_reads_items_as_workers_free_up(self):
+		read = []
+
+		def items():
+			for i in range(10):
+				read.append(i)
+				yield i
+
+		results = bounded_map(lambda i: i, items(), 2)
+		next(results)
+		self.assertLessEqual(len(read), 3)
+		list(results)
+		self.assertEqual(len(read), 10)
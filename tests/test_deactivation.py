@@ -0,0 +1,122 @@
+from unittest import mock
+
+from django.db import DatabaseError, connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from push_notifications.deactivation import DeactivationSink, deactivate_devices
+from push_notifications.models import APNSDevice, GCMDevice
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+
+
+class DeactivationTestCase(TestCase):
+	def setUp(self):
+		for registration_id in ["abc", "def", "ghi", "jkl", "mno"]:
+			GCMDevice.objects.create(registration_id=registration_id, cloud_message_type="FCM")
+			APNSDevice.objects.create(registration_id=registration_id)
+
+	def _active(self, model):
+		active = model.objects.filter(active=True)
+		return sorted(active.values_list("registration_id", flat=True))
+
+	def test_deactivate_devices_in_batches(self):
+		with CaptureQueriesContext(connection) as queries:
+			deactivate_devices(GCMDevice, ["abc", "def", "ghi", "xyz"], batch_size=2)
+
+		updates = [q for q in queries.captured_queries if q["sql"].startswith("UPDATE")]
+		self.assertEqual(len(updates), 2)
+		self.assertEqual(self._active(GCMDevice), ["jkl", "mno"])
+		self.assertEqual(len(self._active(APNSDevice)), 5)
+
+	def test_sink_writes_immediately_by_default(self):
+		sink = DeactivationSink()
+		sink.add(GCMDevice, ["abc"])
+
+		self.assertEqual(sink.pending, 0)
+		self.assertEqual(self._active(GCMDevice), ["def", "ghi", "jkl", "mno"])
+
+	@mock.patch.dict(
+		SETTINGS, {"DEACTIVATION_BUFFER_SIZE": 4, "DEACTIVATION_FLUSH_INTERVAL": 0}
+	)
+	def test_sink_buffers_until_buffer_size(self):
+		sink = DeactivationSink()
+		sink.add(GCMDevice, ["abc", "def"])
+		sink.add(APNSDevice, ["abc"])
+		# duplicates are only counted once
+		sink.add(GCMDevice, ["abc"])
+
+		self.assertEqual(sink.pending, 3)
+		self.assertEqual(len(self._active(GCMDevice)), 5)
+		self.assertEqual(len(self._active(APNSDevice)), 5)
+
+		sink.add(APNSDevice, ["ghi"])
+
+		self.assertEqual(sink.pending, 0)
+		self.assertEqual(self._active(GCMDevice), ["ghi", "jkl", "mno"])
+		self.assertEqual(self._active(APNSDevice), ["def", "jkl", "mno"])
+
+	@mock.patch.dict(
+		SETTINGS, {"DEACTIVATION_BUFFER_SIZE": 100, "DEACTIVATION_FLUSH_INTERVAL": 0}
+	)
+	def test_sink_flush(self):
+		sink = DeactivationSink()
+		sink.add(GCMDevice, ["abc", "def"])
+		self.assertEqual(len(self._active(GCMDevice)), 5)
+
+		sink.flush()
+
+		self.assertEqual(sink.pending, 0)
+		self.assertEqual(self._active(GCMDevice), ["ghi", "jkl", "mno"])
+
+	@mock.patch.dict(
+		SETTINGS, {"DEACTIVATION_BUFFER_SIZE": 100, "DEACTIVATION_FLUSH_INTERVAL": 60}
+	)
+	def test_sink_flushes_after_interval(self):
+		sink = DeactivationSink()
+		with mock.patch("push_notifications.deactivation.time.monotonic", return_value=1000):
+			with mock.patch("threading.Timer"):
+				sink.add(GCMDevice, ["abc"])
+		self.assertEqual(sink.pending, 1)
+
+		with mock.patch("push_notifications.deactivation.time.monotonic", return_value=1060):
+			sink.add(GCMDevice, ["def"])
+
+		self.assertEqual(sink.pending, 0)
+		self.assertEqual(self._active(GCMDevice), ["ghi", "jkl", "mno"])
+
+	@mock.patch.dict(
+		SETTINGS, {"DEACTIVATION_BUFFER_SIZE": 100, "DEACTIVATION_FLUSH_INTERVAL": 0}
+	)
+	def test_sink_keeps_ids_that_fail_to_be_written(self):
+		sink = DeactivationSink()
+		sink.add(GCMDevice, ["abc", "def"])
+		sink.add(APNSDevice, ["abc"])
+
+		with mock.patch(
+			"push_notifications.deactivation._deactivate_batch", side_effect=DatabaseError
+		):
+			with self.assertRaises(DatabaseError):
+				sink.flush()
+
+		self.assertEqual(sink.pending, 3)
+		sink.flush()
+
+		self.assertEqual(sink.pending, 0)
+		self.assertEqual(self._active(GCMDevice), ["ghi", "jkl", "mno"])
+		self.assertEqual(self._active(APNSDevice), ["def", "ghi", "jkl", "mno"])
+
+	def test_sink_logs_errors_instead_of_raising_them_to_senders(self):
+		sink = DeactivationSink()
+		with mock.patch(
+			"push_notifications.deactivation._deactivate_batch", side_effect=DatabaseError
+		):
+			with self.assertLogs("push_notifications.deactivation", "ERROR"):
+				sink.add(GCMDevice, ["abc"])
+
+		self.assertEqual(sink.pending, 1)
+		self.assertEqual(len(self._active(GCMDevice)), 5)
+
+		sink.add(GCMDevice, ["def"])
+
+		self.assertEqual(sink.pending, 0)
+		self.assertEqual(self._active(GCMDevice), ["ghi", "jkl", "mno"])
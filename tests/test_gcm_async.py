@@ -0,0 +1,165 @@
+import asyncio
+import datetime
+import json
+from unittest import mock
+
+import firebase_admin
+from asgiref.sync import async_to_sync
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from firebase_admin import credentials, messaging
+
+from push_notifications.gcm import MessageTemplate, dict_to_fcm_message, encode_message
+from push_notifications.gcm_async import FCMTransport, send_message
+from push_notifications.http2 import run
+from push_notifications.models import GCMDevice
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+
+from .h2server import StubH2Server
+
+
+class StubCredential(credentials.Base):
+	def __init__(self):
+		self.get_access_token = mock.Mock(return_value=credentials.AccessTokenInfo(
+			"access-token", datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+		))
+
+
+async def fcm_handler(headers, body):
+	token = json.loads(body)["message"]["token"]
+	# keep a few requests in flight at the same time
+	await asyncio.sleep(0.01)
+	if token.startswith("unregistered"):
+		return 404, [], {"error": {
+			"code": 404,
+			"message": "Requested entity was not found.",
+			"status": "NOT_FOUND",
+			"details": [{
+				"@type": "type.googleapis.com/google.firebase.fcm.v1.FcmError",
+				"errorCode": "UNREGISTERED",
+			}],
+		}}
+	if token.startswith("invalid"):
+		return 400, [], {"error": {
+			"code": 400, "message": "Bad token", "status": "INVALID_ARGUMENT"
+		}}
+	return 200, [], {"name": "projects/test-project/messages/%s" % token}
+
+
+class FCMAsyncTestCase(TestCase):
+	def setUp(self):
+		self.credential = StubCredential()
+		self.app = firebase_admin.initialize_app(
+			self.credential, {"projectId": "test-project"}, name="fcm-async-%s" % id(self)
+		)
+
+	def tearDown(self):
+		firebase_admin.delete_app(self.app)
+
+	def _send(self, registration_ids, **kwargs):
+		async def run():
+			async with StubH2Server(fcm_handler) as server:
+				transport = FCMTransport(
+					self.app, host="127.0.0.1", port=server.port, secure=False,
+					max_concurrent_streams=10
+				)
+				try:
+					message = dict_to_fcm_message({"message": "Hello world"})
+					response = await send_message(
+						registration_ids, message, transport=transport, **kwargs
+					)
+				finally:
+					await transport.close()
+				return response, server
+		return async_to_sync(run)()
+
+	def test_send_message(self):
+		response, server = self._send(["abc", "def"])
+
+		self.assertIsInstance(response, messaging.BatchResponse)
+		self.assertEqual(response.success_count, 2)
+		self.assertEqual(
+			[r.message_id for r in response.responses],
+			["projects/test-project/messages/abc", "projects/test-project/messages/def"]
+		)
+
+		headers, body = server.requests[0]
+		self.assertEqual(headers[":path"], "/v1/projects/test-project/messages:send")
+		self.assertEqual(headers["authorization"], "Bearer access-token")
+		data = json.loads(body)
+		self.assertNotIn("validate_only", data)
+		self.assertEqual(data["message"]["android"]["notification"]["body"], "Hello world")
+
+	def test_send_message_dry_run(self):
+		response, server = self._send(["abc"], dry_run=True)
+
+		self.assertEqual(response.success_count, 1)
+		self.assertTrue(json.loads(server.requests[0][1])["validate_only"])
+
+	def test_send_message_multiplexes_one_connection(self):
+		tokens = ["token%d" % i for i in range(50)]
+		response, server = self._send(tokens)
+
+		self.assertEqual(response.success_count, 50)
+		self.assertEqual([r.message_id.split("/")[-1] for r in response.responses], tokens)
+		self.assertEqual(server.connections, 1)
+		self.assertGreater(server.max_in_flight, 1)
+		self.assertLessEqual(server.max_in_flight, 10)
+		# the access token is fetched once and reused
+		self.assertEqual(self.credential.get_access_token.call_count, 1)
+
+	def test_send_message_with_errors(self):
+		GCMDevice.objects.create(registration_id="abc", cloud_message_type="FCM")
+		GCMDevice.objects.create(registration_id="unregistered", cloud_message_type="FCM")
+		GCMDevice.objects.create(registration_id="invalid", cloud_message_type="FCM")
+
+		response, server = self._send(["abc", "unregistered", "invalid"])
+
+		self.assertEqual(response.success_count, 1)
+		self.assertEqual(response.failure_count, 2)
+		self.assertIsInstance(response.responses[1].exception, messaging.UnregisteredError)
+		self.assertIsInstance(
+			response.responses[2].exception, firebase_admin.exceptions.InvalidArgumentError
+		)
+		self.assertTrue(GCMDevice.objects.get(registration_id="abc").active)
+		self.assertFalse(GCMDevice.objects.get(registration_id="unregistered").active)
+		self.assertFalse(GCMDevice.objects.get(registration_id="invalid").active)
+
+	def test_queryset_uses_the_template_path(self):
+		for token in ["abc", "def", "unregistered"]:
+			GCMDevice.objects.create(registration_id=token, cloud_message_type="FCM")
+		server = run(StubH2Server(fcm_handler).__aenter__())
+		transport = FCMTransport(self.app, host="127.0.0.1", port=server.port, secure=False)
+		try:
+			with mock.patch.dict(SETTINGS, {"FCM_USE_ASYNC": True}):
+				with mock.patch(
+					"push_notifications.gcm_async.get_transport", return_value=transport
+				):
+					with mock.patch("firebase_admin.messaging.send_each") as send_each:
+						response = GCMDevice.objects.all().send_message("Hello world")
+		finally:
+			run(transport.close())
+			run(server.__aexit__(None, None, None))
+
+		send_each.assert_not_called()
+		self.assertEqual(response.success_count, 2)
+		self.assertEqual(len(server.requests), 3)
+		self.assertFalse(GCMDevice.objects.get(registration_id="unregistered").active)
+
+	def test_falls_back_to_send_each_without_encoder(self):
+		GCMDevice.objects.create(registration_id="abc", cloud_message_type="FCM")
+		with mock.patch.dict(SETTINGS, {"FCM_USE_ASYNC": True}):
+			with mock.patch.object(MessageTemplate, "is_supported", return_value=False):
+				with mock.patch(
+					"firebase_admin.messaging.send_each",
+					return_value=messaging.BatchResponse([messaging.SendResponse({"name": "a"}, None)])
+				) as send_each:
+					response = GCMDevice.objects.all().send_message("Hello world")
+
+		send_each.assert_called_once()
+		self.assertEqual(response.success_count, 1)
+
+	def test_encode_message_without_encoder(self):
+		with mock.patch("push_notifications.gcm._message_encoder", return_value=None):
+			with self.assertRaises(ImproperlyConfigured):
+				encode_message(dict_to_fcm_message({"message": "Hello world"}))
@@ -1,10 +1,13 @@
+import json
 from unittest import mock
 
 from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
-from firebase_admin.messaging import Message
+from firebase_admin import messaging
+from firebase_admin.messaging import BatchResponse, Message, SendResponse
 
-from push_notifications.gcm import dict_to_fcm_message, send_message
+from push_notifications.gcm import MessageTemplate, dict_to_fcm_message, send_message
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
 
 from .responses import FCM_SUCCESS
 
@@ -12,7 +15,7 @@ from .responses import FCM_SUCCESS
 class GCMPushPayloadTest(TestCase):
 
 	def test_fcm_push_payload(self):
-		with mock.patch("firebase_admin.messaging.send_all", return_value=FCM_SUCCESS) as p:
+		with mock.patch("firebase_admin.messaging.send_each", return_value=FCM_SUCCESS) as p:
 			message = dict_to_fcm_message({"message": "Hello world"})
 
 			send_message("abc", message)
@@ -37,7 +40,7 @@ class GCMPushPayloadTest(TestCase):
 			self.assertEqual(message.android.notification.body, "Hello world")
 
 	def test_fcm_push_payload_many(self):
-		with mock.patch("firebase_admin.messaging.send_all", return_value=FCM_SUCCESS) as p:
+		with mock.patch("firebase_admin.messaging.send_each", return_value=FCM_SUCCESS) as p:
 			message = dict_to_fcm_message({"message": "Hello world"})
 
 			send_message(["abc", "123"], message)
@@ -66,6 +69,29 @@ class GCMPushPayloadTest(TestCase):
 			self.assertEqual( message_two.token,"123")
 			self.assertEqual( message_two.android.notification.body, "Hello world")
 
+	def test_fcm_push_payload_chunks_concurrently(self):
+		def send_each(messages, **kwargs):
+			return BatchResponse([
+				SendResponse(resp={"name": message.token}, exception=None) for message in messages
+			])
+
+		reg_ids = ["token%d" % i for i in range(1200)]
+		with mock.patch.dict(SETTINGS, {"FCM_MAX_RECIPIENTS": 1000, "FCM_MAX_WORKERS": 4}):
+			with mock.patch("firebase_admin.messaging.send_each", side_effect=send_each) as p:
+				message = dict_to_fcm_message({"message": "Hello world"})
+
+				response = send_message(reg_ids, message)
+
+				# chunks are capped at the 500 messages send_each accepts
+				self.assertEqual(p.call_count, 3)
+				self.assertEqual(
+					sorted(len(call[0][0]) for call in p.call_args_list), [200, 500, 500]
+				)
+
+				# responses are returned in registration_ids order
+				self.assertEqual(response.success_count, 1200)
+				self.assertEqual([r.message_id for r in response.responses], reg_ids)
+
 	def test_push_payload_with_app_id(self):
 		with self.assertRaises(ImproperlyConfigured) as ic:
 			send_message("abc", {"message": "Hello world"}, application_id="test")
@@ -75,3 +101,23 @@ class GCMPushPayloadTest(TestCase):
 			("LegacySettings does not support application_id. To enable "
 			 "multiple application support, use push_notifications.conf.AppSettings.")
 		)
+
+	def test_message_template(self):
+		message = dict_to_fcm_message({"message": "Hello world", "foo": "bar"})
+
+		template = MessageTemplate(message)
+		for token in ["abc", 'with "quotes"']:
+			expected = messaging._MessagingService.encode_message(Message(
+				data=message.data, android=message.android, token=token
+			))
+			self.assertEqual(json.loads(template.render(token)), {"message": expected})
+
+		# the original message is left untouched
+		self.assertIsNone(message.token)
+
+	def test_message_template_dry_run(self):
+		message = dict_to_fcm_message({"message": "Hello world"})
+
+		data = json.loads(MessageTemplate(message, dry_run=True).render("abc"))
+		self.assertTrue(data["validate_only"])
+		self.assertEqual(data["message"]["token"], "abc")
@@ -0,0 +1,93 @@
+import asyncio
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase
+
+from push_notifications.http2 import (
+	HTTP2Connection, HTTP2ConnectionError, HTTP2Error, HTTP2Transport, TransportRegistry
+)
+
+from .h2server import StubH2Server
+
+
+class HTTP2ConnectionTestCase(SimpleTestCase):
+	def _run(self, serve, send):
+		async def run():
+			server = await asyncio.start_server(serve, "127.0.0.1", 0)
+			port = server.sockets[0].getsockname()[1]
+			connection = HTTP2Connection("127.0.0.1", port, secure=False)
+			try:
+				return await send(connection)
+			finally:
+				await connection.close()
+				server.close()
+				await server.wait_closed()
+		return async_to_sync(run)()
+
+	def test_requests_in_flight_are_not_retryable(self):
+		async def serve(reader, writer):
+			# read the request, then drop the connection without answering
+			await reader.read(65535)
+			writer.close()
+
+		async def send(connection):
+			with self.assertRaises(HTTP2Error) as cm:
+				await connection.request("POST", "/", body=b"x")
+			return cm.exception
+
+		error = self._run(serve, send)
+		# the server may have processed the request
+		self.assertNotIsInstance(error, HTTP2ConnectionError)
+
+	def test_requests_on_closed_connection_are_retryable(self):
+		async def serve(reader, writer):
+			await reader.read(65535)
+			writer.close()
+
+		async def send(connection):
+			with self.assertRaises(HTTP2Error):
+				await connection.request("POST", "/", body=b"x")
+			with self.assertRaises(HTTP2ConnectionError):
+				await connection.request("POST", "/", body=b"x")
+
+		self._run(serve, send)
+
+
+class HTTP2TransportTestCase(SimpleTestCase):
+	def test_unprocessed_requests_are_retried_on_a_new_connection(self):
+		async def run():
+			async with StubH2Server(lambda headers, body: (200, [], b"ok")) as server:
+				transport = HTTP2Transport("127.0.0.1", server.port, secure=False)
+				first = transport.connection
+
+				async def goaway(*args):
+					# the server shut the connection down before processing the request
+					first._closed = True
+					raise HTTP2ConnectionError("GOAWAY")
+
+				with mock.patch.object(first, "request", side_effect=goaway) as request:
+					response = await transport.request("POST", "/", body=b"x")
+				request.assert_called_once()
+				await transport.close()
+				return first, transport.connection, response, server.requests
+
+		first, second, response, requests = async_to_sync(run)()
+		self.assertIsNot(first, second)
+		self.assertEqual(response.status, 200)
+		self.assertEqual(len(requests), 1)
+
+	def test_registry_keeps_one_transport_per_key_and_loop(self):
+		registry = TransportRegistry()
+
+		async def run():
+			first = registry.get("a", lambda: HTTP2Transport("127.0.0.1"))
+			second = registry.get("a", lambda: HTTP2Transport("127.0.0.1"))
+			other = registry.get("b", lambda: HTTP2Transport("127.0.0.1"))
+			await registry.close()
+			return first, second, other, registry.get("a", lambda: None)
+
+		first, second, other, after_close = async_to_sync(run)()
+		self.assertIs(first, second)
+		self.assertIsNot(first, other)
+		self.assertIsNone(after_close)
@@ -0,0 +1,81 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.test import TestCase
+
+from push_notifications.http_pool import HTTPConnectionPool
+
+
+class Handler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers["Content-Length"]))
+		self.server.connections.add(self.client_address)
+		status = 410 if self.path.startswith("/gone") else 200
+		self.send_response(status)
+		self.send_header("Content-Length", str(len(body)))
+		if self.path.startswith("/close"):
+			self.send_header("Connection", "close")
+		self.end_headers()
+		self.wfile.write(body)
+		if self.path.startswith("/drop"):
+			# close the connection without telling the client
+			self.close_connection = True
+
+	def log_message(self, *args):
+		pass
+
+
+class HTTPConnectionPoolTest(TestCase):
+	def setUp(self):
+		self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+		self.server.connections = set()
+		self.url = "http://127.0.0.1:%d" % (self.server.server_address[1])
+		thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+		thread.start()
+		self.pool = HTTPConnectionPool(maxsize=2, timeout=5)
+
+	def tearDown(self):
+		self.pool.clear()
+		self.server.shutdown()
+		self.server.server_close()
+
+	def test_connections_are_reused(self):
+		for i in range(5):
+			response = self.pool.request("POST", self.url + "/?token=%d" % i, body=b"%d" % i)
+			self.assertEqual(response.status, 200)
+			self.assertEqual(response.body, b"%d" % i)
+		self.assertEqual(len(self.server.connections), 1)
+
+	def test_error_responses_keep_the_connection(self):
+		self.assertEqual(self.pool.request("POST", self.url + "/gone", body=b"x").status, 410)
+		self.assertEqual(self.pool.request("POST", self.url + "/", body=b"x").status, 200)
+		self.assertEqual(len(self.server.connections), 1)
+
+	def test_closed_connections_are_not_reused(self):
+		self.pool.request("POST", self.url + "/close", body=b"x")
+		self.pool.request("POST", self.url + "/", body=b"x")
+		self.assertEqual(len(self.server.connections), 2)
+
+	def test_stale_connection_is_replaced(self):
+		self.pool.request("POST", self.url + "/drop", body=b"x")
+		time.sleep(0.1)
+		response = self.pool.request("POST", self.url + "/", body=b"y")
+		self.assertEqual(response.body, b"y")
+		self.assertEqual(len(self.server.connections), 2)
+
+	def test_idle_connections_are_capped(self):
+		results = []
+
+		def send():
+			results.append(self.pool.request("POST", self.url + "/", body=b"x").status)
+
+		threads = [threading.Thread(target=send) for _ in range(6)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(results, [200] * 6)
+		self.assertLessEqual(sum(len(idle) for idle in self.pool._idle.values()), 2)
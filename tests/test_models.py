@@ -1,13 +1,16 @@
+import unittest
 from unittest import mock
 
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from firebase_admin import messaging
 from firebase_admin.exceptions import InvalidArgumentError
 from firebase_admin.messaging import BatchResponse, Message, SendResponse
 
 from push_notifications.gcm import dict_to_fcm_message, send_bulk_message
-from push_notifications.models import APNSDevice, GCMDevice
+from push_notifications.models import APNSDevice, GCMDevice, WebPushDevice, WNSDevice
 
 from . import responses
 
@@ -38,7 +41,7 @@ class GCMModelTestCase(TestCase):
 	def test_fcm_send_message(self):
 		device = GCMDevice.objects.create(registration_id="abc", cloud_message_type="FCM")
 		with mock.patch(
-			"firebase_admin.messaging.send_all", return_value=responses.FCM_SUCCESS
+			"firebase_admin.messaging.send_each", return_value=responses.FCM_SUCCESS
 		) as p:
 			device.send_message("Hello world")
 
@@ -65,7 +68,7 @@ class GCMModelTestCase(TestCase):
 	def test_fcm_send_message_with_fcm_message(self):
 		device = GCMDevice.objects.create(registration_id="abc", cloud_message_type="FCM")
 		with mock.patch(
-			"firebase_admin.messaging.send_all", return_value=responses.FCM_SUCCESS
+			"firebase_admin.messaging.send_each", return_value=responses.FCM_SUCCESS
 		) as p:
 			message_to_send = messaging.Message(
 				notification=messaging.Notification(
@@ -99,7 +102,7 @@ class GCMModelTestCase(TestCase):
 	def test_fcm_send_message_extra_data(self):
 		device = GCMDevice.objects.create(registration_id="abc", cloud_message_type="FCM")
 		with mock.patch(
-			"firebase_admin.messaging.send_all", return_value=responses.FCM_SUCCESS
+			"firebase_admin.messaging.send_each", return_value=responses.FCM_SUCCESS
 		) as p:
 			device.send_message("Hello world", extra={"foo": "bar"})
 
@@ -125,7 +128,7 @@ class GCMModelTestCase(TestCase):
 	def test_fcm_send_message_extra_options(self):
 		device = GCMDevice.objects.create(registration_id="abc", cloud_message_type="FCM")
 		with mock.patch(
-			"firebase_admin.messaging.send_all", return_value=responses.FCM_SUCCESS
+			"firebase_admin.messaging.send_each", return_value=responses.FCM_SUCCESS
 		) as p:
 			device.send_message("Hello world", collapse_key="test_key", foo="bar")
 
@@ -152,7 +155,7 @@ class GCMModelTestCase(TestCase):
 	def test_fcm_send_message_extra_notification(self):
 		device = GCMDevice.objects.create(registration_id="abc", cloud_message_type="FCM")
 		with mock.patch(
-			"firebase_admin.messaging.send_all", return_value=responses.FCM_SUCCESS
+			"firebase_admin.messaging.send_each", return_value=responses.FCM_SUCCESS
 		) as p:
 			device.send_message("Hello world", extra={"icon": "test_icon"}, title="test")
 
@@ -180,7 +183,7 @@ class GCMModelTestCase(TestCase):
 	def test_fcm_send_message_extra_options_and_notification_and_data(self):
 		device = GCMDevice.objects.create(registration_id="abc", cloud_message_type="FCM")
 		with mock.patch(
-			"firebase_admin.messaging.send_all", return_value=responses.FCM_SUCCESS
+			"firebase_admin.messaging.send_each", return_value=responses.FCM_SUCCESS
 		) as p:
 			device.send_message(
 				"Hello world",
@@ -215,7 +218,7 @@ class GCMModelTestCase(TestCase):
 		self._create_fcm_devices(["abc", "abc1"])
 
 		with mock.patch(
-			"firebase_admin.messaging.send_all", return_value=responses.FCM_SUCCESS_MULTIPLE
+			"firebase_admin.messaging.send_each", return_value=responses.FCM_SUCCESS_MULTIPLE
 		) as p:
 			GCMDevice.objects.all().send_message("Hello world")
 
@@ -245,7 +248,7 @@ class GCMModelTestCase(TestCase):
 		self._create_fcm_devices(["abc", "abc1"])
 
 		with mock.patch(
-			"firebase_admin.messaging.send_all", return_value=responses.FCM_SUCCESS_MULTIPLE
+			"firebase_admin.messaging.send_each", return_value=responses.FCM_SUCCESS_MULTIPLE
 		) as p:
 			message_to_send = messaging.Message(
 				notification=messaging.Notification(
@@ -279,11 +282,25 @@ class GCMModelTestCase(TestCase):
 			self.assertEqual(message_two.notification.title, "Hello world")
 			self.assertEqual(message_two.notification.body, "What a beautiful day.")
 
+	def test_fcm_send_message_to_multiple_devices_in_pages(self):
+		self._create_fcm_devices(["abc", "abc1", "abc2"])
+
+		with mock.patch(
+			"firebase_admin.messaging.send_each", return_value=responses.FCM_SUCCESS_MULTIPLE
+		) as p:
+			GCMDevice.objects.all().send_message("Hello world", page_size=2)
+
+			# one FCM call per page, in primary key order
+			self.assertEqual(p.call_count, 2)
+			first, second = p.call_args_list
+			self.assertEqual([m.token for m in first[0][0]], ["abc", "abc1"])
+			self.assertEqual([m.token for m in second[0][0]], ["abc2"])
+
 	def test_gcm_send_message_does_not_send(self):
 		device = GCMDevice.objects.create(registration_id="abc", cloud_message_type="GCM")
 
 		with mock.patch(
-			"firebase_admin.messaging.send_all", return_value=responses.FCM_SUCCESS_MULTIPLE
+			"firebase_admin.messaging.send_each", return_value=responses.FCM_SUCCESS_MULTIPLE
 		) as p:
 			message_to_send = messaging.Message(
 				notification=messaging.Notification(
@@ -299,7 +316,7 @@ class GCMModelTestCase(TestCase):
 		self._create_devices(["abc", "abc1"])
 
 		with mock.patch(
-			"firebase_admin.messaging.send_all", return_value=responses.FCM_SUCCESS_MULTIPLE
+			"firebase_admin.messaging.send_each", return_value=responses.FCM_SUCCESS_MULTIPLE
 		) as p:
 			message_to_send = messaging.Message(
 				notification=messaging.Notification(
@@ -318,7 +335,7 @@ class GCMModelTestCase(TestCase):
 		GCMDevice.objects.create(registration_id="xyz", active=False, cloud_message_type="FCM")
 
 		with mock.patch(
-			"firebase_admin.messaging.send_all", return_value=responses.FCM_SUCCESS_MULTIPLE
+			"firebase_admin.messaging.send_each", return_value=responses.FCM_SUCCESS_MULTIPLE
 		) as p:
 			GCMDevice.objects.all().send_message("Hello world")
 
@@ -344,7 +361,7 @@ class GCMModelTestCase(TestCase):
 		self._create_fcm_devices(["abc", "abc1"])
 
 		with mock.patch(
-			"firebase_admin.messaging.send_all", return_value=responses.FCM_SUCCESS_MULTIPLE
+			"firebase_admin.messaging.send_each", return_value=responses.FCM_SUCCESS_MULTIPLE
 		) as p:
 			GCMDevice.objects.all().send_message("Hello world", collapse_key="test_key")
 
@@ -386,7 +403,7 @@ class GCMModelTestCase(TestCase):
 				[SendResponse(resp={"name": "..."}, exception=error)]
 			)
 			with mock.patch(
-				"firebase_admin.messaging.send_all", return_value=return_value
+				"firebase_admin.messaging.send_each", return_value=return_value
 			):
 				device = GCMDevice.objects.get(registration_id=devices[index])
 				device.send_message("Hello World!")
@@ -399,7 +416,7 @@ class GCMModelTestCase(TestCase):
 			[SendResponse(resp={"name": "..."}, exception=OSError())]
 		)
 		with mock.patch(
-			"firebase_admin.messaging.send_all",
+			"firebase_admin.messaging.send_each",
 			return_value=return_value
 		):
 			# these errors are not device specific, device is not deactivated
@@ -417,7 +434,7 @@ class GCMModelTestCase(TestCase):
 			SendResponse(resp={"name": "..."}, exception=InvalidArgumentError("Invalid registration")),
 		])
 		with mock.patch(
-			"firebase_admin.messaging.send_all", return_value=return_value
+			"firebase_admin.messaging.send_each", return_value=return_value
 		):
 			GCMDevice.objects.all().send_message("Hello World")
 			self.assertFalse(GCMDevice.objects.get(registration_id="abc").active)
@@ -436,7 +453,7 @@ class GCMModelTestCase(TestCase):
 		])
 
 		with mock.patch(
-			"firebase_admin.messaging.send_all", return_value=return_value
+			"firebase_admin.messaging.send_each", return_value=return_value
 		):
 			GCMDevice.objects.all().send_message("Hello World")
 			self.assertTrue(GCMDevice.objects.get(registration_id="abc").active)
@@ -448,14 +465,14 @@ class GCMModelTestCase(TestCase):
 		self._create_fcm_devices(["abc", "abc1"])
 
 		with mock.patch(
-			"firebase_admin.messaging.send_all",
+			"firebase_admin.messaging.send_each",
 			return_value=responses.FCM_SUCCESS_MULTIPLE
 		) as p:
 			GCMDevice.objects.filter(registration_id="xyz").send_message("Hello World")
 			p.assert_not_called()
 
 		with mock.patch(
-			"firebase_admin.messaging.send_all",
+			"firebase_admin.messaging.send_each",
 			return_value=responses.FCM_SUCCESS_MULTIPLE
 		) as p:
 			reg_ids = [obj.registration_id for obj in GCMDevice.objects.all()]
@@ -468,3 +485,55 @@ class GCMModelTestCase(TestCase):
 		self.assertIsNotNone(device.pk)
 		self.assertIsNotNone(device.date_created)
 		self.assertEqual(device.date_created.date(), timezone.now().date())
+
+
+@unittest.skipUnless(connection.vendor == "sqlite", "Checks SQLite query plans")
+class DeviceIndexTestCase(TestCase):
+	def _assert_send_queries_use_index(self, queryset, indexes, sender, **sender_kwargs):
+		for i in range(6):
+			queryset.model.objects.create(
+				registration_id="https://example.com/%d" % (i), application_id="app%d" % (i % 2)
+			)
+
+		with mock.patch(sender, **sender_kwargs):
+			with CaptureQueriesContext(connection) as queries:
+				queryset.send_message("Hello world")
+
+		filtered = [q["sql"] for q in queries.captured_queries if "WHERE" in q["sql"]]
+		self.assertTrue(filtered)
+		for sql in filtered:
+			with connection.cursor() as cursor:
+				cursor.execute(connection.ops.explain_query_prefix() + " " + sql)
+				plan = " ".join(str(row) for row in cursor.fetchall())
+			self.assertTrue(any(index in plan for index in indexes), (sql, plan))
+
+	def test_gcm_send_message_uses_indexes(self):
+		self._assert_send_queries_use_index(
+			GCMDevice.objects.all(),
+			["push_gcm_app_active_idx", "push_gcm_app_active_type_idx"],
+			"push_notifications.gcm.send_message", return_value=mock.Mock(responses=[]),
+		)
+
+	def test_apns_send_message_uses_index(self):
+		def send(registration_ids, **kwargs):
+			return {registration_id: "Success" for registration_id in registration_ids}
+
+		self._assert_send_queries_use_index(
+			APNSDevice.objects.all(), ["push_apns_app_active_idx"],
+			"push_notifications.apns.apns_send_bulk_message", side_effect=send,
+		)
+
+	def test_wns_send_message_uses_index(self):
+		self._assert_send_queries_use_index(
+			WNSDevice.objects.all(), ["push_wns_app_active_idx"],
+			"push_notifications.wns.wns_send_bulk_message", return_value=[],
+		)
+
+	def test_webpush_send_message_uses_index(self):
+		def send(devices, message, **kwargs):
+			return [{"success": 1} for device in devices]
+
+		self._assert_send_queries_use_index(
+			WebPushDevice.objects.all(), ["push_webpush_app_active_idx"],
+			"push_notifications.webpush.webpush_send_bulk_message", side_effect=send,
+		)
@@ -1,12 +1,30 @@
+import base64
+import collections
+import email.utils
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
+import http_ece
+import requests
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
 from django.test import TestCase
+from py_vapid import Vapid
 from pywebpush import WebPushException
 
+from push_notifications import webpush
+
 from push_notifications.exceptions import WebPushError
+from push_notifications.models import WebPushDevice
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
 from push_notifications.webpush import (
 	get_subscription_info, webpush_send_message
 )
+from push_notifications.webpush_encryption import encrypt
 
 # Mock Responses
 mock_success_response = mock.MagicMock(status_code=200, ok=True)
@@ -26,6 +44,7 @@ class WebPushSendMessageTestCase(TestCase):
 		self.mock_device.auth = "authtest"
 		self.mock_device.p256dh = "p256dhtest"
 		self.mock_device.active = True
+		self.mock_device.pk = 1
 		self.mock_device.save.return_value = True
 
 	def test_get_subscription_info(self):
@@ -85,9 +104,452 @@ class WebPushSendMessageTestCase(TestCase):
 		results = webpush_send_message(self.mock_device, "message")
 		self.assertEqual(results["failure"], 1)
 
+	def test_webpush_send_message_unsubscribe_only_deactivates_the_device(self):
+		devices = [
+			WebPushDevice.objects.create(
+				registration_id=self.endpoint, application_id=application_id,
+				browser="FIREFOX", auth="authtest", p256dh="p256dhtest"
+			)
+			for application_id in [None, "app2"]
+		]
+		with mock.patch(
+			"push_notifications.webpush.webpush", side_effect=WebPushException(
+				"Unsubscribe", response=mock_unsubscribe_response
+			)
+		):
+			webpush_send_message(devices[0], "message")
+
+		self.assertEqual(
+			list(WebPushDevice.objects.filter(active=True).values_list("application_id", flat=True)),
+			["app2"]
+		)
+
 	@mock.patch(
         "push_notifications.webpush.webpush",
         side_effect=WebPushException("Error"))
 	def test_webpush_send_message_exception(self, webpush_mock):
 		with self.assertRaises(WebPushError):
 			webpush_send_message(self.mock_device, "message")
+
+
+class VAPIDKeyTestCase(TestCase):
+	def setUp(self):
+		webpush._vapid_keys.clear()
+		webpush._vapid_headers.clear()
+		webpush._sessions.clear()
+		webpush._limiters.clear()
+		self.vapid = Vapid()
+		self.vapid.generate_keys()
+		fd, self.key_path = tempfile.mkstemp(suffix=".pem")
+		os.close(fd)
+		self.vapid.save_key(self.key_path)
+		self.addCleanup(os.remove, self.key_path)
+		self.settings = mock.patch.dict(SETTINGS, {
+			"WP_PRIVATE_KEY": self.key_path, "WP_CLAIMS": {"sub": "mailto:dev@example.com"}
+		})
+		self.settings.start()
+		self.addCleanup(self.settings.stop)
+
+
+class WebPushVAPIDTestCase(VAPIDKeyTestCase):
+	def test_headers_are_signed_once_per_origin(self):
+		with mock.patch.object(Vapid, "sign", autospec=True, side_effect=Vapid.sign) as sign:
+			mozilla = webpush._webpush_vapid_headers(
+				None, "https://updates.push.services.mozilla.com/wpush/v2/a"
+			)
+			self.assertEqual(webpush._webpush_vapid_headers(
+				None, "https://updates.push.services.mozilla.com/wpush/v2/b"
+			), mozilla)
+			google = webpush._webpush_vapid_headers(None, "https://fcm.googleapis.com/fcm/send/c")
+		self.assertEqual(sign.call_count, 2)
+		self.assertNotEqual(google, mozilla)
+		self.assertEqual(
+			[c[0][1]["aud"] for c in sign.call_args_list],
+			["https://updates.push.services.mozilla.com", "https://fcm.googleapis.com"]
+		)
+		self.assertTrue(Vapid.verify(mozilla["Authorization"]))
+
+	def test_headers_are_signed_again_before_they_expire(self):
+		endpoint = "https://updates.push.services.mozilla.com/wpush/v2/a"
+		with mock.patch.object(Vapid, "sign", autospec=True, side_effect=Vapid.sign) as sign:
+			with mock.patch("push_notifications.webpush.time.time", return_value=1000000):
+				webpush._webpush_vapid_headers(None, endpoint)
+			expires_at = sign.call_args[0][1]["exp"]
+			self.assertEqual(expires_at, 1000000 + webpush.VAPID_TOKEN_LIFETIME)
+			refresh_at = expires_at - webpush.VAPID_REFRESH_MARGIN
+			with mock.patch("push_notifications.webpush.time.time", return_value=refresh_at - 1):
+				webpush._webpush_vapid_headers(None, endpoint)
+			self.assertEqual(sign.call_count, 1)
+			with mock.patch("push_notifications.webpush.time.time", return_value=refresh_at):
+				webpush._webpush_vapid_headers(None, endpoint)
+			self.assertEqual(sign.call_count, 2)
+
+	def test_key_is_parsed_once(self):
+		with mock.patch.object(Vapid, "from_file", side_effect=Vapid.from_file) as from_file:
+			for endpoint in ["https://a.example.com/1", "https://b.example.com/2"]:
+				webpush._webpush_vapid_headers(None, endpoint)
+		self.assertEqual(from_file.call_count, 1)
+
+	def test_send_message_passes_the_cached_headers(self):
+		device = WebPushDevice(
+			registration_id="https://updates.push.services.mozilla.com/wpush/v2/a",
+			browser="FIREFOX", auth="authtest", p256dh="p256dhtest",
+		)
+		with mock.patch(
+			"push_notifications.webpush.webpush", return_value=mock_success_response
+		) as webpush_mock:
+			webpush_send_message(device, "message", headers={"Urgency": "high"})
+		kwargs = webpush_mock.call_args[1]
+		self.assertNotIn("vapid_claims", kwargs)
+		self.assertEqual(kwargs["headers"]["Urgency"], "high")
+		self.assertTrue(kwargs["headers"]["Authorization"].startswith("vapid t="))
+
+
+class WebPushDeviceQuerySetTestCase(VAPIDKeyTestCase):
+
+	def _create(self, *tokens):
+		for token in tokens:
+			WebPushDevice.objects.create(
+				registration_id="https://updates.push.services.mozilla.com/wpush/v2/" + token,
+				browser="FIREFOX", auth="authtest", p256dh="p256dhtest",
+			)
+
+	def test_sends_reuse_a_session_per_origin(self):
+		self._create("a", "b")
+		WebPushDevice.objects.create(
+			registration_id="https://fcm.googleapis.com/fcm/send/c",
+			browser="CHROME", auth="authtest", p256dh="p256dhtest",
+		)
+		with mock.patch.dict(SETTINGS, {"WP_ERROR_TIMEOUT": (3.05, 10)}):
+			with mock.patch(
+				"push_notifications.webpush.webpush", return_value=mock_success_response
+			) as webpush_mock:
+				WebPushDevice.objects.all().send_message("message")
+		calls = [c[1] for c in webpush_mock.call_args_list]
+		self.assertEqual(
+			[c["subscription_info"]["endpoint"].split("/")[2] for c in calls],
+			[
+				"fcm.googleapis.com",
+				"updates.push.services.mozilla.com",
+				"updates.push.services.mozilla.com",
+			]
+		)
+		self.assertIs(calls[1]["requests_session"], calls[2]["requests_session"])
+		self.assertIsNot(calls[0]["requests_session"], calls[1]["requests_session"])
+		self.assertEqual({c["timeout"] for c in calls}, {(3.05, 10)})
+
+	def test_send_message_passes_kwargs(self):
+		self._create("abc")
+		with mock.patch(
+			"push_notifications.webpush.webpush", return_value=mock_success_response
+		) as webpush_mock:
+			res = WebPushDevice.objects.all().send_message("message", ttl=60)
+		self.assertEqual(res, [{
+			"results": [{
+				"original_registration_id":
+					"https://updates.push.services.mozilla.com/wpush/v2/abc"
+			}],
+			"success": 1,
+		}])
+		self.assertEqual(webpush_mock.call_args[1]["ttl"], 60)
+
+	def test_send_message_continues_after_errors(self):
+		self._create("ok", "gone", "error", "timeout")
+
+		def webpush(subscription_info, **kwargs):
+			token = subscription_info["endpoint"].rsplit("/", 1)[-1]
+			if token == "gone":
+				raise WebPushException("Unsubscribe", response=mock_unsubscribe_response)
+			if token == "error":
+				raise WebPushException("Error")
+			if token == "timeout":
+				raise requests.Timeout("Read timed out")
+			return mock_success_response
+
+		with mock.patch("push_notifications.webpush.webpush", side_effect=webpush):
+			res = WebPushDevice.objects.all().send_message("message")
+
+		# the devices are sent to in registration_id order
+		self.assertEqual(
+			[r.get("success", 0) for r in res], [0, 0, 1, 0]
+		)
+		self.assertEqual(res[0]["results"][0]["error"], "Error")
+		self.assertEqual(res[1]["results"][0]["error"], "Unsubscribe")
+		self.assertEqual(res[3]["results"][0]["error"], "Read timed out")
+		active = WebPushDevice.objects.filter(active=True).order_by("registration_id")
+		self.assertEqual(
+			list(active.values_list("registration_id", flat=True)),
+			[
+				"https://updates.push.services.mozilla.com/wpush/v2/error",
+				"https://updates.push.services.mozilla.com/wpush/v2/ok",
+				"https://updates.push.services.mozilla.com/wpush/v2/timeout",
+			]
+		)
+
+	def test_send_message_with_several_workers(self):
+		tokens = ["token%d" % i for i in range(20)]
+		self._create(*tokens)
+		in_flight = []
+		max_in_flight = []
+		lock = threading.Lock()
+
+		def webpush(subscription_info, **kwargs):
+			with lock:
+				in_flight.append(subscription_info["endpoint"])
+				max_in_flight.append(len(in_flight))
+			time.sleep(0.01)
+			with lock:
+				in_flight.remove(subscription_info["endpoint"])
+			return mock_success_response
+
+		with mock.patch.dict(SETTINGS, {"WP_MAX_WORKERS": 4}):
+			with mock.patch("push_notifications.webpush.webpush", side_effect=webpush):
+				res = WebPushDevice.objects.all().send_message("message")
+
+		self.assertEqual(
+			[r["results"][0]["original_registration_id"].rsplit("/", 1)[-1] for r in res],
+			sorted(tokens)
+		)
+		self.assertGreater(max(max_in_flight), 1)
+		self.assertLessEqual(max(max_in_flight), 4)
+
+
+class WebPushEncryptionProcessesTestCase(VAPIDKeyTestCase):
+	def _subscribe(self, token):
+		private_key = ec.generate_private_key(ec.SECP256R1())
+		public_key = private_key.public_key().public_bytes(
+			serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+		)
+		auth = os.urandom(16)
+		WebPushDevice.objects.create(
+			registration_id="https://updates.push.services.mozilla.com/wpush/v2/" + token,
+			browser="FIREFOX",
+			auth=base64.urlsafe_b64encode(auth).decode().strip("="),
+			p256dh=base64.urlsafe_b64encode(public_key).decode().strip("="),
+		)
+		return private_key, auth
+
+	def test_payloads_are_encrypted_in_worker_processes(self):
+		receivers = {"token%d" % i: self._subscribe("token%d" % i) for i in range(4)}
+		posts = []
+
+		def post(endpoint, data, headers, timeout):
+			posts.append((endpoint, data, headers))
+			return mock.MagicMock(status_code=201, ok=True)
+
+		with mock.patch.dict(SETTINGS, {"WP_ENCRYPTION_PROCESSES": 2, "WP_MAX_WORKERS": 4}):
+			with mock.patch("push_notifications.webpush.webpush") as webpush_mock:
+				with mock.patch("requests.Session.post", side_effect=post):
+					res = WebPushDevice.objects.all().send_message("secret message", ttl=30)
+
+		webpush_mock.assert_not_called()
+		self.assertEqual([r["success"] for r in res], [1] * 4)
+		self.assertEqual(len(posts), 4)
+		for endpoint, data, headers in posts:
+			private_key, auth = receivers[endpoint.rsplit("/", 1)[-1]]
+			self.assertEqual(
+				http_ece.decrypt(data, private_key=private_key, auth_secret=auth, version="aes128gcm"),
+				b"secret message"
+			)
+			self.assertEqual(headers["content-encoding"], "aes128gcm")
+			self.assertEqual(headers["ttl"], "30")
+			self.assertTrue(headers["Authorization"].startswith("vapid t="))
+		self.assertEqual(len(webpush._sessions), 1)
+
+	def test_payloads_are_encrypted_ahead_of_the_sends(self):
+		for i in range(4):
+			self._subscribe("token%d" % i)
+		submitted = []
+		posted = []
+		encryptor = ThreadPoolExecutor(max_workers=1)
+
+		def submit(fn, *args):
+			submitted.append(args[0]["endpoint"])
+			return encryptor.submit(fn, *args)
+
+		def post(endpoint, data, headers, timeout):
+			posted.append(len(submitted))
+			return mock.MagicMock(status_code=201, ok=True)
+
+		with mock.patch.dict(SETTINGS, {"WP_ENCRYPTION_PROCESSES": 1, "WP_MAX_WORKERS": 1}):
+			with mock.patch(
+				"push_notifications.webpush._webpush_encryption_pool",
+				return_value=mock.Mock(submit=submit)
+			):
+				with mock.patch("requests.Session.post", side_effect=post):
+					res = WebPushDevice.objects.all().send_message("secret message")
+		encryptor.shutdown()
+
+		self.assertEqual([r["success"] for r in res], [1] * 4)
+		# each payload is encrypted once, the next two before the device is sent to
+		self.assertEqual(len(submitted), 4)
+		self.assertEqual(posted, [3, 4, 4, 4])
+
+	def test_str_payloads_are_encoded(self):
+		with mock.patch("push_notifications.webpush_encryption.WebPusher") as pusher:
+			pusher.return_value.encode.return_value = {"body": b"encrypted"}
+			encrypt({"endpoint": "https://example.com/token", "keys": {}}, "héllo")
+		pusher.return_value.encode.assert_called_once_with("héllo".encode("utf-8"), "aes128gcm")
+
+	def test_rejected_subscriptions_are_reported(self):
+		self._subscribe("gone")
+		with mock.patch.dict(SETTINGS, {"WP_ENCRYPTION_PROCESSES": 1}):
+			with mock.patch("requests.Session.post", return_value=mock.MagicMock(
+				status_code=410, ok=False, reason="Gone", text=""
+			)):
+				res = WebPushDevice.objects.all().send_message("secret message")
+		self.assertEqual(res[0]["failure"], 1)
+		self.assertFalse(WebPushDevice.objects.get().active)
+
+
+class WebPushThrottlingTestCase(VAPIDKeyTestCase):
+	def setUp(self):
+		super().setUp()
+		for endpoint in [
+			"https://fcm.googleapis.com/fcm/send/a",
+			"https://fcm.googleapis.com/fcm/send/b",
+			"https://updates.push.services.mozilla.com/wpush/v2/c",
+			"https://updates.push.services.mozilla.com/wpush/v2/d",
+		]:
+			WebPushDevice.objects.create(
+				registration_id=endpoint, browser="CHROME", auth="authtest", p256dh="p256dhtest"
+			)
+		self.requests = []
+
+	def _webpush(self, retry_after, throttled=1):
+		def webpush(subscription_info, **kwargs):
+			endpoint = subscription_info["endpoint"]
+			self.requests.append(endpoint)
+			if endpoint.endswith("/a") and self.requests.count(endpoint) <= throttled:
+				raise WebPushException("Too Many Requests", response=mock.MagicMock(
+					status_code=429, headers={"Retry-After": retry_after}
+				))
+			return mock_success_response
+		return mock.patch("push_notifications.webpush.webpush", side_effect=webpush)
+
+	def test_throttled_subscriptions_are_retried_after_the_others(self):
+		with self._webpush("0.05"):
+			res = WebPushDevice.objects.all().send_message("message")
+
+		self.assertEqual([r.get("success") for r in res], [1, 1, 1, 1])
+		self.assertEqual([e.rsplit("/", 1)[-1] for e in self.requests], [
+			# b is set aside without a request while fcm is paused
+			"a", "c", "d", "a", "b"
+		])
+
+	def test_subscriptions_fail_when_the_pause_is_too_long(self):
+		with self._webpush("3600"):
+			res = WebPushDevice.objects.all().send_message("message")
+
+		self.assertEqual([r.get("success") for r in res], [None, None, 1, 1])
+		self.assertEqual(res[0]["failure"], 1)
+		self.assertEqual(res[0]["results"][0]["error"], "Too Many Requests")
+		self.assertEqual(res[1]["results"][0]["error"], "Throttled by the push service")
+		self.assertEqual(len(self.requests), 3)
+		self.assertEqual(WebPushDevice.objects.filter(active=True).count(), 4)
+
+	def test_subscriptions_fail_after_max_retries(self):
+		with mock.patch.dict(SETTINGS, {"WP_MAX_RETRIES": 2}):
+			with self._webpush("0", throttled=10):
+				res = WebPushDevice.objects.all().send_message("message")
+
+		self.assertEqual(res[0]["results"][0]["error"], "Too Many Requests")
+		self.assertEqual([r.get("success") for r in res[1:]], [1, 1, 1])
+		self.assertEqual(self.requests.count("https://fcm.googleapis.com/fcm/send/a"), 3)
+
+	def test_origin_concurrency_is_limited(self):
+		in_flight = collections.Counter()
+		max_in_flight = collections.Counter()
+		lock = threading.Lock()
+
+		def webpush(subscription_info, **kwargs):
+			origin = subscription_info["endpoint"].split("/")[2]
+			with lock:
+				in_flight[origin] += 1
+				max_in_flight[origin] = max(max_in_flight[origin], in_flight[origin])
+			time.sleep(0.01)
+			with lock:
+				in_flight[origin] -= 1
+			return mock_success_response
+
+		for i in range(10):
+			WebPushDevice.objects.create(
+				registration_id="https://fcm.googleapis.com/fcm/send/x%d" % i,
+				browser="CHROME", auth="authtest", p256dh="p256dhtest"
+			)
+		with mock.patch.dict(SETTINGS, {"WP_MAX_WORKERS": 6, "WP_ORIGIN_MAX_CONCURRENCY": 2}):
+			with mock.patch("push_notifications.webpush.webpush", side_effect=webpush):
+				res = WebPushDevice.objects.all().send_message("message")
+
+		self.assertEqual(len(res), 14)
+		self.assertEqual(max_in_flight["fcm.googleapis.com"], 2)
+
+	def test_busy_origins_do_not_hold_the_workers(self):
+		def webpush(subscription_info, **kwargs):
+			endpoint = subscription_info["endpoint"]
+			self.requests.append(endpoint)
+			if "fcm" in endpoint:
+				time.sleep(0.05)
+			return mock_success_response
+
+		with mock.patch.dict(SETTINGS, {"WP_MAX_WORKERS": 4, "WP_ORIGIN_MAX_CONCURRENCY": 1}):
+			with mock.patch("push_notifications.webpush.webpush", side_effect=webpush):
+				res = WebPushDevice.objects.all().send_message("message")
+
+		# b waits for a to free the slot of fcm while c and d are sent
+		self.assertEqual([e.rsplit("/", 1)[-1] for e in self.requests], ["a", "c", "d", "b"])
+		self.assertEqual(
+			[r["results"][0]["original_registration_id"].rsplit("/", 1)[-1] for r in res],
+			["a", "b", "c", "d"]
+		)
+
+	def test_limiter_slots_are_released_when_a_send_raises(self):
+		def send(subscription_info, **kwargs):
+			if subscription_info["endpoint"].endswith("/b"):
+				raise ValueError("Unexpected")
+			time.sleep(0.01)
+			return mock_success_response
+
+		for i in range(2):
+			WebPushDevice.objects.create(
+				registration_id="https://fcm.googleapis.com/fcm/send/x%d" % i,
+				browser="CHROME", auth="authtest", p256dh="p256dhtest"
+			)
+		with mock.patch.dict(SETTINGS, {"WP_MAX_WORKERS": 4, "WP_ORIGIN_MAX_CONCURRENCY": 4}):
+			with mock.patch("push_notifications.webpush.webpush", side_effect=send):
+				with self.assertRaises(ValueError):
+					WebPushDevice.objects.all().send_message("message")
+
+			limiter = webpush._webpush_limiter("https://fcm.googleapis.com")
+			self.assertEqual([limiter.acquire() for i in range(5)], [True] * 4 + [False])
+
+	def test_limiter_does_not_block(self):
+		limiter = webpush._OriginLimiter(concurrency=1, rate=1)
+		self.assertTrue(limiter.acquire())
+		self.assertFalse(limiter.acquire())
+		limiter.release()
+		# the slot is free, but the only token is spent
+		self.assertFalse(limiter.acquire())
+		self.assertAlmostEqual(limiter.ready_in(), 1, delta=0.1)
+		limiter = webpush._OriginLimiter()
+		limiter.pause(30)
+		self.assertFalse(limiter.acquire())
+		self.assertAlmostEqual(limiter.ready_in(), 30, delta=0.1)
+
+	def test_origin_rate_is_limited(self):
+		limiter = webpush._OriginLimiter(rate=100)
+		start = time.monotonic()
+		for i in range(120):
+			while not limiter.acquire():
+				time.sleep(limiter.ready_in())
+			limiter.release()
+		# the first 100 requests are a burst, the next 20 take 0.2s
+		self.assertGreaterEqual(time.monotonic() - start, 0.18)
+
+	def test_retry_after_http_date(self):
+		response = mock.MagicMock(headers={
+			"Retry-After": email.utils.formatdate(time.time() + 30, usegmt=True)
+		})
+		self.assertAlmostEqual(webpush._webpush_retry_after(response), 30, delta=1.5)
+		response = mock.MagicMock(headers={})
+		self.assertEqual(webpush._webpush_retry_after(response), webpush.DEFAULT_RETRY_AFTER)
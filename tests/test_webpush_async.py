@@ -0,0 +1,204 @@
+import asyncio
+import base64
+import os
+from unittest import mock
+
+import http_ece
+from asgiref.sync import async_to_sync
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from push_notifications import webpush_async
+from push_notifications.exceptions import WebPushError
+from push_notifications.http2 import HTTP2Error, HTTP2NotSupportedError
+from push_notifications.models import WebPushDevice
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from push_notifications.webpush_async import (
+	WebPushTransport, send_bulk_message, send_message
+)
+
+from .h2server import StubH2Server
+from .test_webpush import VAPIDKeyTestCase
+
+
+ORIGIN = "https://updates.push.services.mozilla.com"
+
+
+async def webpush_handler(headers, body):
+	token = headers[":path"].rsplit("/", 1)[-1]
+	# keep a few requests in flight at the same time
+	await asyncio.sleep(0.01)
+	if token.startswith("gone"):
+		return 410, [], b"subscription has expired"
+	if token.startswith("bad"):
+		return 400, [], b"bad request"
+	return 201, [("location", "https://example.com/m/" + token)], b""
+
+
+class WebPushAsyncTestCase(VAPIDKeyTestCase):
+	def _subscribe(self, token):
+		private_key = ec.generate_private_key(ec.SECP256R1())
+		public_key = private_key.public_key().public_bytes(
+			serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+		)
+		auth = os.urandom(16)
+		device = WebPushDevice.objects.create(
+			registration_id=ORIGIN + "/wpush/v2/" + token,
+			browser="FIREFOX",
+			auth=base64.urlsafe_b64encode(auth).decode().strip("="),
+			p256dh=base64.urlsafe_b64encode(public_key).decode().strip("="),
+		)
+		return device, private_key, auth
+
+	def _run(self, send, *args, handler=webpush_handler, **kwargs):
+		async def run():
+			async with StubH2Server(handler) as server:
+				transport = WebPushTransport(
+					ORIGIN, host="127.0.0.1", port=server.port, secure=False,
+					max_concurrent_streams=10
+				)
+				try:
+					return await send(*args, transport=transport, **kwargs), server
+				finally:
+					await transport.close()
+		return async_to_sync(run)()
+
+	def test_send_bulk_message(self):
+		receivers = {}
+		for i in range(20):
+			device, private_key, auth = self._subscribe("token%d" % i)
+			receivers[device.registration_id] = (private_key, auth)
+		devices = list(WebPushDevice.objects.order_by("id"))
+
+		res, server = self._run(
+			send_bulk_message, devices, "secret message", ttl=30, headers={"Urgency": "high"}
+		)
+
+		self.assertEqual(
+			[r["results"][0]["original_registration_id"] for r in res],
+			[d.registration_id for d in devices]
+		)
+		self.assertEqual([r["success"] for r in res], [1] * 20)
+		self.assertEqual(server.connections, 1)
+		self.assertGreater(server.max_in_flight, 1)
+		self.assertLessEqual(server.max_in_flight, 10)
+
+		for headers, body in server.requests:
+			private_key, auth = receivers[ORIGIN + headers[":path"]]
+			self.assertEqual(
+				http_ece.decrypt(body, private_key=private_key, auth_secret=auth, version="aes128gcm"),
+				b"secret message"
+			)
+			self.assertEqual(headers[":method"], "POST")
+			self.assertEqual(headers["content-encoding"], "aes128gcm")
+			self.assertEqual(headers["ttl"], "30")
+			self.assertEqual(headers["urgency"], "high")
+			self.assertTrue(headers["authorization"].startswith("vapid t="))
+
+	def test_send_bulk_message_with_errors(self):
+		devices = [self._subscribe(token)[0] for token in ["abc", "gone", "bad"]]
+
+		res, server = self._run(send_bulk_message, devices, "Hello world")
+
+		self.assertEqual(res[0]["success"], 1)
+		self.assertEqual(res[1]["failure"], 1)
+		self.assertIn("410", res[1]["results"][0]["error"])
+		self.assertEqual(res[2]["failure"], 1)
+		self.assertIn("400", res[2]["results"][0]["error"])
+		inactive = WebPushDevice.objects.filter(active=False)
+		self.assertEqual(
+			list(inactive.values_list("registration_id", flat=True)), [ORIGIN + "/wpush/v2/gone"]
+		)
+
+	def test_send_bulk_message_with_request_errors(self):
+		devices = [self._subscribe("token%d" % i)[0] for i in range(5)]
+		post = WebPushTransport.post
+
+		async def failing_post(transport, path, headers, body, timeout=None):
+			if path.endswith("/token2"):
+				raise HTTP2Error("Stream reset by the push service")
+			return await post(transport, path, headers, body, timeout)
+
+		with mock.patch.object(WebPushTransport, "post", failing_post):
+			res, server = self._run(send_bulk_message, devices, "Hello world")
+
+		self.assertEqual([r.get("success") for r in res], [1, 1, None, 1, 1])
+		self.assertEqual(res[2]["failure"], 1)
+		self.assertIn("Stream reset by the push service", res[2]["results"][0]["error"])
+		self.assertEqual(len(server.requests), 4)
+		self.assertEqual(WebPushDevice.objects.filter(active=True).count(), 5)
+
+	def test_send_bulk_message_retries_throttled(self):
+		device = self._subscribe("abc")[0]
+		attempts = []
+
+		async def handler(headers, body):
+			attempts.append(headers[":path"])
+			if len(attempts) == 1:
+				return 429, [("retry-after", "0")], b""
+			return 201, [], b""
+
+		res, server = self._run(send_bulk_message, [device], "Hello world", handler=handler)
+
+		self.assertEqual(res[0]["success"], 1)
+		self.assertEqual(len(attempts), 2)
+
+	def test_send_message(self):
+		device = self._subscribe("abc")[0]
+
+		res, server = self._run(send_message, device, "Hello world")
+
+		self.assertEqual(res["success"], 1)
+		self.assertEqual(len(server.requests), 1)
+
+	def test_send_message_raises_and_deactivates(self):
+		device = self._subscribe("gone")[0]
+		res, server = self._run(send_message, device, "Hello world")
+		self.assertEqual(res["failure"], 1)
+		self.assertFalse(WebPushDevice.objects.get(id=device.id).active)
+
+		device = self._subscribe("bad")[0]
+		with self.assertRaises(WebPushError):
+			self._run(send_message, device, "Hello world")
+		self.assertTrue(WebPushDevice.objects.get(id=device.id).active)
+
+	def test_falls_back_to_http1(self):
+		device = self._subscribe("abc")[0]
+		posts = []
+
+		def post(url, data, headers, timeout):
+			posts.append((url, headers))
+			return mock.MagicMock(status_code=201, headers={}, content=b"")
+
+		async def run():
+			transport = WebPushTransport(ORIGIN)
+			with mock.patch.object(
+				transport.connection, "request", side_effect=HTTP2NotSupportedError
+			) as request:
+				with mock.patch("requests.Session.post", side_effect=post):
+					first = await send_message(device, "Hello world", transport=transport)
+					second = await send_message(device, "Hello world", transport=transport)
+			await transport.close()
+			return first, second, transport, request.call_count
+
+		with mock.patch.dict(SETTINGS, {"WP_ERROR_TIMEOUT": 5}):
+			first, second, transport, h2_attempts = async_to_sync(run)()
+
+		self.assertEqual(first["success"], 1)
+		self.assertEqual(second["success"], 1)
+		self.assertFalse(transport.http2)
+		self.assertEqual(h2_attempts, 1)
+		self.assertEqual([url for url, _ in posts], [device.registration_id] * 2)
+		self.assertEqual(posts[0][1]["content-encoding"], "aes128gcm")
+
+	def test_get_transport(self):
+		async def run():
+			first = webpush_async.get_transport(ORIGIN)
+			second = webpush_async.get_transport(ORIGIN)
+			await webpush_async.close_transports()
+			return first, second
+
+		first, second = async_to_sync(run)()
+		self.assertIs(first, second)
+		self.assertTrue(first.secure)
+		self.assertEqual((first.host, first.port), ("updates.push.services.mozilla.com", 443))
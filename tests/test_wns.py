@@ -1,16 +1,26 @@
+import socket
+import threading
+import time
 from unittest import mock
 import xml.etree.ElementTree as ET
 
 from django.test import TestCase
 
+from push_notifications import wns
+from push_notifications.http_pool import HTTPResponse
+from push_notifications.models import WNSDevice
+from push_notifications.settings import PUSH_NOTIFICATIONS_SETTINGS as SETTINGS
+from push_notifications.compat import HTTPError
 from push_notifications.wns import (
+	WNSNotificationResponseError, _wns_authenticate, _wns_send,
 	dict_to_xml_schema, wns_send_bulk_message, wns_send_message
 )
 
 
 class WNSSendMessageTestCase(TestCase):
 	def setUp(self):
-		pass
+		wns._wns_compile_toast.cache_clear()
+		wns._wns_compile_xml.cache_clear()
 
 	@mock.patch("push_notifications.wns._wns_prepare_toast", return_value="this is expected")
 	@mock.patch("push_notifications.wns._wns_send")
@@ -43,20 +53,181 @@ class WNSSendMessageTestCase(TestCase):
 
 class WNSSendBulkMessageTestCase(TestCase):
 	def setUp(self):
-		pass
+		wns._wns_compile_toast.cache_clear()
+		wns._wns_compile_xml.cache_clear()
 
-	@mock.patch("push_notifications.wns.wns_send_message")
-	def test_send_bulk_message_doesnt_call_send_message_with_empty_list(self, mock_method):
+	@mock.patch("push_notifications.wns._wns_send")
+	def test_send_bulk_message_doesnt_call_send_with_empty_list(self, mock_method):
 		wns_send_bulk_message(uri_list=[], message="test message")
 		mock_method.assert_not_called()
 
-	@mock.patch("push_notifications.wns.wns_send_message")
-	def test_send_bulk_message_calls_send_message(self, mock_method):
+	@mock.patch("push_notifications.wns._wns_prepare_toast", return_value="this is expected")
+	@mock.patch("push_notifications.wns._wns_send")
+	def test_send_bulk_message_calls_wns_send(self, mock_method, _):
 		wns_send_bulk_message(uri_list=["one", ], message="test message")
 		mock_method.assert_called_with(
-			application_id=None, message="test message", raw_data=None, uri="one", xml_data=None
+			application_id=None, uri="one", data=b"this is expected", wns_type="wns/toast"
+		)
+
+	@mock.patch("push_notifications.wns._wns_send")
+	def test_send_bulk_message_builds_the_xml_once(self, mock_method):
+		with mock.patch(
+			"push_notifications.wns.dict_to_xml_schema", wraps=dict_to_xml_schema
+		) as build:
+			for i in range(2):
+				wns_send_bulk_message(
+					uri_list=["one", "two", "three"], xml_data={"badge": {"attrs": {"value": "1"}}}
+				)
+		self.assertEqual(build.call_count, 1)
+		data = {c[1]["data"] for c in mock_method.call_args_list}
+		self.assertEqual(data, {b'<badge value="1" />'})
+		self.assertEqual(
+			{c[1]["wns_type"] for c in mock_method.call_args_list}, {"wns/badge"}
+		)
+
+	def test_toasts_are_cached_per_message_and_template(self):
+		with mock.patch(
+			"push_notifications.wns._wns_prepare_toast", wraps=wns._wns_prepare_toast
+		) as build:
+			first = wns._wns_prepare("Hello")
+			self.assertEqual(wns._wns_prepare("Hello"), first)
+			wns._wns_prepare("Hello", template="ToastText02")
+			wns._wns_prepare({"text": ["Hello"], "image": ["src"]})
+		self.assertEqual(build.call_count, 3)
+		self.assertEqual(first[0], "wns/toast")
+		self.assertIn(b'<text id="1">Hello</text>', first[1])
+
+	@mock.patch("push_notifications.wns._wns_authenticate", return_value="token")
+	def test_send_bulk_message_continues_after_errors(self, _):
+		for uri in ["https://ok", "https://expired", "https://invalid", "https://throttled"]:
+			WNSDevice.objects.create(registration_id=uri)
+		statuses = {
+			"https://ok": 200, "https://expired": 410, "https://invalid": 404,
+			"https://throttled": 406, "https://unexpected": 429, "https://timeout": None,
+		}
+
+		def request(method, uri, **kwargs):
+			if statuses[uri] is None:
+				raise socket.timeout("timed out")
+			return HTTPResponse(statuses[uri], "", {}, b"")
+
+		pool = mock.Mock()
+		pool.request.side_effect = request
+		with mock.patch("push_notifications.wns._wns_connection_pool", return_value=pool):
+			results = wns_send_bulk_message(uri_list=list(statuses), message="test message")
+
+		self.assertEqual(len(results), 6)
+		self.assertEqual(results[0], "")
+		self.assertEqual(results[1].status, 410)
+		self.assertEqual(results[2].status, 404)
+		self.assertEqual(results[3].status, 406)
+		self.assertIsInstance(results[4], HTTPError)
+		self.assertEqual(results[4].code, 429)
+		self.assertIsInstance(results[5], socket.timeout)
+		self.assertEqual(
+			set(WNSDevice.objects.filter(active=False).values_list("registration_id", flat=True)),
+			{"https://expired", "https://invalid"}
 		)
 
+	def test_send_bulk_message_with_several_workers(self):
+		in_flight = []
+		max_in_flight = []
+		lock = threading.Lock()
+
+		def send(uri, **kwargs):
+			with lock:
+				in_flight.append(uri)
+				max_in_flight.append(len(in_flight))
+			time.sleep(0.01)
+			with lock:
+				in_flight.remove(uri)
+			return uri.upper()
+
+		uris = ["uri%d" % i for i in range(20)]
+		with mock.patch.dict(SETTINGS, {"WNS_MAX_WORKERS": 4}):
+			with mock.patch("push_notifications.wns._wns_send", side_effect=send):
+				results = wns_send_bulk_message(uri_list=uris, message="test message")
+
+		self.assertEqual(results, [uri.upper() for uri in uris])
+		self.assertGreater(max(max_in_flight), 1)
+		self.assertLessEqual(max(max_in_flight), 4)
+
+
+class WNSDeviceQuerySetTestCase(TestCase):
+	def test_send_message_in_pages_per_application(self):
+		for i in range(5):
+			WNSDevice.objects.create(
+				registration_id="https://wns.example.com/%d" % i, application_id="app%d" % (i % 2)
+			)
+		WNSDevice.objects.create(registration_id="https://wns.example.com/off", active=False)
+
+		with mock.patch(
+			"push_notifications.wns.wns_send_bulk_message",
+			side_effect=lambda uri_list, **kwargs: [uri[-1] for uri in uri_list]
+		) as p:
+			res = WNSDevice.objects.all().send_message("Hello world", page_size=2)
+
+		self.assertEqual(
+			[(c[1]["application_id"], c[1]["uri_list"]) for c in p.call_args_list],
+			[
+				("app0", ["https://wns.example.com/0", "https://wns.example.com/2"]),
+				("app0", ["https://wns.example.com/4"]),
+				("app1", ["https://wns.example.com/1", "https://wns.example.com/3"]),
+			]
+		)
+		self.assertEqual(res, ["0", "2", "4", "1", "3"])
+
+
+class WNSAccessTokenTestCase(TestCase):
+	def setUp(self):
+		wns._wns_access_tokens.clear()
+
+	def _tokens(self, *tokens, expires_in=86400):
+		return mock.patch(
+			"push_notifications.wns._wns_request_access_token",
+			side_effect=[{"access_token": t, "expires_in": expires_in} for t in tokens]
+		)
+
+	def test_access_token_is_cached_per_application_and_scope(self):
+		with self._tokens("token1", "token2", "token3") as request:
+			self.assertEqual(_wns_authenticate(), "token1")
+			self.assertEqual(_wns_authenticate(), "token1")
+			self.assertEqual(_wns_authenticate(application_id="other"), "token2")
+			self.assertEqual(_wns_authenticate(scope="other.scope"), "token3")
+		self.assertEqual(request.call_count, 3)
+
+	def test_access_token_is_refreshed_before_it_expires(self):
+		with self._tokens("token1", "token2", expires_in=3600) as request:
+			with mock.patch("push_notifications.wns.time.monotonic", return_value=1000):
+				self.assertEqual(_wns_authenticate(), "token1")
+			with mock.patch("push_notifications.wns.time.monotonic", return_value=4500):
+				self.assertEqual(_wns_authenticate(), "token1")
+			with mock.patch("push_notifications.wns.time.monotonic", return_value=4560):
+				self.assertEqual(_wns_authenticate(), "token2")
+		self.assertEqual(request.call_count, 2)
+
+	def _responses(self, *statuses):
+		pool = mock.Mock()
+		pool.request.side_effect = [HTTPResponse(status, "", {}, b"") for status in statuses]
+		return mock.patch("push_notifications.wns._wns_connection_pool", return_value=pool)
+
+	def test_send_retries_once_with_a_new_token_after_401(self):
+		with self._tokens("revoked", "fresh"):
+			with self._responses(401, 200) as pool:
+				_wns_send("https://db5.notify.windows.com/?token=abc", "<toast />")
+		requests = pool.return_value.request.call_args_list
+		self.assertEqual(
+			[r[1]["headers"]["Authorization"] for r in requests], ["Bearer revoked", "Bearer fresh"]
+		)
+		self.assertEqual(wns._wns_access_tokens[(None, "notify.windows.com")][0], "fresh")
+
+	def test_send_raises_after_second_401(self):
+		with self._tokens("revoked", "also revoked"):
+			with self._responses(401, 401) as pool:
+				with self.assertRaises(WNSNotificationResponseError):
+					_wns_send("https://db5.notify.windows.com/?token=abc", "<toast />")
+		self.assertEqual(pool.return_value.request.call_count, 2)
+
 
 class WNSDictToXmlSchemaTestCase(TestCase):
 	def setUp(self):